@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+# Copyright 2018 Arista Networks.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#     Unless required by applicable law or agreed to in writing, software
+#     distributed under the License is distributed on an "AS IS" BASIS,
+#     WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#     See the License for the specific language governing permissions and
+#     limitations under the License.
+
+# Compare the ABI of the types in two binaries, or in a binary and a module
+# generated by CTypeGen. Each structure, union and enum is reduced to a
+# layout - its size, the offsets and types of its members, and the values of
+# its enumerators - and we compare hashes of those, only describing the
+# layouts that differ. We never render python for the binaries, so this is
+# fast enough to compare every type in a large library.
+
+from __future__ import print_function
+import argparse
+import imp
+import os
+import sys
+import timeit
+import types
+
+from CTypeGenRun import layoutFingerprint, moduleLayouts
+
+class AbiDiff( object ):
+   ''' The differences between two sets of layouts. changed holds a
+   ( name, descriptions ) pair for each type whose layout differs. '''
+
+   __slots__ = [ "compared", "added", "removed", "changed" ]
+
+   def __init__( self ):
+      self.compared = 0
+      self.added = []
+      self.removed = []
+      self.changed = []
+
+   def __bool__( self ):
+      return bool( self.added or self.removed or self.changed )
+
+   __nonzero__ = __bool__
+
+   def write( self, stream ):
+      for name in self.removed:
+         stream.write( "removed: %s\n" % name )
+      for name in self.added:
+         stream.write( "added: %s\n" % name )
+      for name, descriptions in self.changed:
+         stream.write( "changed: %s\n" % name )
+         for description in descriptions:
+            stream.write( "   %s\n" % description )
+
+def describeLayout( layout ):
+   ''' Return a short description of a type from its layout '''
+   kind = layout[ 0 ]
+   if kind == "ref":
+      return layout[ 1 ]
+   if kind in ( "int", "uint", "float" ):
+      return "%s%d" % ( kind, layout[ 1 ] * 8 )
+   if kind == "array":
+      return describeLayout( layout[ 2 ] ) + "".join( "[%d]" % dim
+                                                     for dim in layout[ 1 ] )
+   if kind == "opaque":
+      return "%s opaque bytes" % layout[ 1 ]
+   if kind in ( "structure", "union", "enum" ):
+      return "anonymous %s" % kind
+   return kind
+
+def describeChanges( old, new, path="" ):
+   ''' Return a list of descriptions of the differences between the layouts
+   old and new. Members of anonymous types are named by their path from the
+   outermost type. '''
+   where = "%s: " % path if path else ""
+   if old[ 0 ] != new[ 0 ] or old[ 0 ] not in ( "structure", "union", "enum" ):
+      return [ "%stype %s -> %s" % ( where, describeLayout( old ),
+                                     describeLayout( new ) ) ]
+   changes = []
+   if old[ 1 ] != new[ 1 ]:
+      changes.append( "%ssize %s -> %s" % ( where, old[ 1 ], new[ 1 ] ) )
+   if old[ 0 ] == "enum":
+      oldValues = dict( ( name, value ) for value, name in old[ 2 ] )
+      newValues = dict( ( name, value ) for value, name in new[ 2 ] )
+      for value, name in old[ 2 ]:
+         if name not in newValues:
+            changes.append( "%senumerator %s removed" % ( where, name ) )
+         elif newValues[ name ] != value:
+            changes.append( "%senumerator %s = %d -> %d" %
+                            ( where, name, value, newValues[ name ] ) )
+      for value, name in new[ 2 ]:
+         if name not in oldValues:
+            changes.append( "%senumerator %s = %d added" % ( where, name, value ) )
+      return changes or [ "%senumerator names changed" % where ]
+   if old[ 2 ] is None or new[ 2 ] is None:
+      return changes + [ "%sdefinition %s" % (
+            where, "removed" if new[ 2 ] is None else "added" ) ]
+
+   oldMembers = dict( ( member[ 0 ], member ) for member in old[ 2 ] )
+   newMembers = dict( ( member[ 0 ], member ) for member in new[ 2 ] )
+   prefix = "%s." % path if path else ""
+   for member in old[ 2 ]:
+      if member[ 0 ] not in newMembers:
+         changes.append( "%s%s: removed" % ( prefix, member[ 0 ] ) )
+   for name, offset, bits, layout in new[ 2 ]:
+      member = prefix + name
+      if name not in oldMembers:
+         changes.append( "%s: added at offset %s" % ( member, offset ) )
+         continue
+      _, oldOffset, oldBits, oldLayout = oldMembers[ name ]
+      if oldOffset != offset:
+         changes.append( "%s: offset %s -> %s" % ( member, oldOffset, offset ) )
+      if oldBits != bits:
+         changes.append( "%s: bit-field width %s -> %s" % ( member, oldBits, bits ) )
+      if oldLayout != layout:
+         changes.extend( describeChanges( oldLayout, layout, member ) )
+   return changes or [ "%smembers reordered" % where ]
+
+def diffLayouts( old, new, names=None ):
+   ''' Compare two dicts mapping type names to layouts, as returned by
+   CTypeGen.binaryLayouts or CTypeGenRun.moduleLayouts, and return an
+   AbiDiff. If names is given, only types with those names are compared. '''
+   diff = AbiDiff()
+   if names is not None:
+      names = set( names )
+      old = dict( item for item in old.items() if item[ 0 ] in names )
+      new = dict( item for item in new.items() if item[ 0 ] in names )
+   for name in sorted( set( old ) | set( new ) ):
+      if name not in new:
+         diff.removed.append( name )
+      elif name not in old:
+         diff.added.append( name )
+      else:
+         diff.compared += 1
+         if layoutFingerprint( old[ name ] ) != layoutFingerprint( new[ name ] ):
+            diff.changed.append( ( name, describeChanges( old[ name ],
+                                                          new[ name ] ) ) )
+   return diff
+
+def loadLayouts( source, errorfunc=None ):
+   ''' Return the layouts of the types in source, and whether it's a
+   generated module. source may be a module, the path of a generated module's
+   source, or the path of an ELF binary with DWARF information. '''
+   if isinstance( source, types.ModuleType ):
+      return moduleLayouts( source ), True
+   if source.endswith( ".py" ):
+      name = os.path.splitext( os.path.basename( source ) )[ 0 ]
+      return moduleLayouts( imp.load_source( name, source ) ), True
+   from CTypeGen import binaryLayouts
+   return binaryLayouts( [ source ], errorfunc ), False
+
+def abiDiff( old, new, errorfunc=None ):
+   ''' Compare the types in old and new - see loadLayouts. Where one is a
+   generated module, we only compare the types it has: the binary will have
+   many more, that the module doesn't use. '''
+   oldLayouts, oldIsModule = loadLayouts( old, errorfunc )
+   newLayouts, newIsModule = loadLayouts( new, errorfunc )
+   names = None
+   if oldIsModule or newIsModule:
+      names = set()
+      if oldIsModule:
+         names |= set( oldLayouts )
+      if newIsModule:
+         names |= set( newLayouts )
+   return diffLayouts( oldLayouts, newLayouts, names )
+
+def main( argv=None ):
+   parser = argparse.ArgumentParser(
+         description="compare the layouts of the types in two binaries, or a "
+         "binary and a module generated by CTypeGen" )
+   parser.add_argument( "old", help="binary, or generated python module" )
+   parser.add_argument( "new", help="binary, or generated python module" )
+   parser.add_argument( "--quiet", action="store_true",
+                        help="only report the number of differences" )
+   args = parser.parse_args( argv )
+   errors = []
+   start = timeit.default_timer()
+   diff = abiDiff( args.old, args.new, errors.append )
+   elapsed = timeit.default_timer() - start
+   if not args.quiet:
+      diff.write( sys.stdout )
+   print( "compared %d types in %.2fs: %d added, %d removed, %d changed" %
+          ( diff.compared, elapsed, len( diff.added ), len( diff.removed ),
+            len( diff.changed ) ) )
+   if errors:
+      print( "%d errors reading DWARF information" % len( errors ),
+             file=sys.stderr )
+   return 1 if diff else 0
+
+if __name__ == "__main__":
+   sys.exit( main() )
@@ -15,10 +15,19 @@ from __future__ import print_function
 # CTypeGen generates boilerplate code using python's ctype package to
 # interact with C libraries. See Aid 3558, aka go/ctypegen for the gorey details.
 
+import contextlib
+import ctypes
 import datetime
+import fnmatch
 import io
 import imp
 import inspect
+import json
+import keyword
+import os
+import re
+import resource
+import timeit
 
 # the following modules are dynamically generated inside the C extension.
 # pylint should ignore them
@@ -27,12 +36,23 @@ import libCTypeGen # pylint: disable=import-error
 tags = libCTypeGen.tags
 attrs = libCTypeGen.attrs
 
+from CTypeGenRun import arrayLayout, layoutFingerprint, scalarLayout
+from CTypeMemory import buildId
+
 # python3 doesn't have basestring
 try:
    baseString = basestring
 except NameError:
    baseString = str
 
+# Names of types are shared widely, so we intern them. The builtin intern
+# only accepts str on python2, where names from libCTypeGen are unicode, so
+# we keep our own table, which works for both.
+internedNames = {}
+
+def intern( s ):
+   return internedNames.setdefault( s, s )
+
 try:
    dict.iteritems
 except AttributeError:
@@ -54,38 +74,69 @@ else:
 # sanity check on the generated file.
 # pkgdeps: import CTypeGenRun
 
+pythonIdRepls = {
+      u":" : u"_cn",
+      u"<" : u"_lt",
+      u">" : u"_gt",
+      u"(" : u"_lp",
+      u")" : u"_rp",
+      u"*" : u"_ptr",
+      u" " : u"_sp",
+      u"," : u"_comma",
+      u"&" : u"_amp",
+      u"[" : u"_lbrack",
+      u"]" : u"_rbrack",
+      }
+pythonIdEscapes = re.compile( u"[:<>()* ,&\\[\\]]+" )
+pythonIds = {}
+
+def escapePythonId( match ):
+   text = u"".join( pythonIdRepls[ c ] for c in match.group( 0 ) )
+   # Separate the escaped characters from any that follow.
+   if match.end() != len( match.string ):
+      text += u"_"
+   return text
+
 def asPythonId( s ):
    ''' convert an identifier from debug data into a valid DWARF id '''
-   repls = {
-         u":" : u"_cn",
-         u"<" : u"_lt",
-         u">" : u"_gt",
-         u"(" : u"_lp",
-         u")" : u"_rp",
-         u"*" : u"_ptr",
-         u" " : u"_sp",
-         u"," : u"_comma",
-         u"&" : u"_amp",
-         u"[" : u"_lbrack",
-         u"]" : u"_rbrack",
-         }
    if s is None:
       return None
-   prevWasEscaped = False
-   output = io.StringIO()
-   for c in s:
-      if c in repls:
-         output.write( repls[ c ] )
-         prevWasEscaped = True
-      else:
-         if prevWasEscaped:
-            output.write( u"_" )
-         output.write( c )
-         prevWasEscaped = False
-   out = output.getvalue()
-   output.close()
+   out = pythonIds.get( s )
+   if out is None:
+      out = pythonIdEscapes.sub( escapePythonId, s )
+      pythonIds[ s ] = out
    return out
 
+def splitScopedName( name ):
+   ''' Split a qualified C++ name into its components, leaving any "::" in
+   template arguments alone, eg, "A::B<C::D>::E" gives [ "A", "B<C::D>", "E" ] '''
+   parts = []
+   depth = 0
+   start = 0
+   i = 0
+   while i < len( name ):
+      if name[ i ] in "<(":
+         depth += 1
+      elif name[ i ] in ">)":
+         depth -= 1
+      elif depth == 0 and name.startswith( "::", i ):
+         parts.append( name[ start : i ] )
+         i += 2
+         start = i
+         continue
+      i += 1
+   parts.append( name[ start : ] )
+   return parts
+
+def layoutSource( layout ):
+   ''' Return python source for a layout, or part of one '''
+   if isinstance( layout, list ):
+      return u"[ %s ]" % u", ".join( layoutSource( item ) for item in layout ) \
+            if layout else u"[]"
+   if isinstance( layout, baseString ):
+      return u'"%s"' % layout
+   return u"%s" % layout
+
 def pad( indent ):
    ''' Return a padding string with the given number of spaces - useful for
    formatting'''
@@ -96,15 +147,17 @@ class Type( object ):
    for structures, unions, functions, etc'''
 
    __slots__ = [
-         "resolver", "die", "_name", "spec", "defdie"
+         "resolver", "die", "_name", "spec", "defdie", "memos", "memoEpoch"
    ]
 
    def __init__( self, resolver, die ):
       self.resolver = resolver
-      self._name = "::".join( die.fullname() ) if die else "void"
+      self._name = intern( "::".join( die.fullname() ) ) if die else "void"
       self.spec = None
       self.die = die
       self.defdie = None
+      self.memos = {}
+      self.memoEpoch = resolver.epoch
 
    def definition( self ):
       if self.defdie:
@@ -112,17 +165,37 @@ class Type( object ):
       if not self.die[ attrs.DW_AT_declaration ]:
          self.defdie = self.die
          return self.defdie
-      for d in self.resolver.dwarves:
-         self.defdie = d.findDefinition( self.die )
-         if self.defdie:
-            return self.defdie
+      stats = self.resolver.stats
+      stats.begin( "definitions" )
+      try:
+         for d in self.resolver.dwarves:
+            stats.findDefinitionCalls += 1
+            self.defdie = d.findDefinition( self.die )
+            if self.defdie:
+               return self.defdie
+      finally:
+         stats.end()
       self.resolver.errorfunc( "failed to find definition for %s" %
-                               self.die.fullname() )
+                               self._name )
       self.defdie = self.die
       return self.defdie
 
    def applyHints( self, spec ):
+      # Only our own rendering depends on our spec, so only our memos go.
       self.spec = spec
+      self.memos = {}
+
+   def memoized( self, kind, render ):
+      ''' Return the result of render(), caching it until hints are applied
+      to this type, or the resolver invalidates all rendered names '''
+      if self.memoEpoch != self.resolver.epoch:
+         self.memos = {}
+         self.memoEpoch = self.resolver.epoch
+      value = self.memos.get( kind )
+      if value is None:
+         value = render()
+         self.memos[ kind ] = value
+      return value
 
    def dieComment( self ):
       if self.pyName() == self.name():
@@ -131,7 +204,7 @@ class Type( object ):
 
    def pyName( self ):
       ''' Remove non-python characters from this type's name'''
-      return asPythonId( self.name() )
+      return self.memoized( "pyName", lambda: asPythonId( self.name() ) )
 
    def declare( self, out ):
       ''' Write to out any info required to refer to this type.'''
@@ -161,6 +234,9 @@ class Type( object ):
    def name( self ):
       ''' Return the name of the structure - if there's no name in the DWARF
       info, we fabricate one based on the type descriptors offset in the DWARF. '''
+      return self.memoized( "name", self.renderName )
+
+   def renderName( self ):
       if self._name:
          res = self._name
       else:
@@ -176,25 +252,49 @@ class Type( object ):
       name of the generated python # type. (eg, struct Foo in C creates
       a class Foo in python, making Foo a valid ctype name.)
       '''
+      return self.memoized( "ctype", self.renderCtype )
+
+   def renderCtype( self ):
       return self.pyName()
 
+   def layout( self ):
+      ''' Describe this type's layout as it appears in a member of another,
+      as CTypeGenRun.typeLayout does for ctypes types '''
+      return self.definitionLayout()
+
+   def definitionLayout( self ):
+      ''' Describe this type's own layout, as CTypeGenRun.classLayout does
+      for ctypes types '''
+      return [ u"opaque", self.size() ]
+
+   def layoutName( self ):
+      ''' The name of the type in layouts: its C name, without any package
+      name. Generated classes record it as _c_name_. '''
+      return self._name
+
    def writeLibUpdates( self, indent, stream ):
       raise Exception( "writeLibUpdates not supported for this type" )
 
 class VoidType( Type ):
-   ''' A type representing void '''
+   ''' A type representing void. Each resolver has a single instance. '''
+   __slots__ = []
+
    def __init__( self, resolver ):
       super( VoidType, self ).__init__( resolver, None )
 
-   def name( self ):
+   def renderName( self ):
       return u"void"
 
+   def definitionLayout( self ):
+      return [ u"void" ]
+
 class FunctionType( Type ):
    ''' A type representing a function as pointed to by a
    pointer-to-function. We treat such pointers differently to other
    pointers in PointerType, and avoid rendering the outer POINTER(),
    which is implied in ctypes for function types. Note this means objects of
    this type don't actually appear as fields in a structure. '''
+   __slots__ = []
 
    def params( self ):
       ''' return all formal parameters to the function defined herein '''
@@ -208,11 +308,33 @@ class FunctionType( Type ):
       for child in self.params():
          self.resolver.defineType(
                self.resolver.dieToType( child[ attrs.DW_AT_type ] ), out )
+      self.resolver.definePrototype( self, out )
 
    def size( self ):
       raise Exception( "functions don't have sizes : %s" % self.name() )
 
-   def ctype( self ):
+   def definitionLayout( self ):
+      return [ u"function" ]
+
+   def renderCtype( self ):
+      ''' Functions with the same signature share a single CFUNCTYPE,
+      assigned to a name at module level. '''
+      protoName = self.resolver.prototypeName( self.signature() )
+      if self.resolver.pkgname is not None:
+         return u'%s.%s' % ( self.resolver.pkgname, protoName )
+      return protoName
+
+   def signature( self ):
+      ''' The keys of the DIEs for the return and parameter types. Unlike the
+      text of the prototype, this doesn't change when the types it refers to
+      are qualified with our package name. '''
+      dieKey = self.resolver.dieKey
+      rtype = self.definition()[ attrs.DW_AT_type ]
+      return ( dieKey( rtype ) if rtype else None, ) + tuple(
+            dieKey( child[ attrs.DW_AT_type ] ) for child in self.params() )
+
+   def prototype( self ):
+      ''' The CFUNCTYPE expression for this function's signature '''
       result = io.StringIO()
       result.write( u"CFUNCTYPE( " )
       rtype = self.baseType()
@@ -231,29 +353,24 @@ class FunctionDefType( FunctionType ):
    ''' A type representing a function declaration. We use these DIEs to
    generate the restype and argtypes fields for ctypes, so we can call
    them with type-safety. '''
+   __slots__ = []
+
+   def renderName( self ):
+      # This is the function's symbol in the library, so is never qualified
+      # with our package name.
+      return self._name
 
    def writeLibUpdates( self, indent, stream ):
       """Write function's prototype to stream"""
-      base = self.baseType()
-      if base is not None:
-         stream.write( u"%slib.%s.restype = %s\n" %
-               ( pad( indent ), self.name(), base.ctype() ) )
-      args = []
-      for child in self.params():
-         baseType = self.resolver.dieToType( child[ attrs.DW_AT_type ] )
-         args.append( baseType.ctype() )
-      stream.write( u"%slib.%s.argtypes = " % ( pad( indent ), self.name() ) )
-      if args:
-         sep = u"["
-         for arg in args:
-            stream.write( u"%s\n%s%s" % ( sep, pad( indent + 3 ), arg ) )
-            sep = ","
-         stream.write( u" ]\n\n" )
-      else:
-         stream.write( u"[]\n\n" )
+      stream.write( u"%sbindPrototype( lib.%s, %s )\n" %
+            ( pad( indent ), self.name(), self.ctype() ) )
 
 class Member( object ):
    ''' A single member in a struct, union, class etc. '''
+   __slots__ = [
+         "resolver", "_name", "ctypeOverride", "die", "allowUnalignedPtr"
+   ]
+
    def __init__( self, die, resolver ):
       self.resolver = resolver
       self._name = None
@@ -413,10 +530,9 @@ class MemberType( Type ):
       out.write( u' ):\n' )
       if self.dieComment():
          out.write( u"   %s\n" % self.dieComment() )
+      out.write( u'   _c_name_ = "%s"\n' % self.layoutName() )
       if self.spec and self.spec.pack:
          out.write( u"   _pack_ = 1\n" )
-      else:
-         out.write( u"   pass\n" )
       out.write( u'\n' )
 
    def define( self, out ):
@@ -449,6 +565,210 @@ class MemberType( Type ):
          else:
             out.write( u"   ( \"%s\", %s ),\n" % ( member.name(), member.ctype() ) )
       out.write( u"]\n\n" )
+      if self.spec and self.spec.fieldHints:
+         self.writeHintedFields( out )
+      if self.resolver.numpy:
+         out.write( u"%s._numpy_dtype_ = numpyDtype( %s )\n\n" %
+               ( self.pyName(), self.pyName() ) )
+      if self.resolver.codecs:
+         out.write( u"%s._struct_codec_ = structCodec( %s )\n\n" %
+               ( self.pyName(), self.pyName() ) )
+      if self.resolver.converters:
+         self.writeConverters( out )
+
+   def layout( self ):
+      if self.die[ attrs.DW_AT_name ] is None:
+         return self.definitionLayout()
+      return [ u"ref", self.layoutName() ]
+
+   def definitionLayout( self ):
+      kind = self.ctype_subclass().lower()
+      definition = self.definition()
+      if definition[ attrs.DW_AT_declaration ]:
+         return [ kind, None, None ]
+      return [ kind, definition[ attrs.DW_AT_byte_size ], self.memberLayouts() ]
+
+   def memberLayouts( self ):
+      ''' Describe our members as the DWARF does, ignoring any hints, so the
+      layout is the same however the type was generated. The result is in the
+      same order as self.members. '''
+      self.findMembers()
+      members = []
+      superCount = 0
+      for member in self.members:
+         die = member.die
+         name = die[ attrs.DW_AT_name ]
+         bits = die[ attrs.DW_AT_bit_size ]
+         offset = None
+         if die.tag() == tags.DW_TAG_inheritance:
+            name = u"__super__%d" % superCount
+            superCount += 1
+         elif bits and name is not None:
+            name = asPythonId( name )
+         if not bits:
+            # Compilers may leave out the location of union members.
+            offset = die[ attrs.DW_AT_data_member_location ] or 0
+         members.append( [ u"%s" % name, offset, bits, member.type().layout() ] )
+      return members
+
+   def writeHintedFields( self, out ):
+      ''' Write the layouts of any fields hints renamed or retyped, as the DWARF
+      describes them, so CTypeGenRun.classLayout can describe the class as
+      binaryLayouts describes the type. '''
+      hinted = [ ( self.fieldName( member ), layout )
+                 for member, layout in zip( self.members, self.memberLayouts() )
+                 if member.ctypeOverride is not None or
+                    self.fieldName( member ) != layout[ 0 ] ]
+      if not hinted:
+         return
+      out.write( u"%s._c_fields_ = {\n" % self.pyName() )
+      for fname, layout in hinted:
+         out.write( u'   "%s": %s,\n' % ( fname, layoutSource( layout ) ) )
+      out.write( u"}\n\n" )
+
+   def fieldName( self, member ):
+      ''' The name of member in _fields_ '''
+      return u"%s" % ( member.pyName() if member.bit_size() else member.name() )
+
+   def writeConverters( self, out ):
+      ''' Write functions converting objects of this type to and from dicts,
+      <Type>_to_dict and <Type>_from_dict. They stay out of the class, where
+      they could hide fields with the same names. '''
+      name = self.pyName()
+      out.write( u"def %s_to_dict( obj ):\n" % name )
+      out.write( u"   return {\n" )
+      for member in self.members:
+         fname = self.fieldName( member )
+         typ = None if member.ctypeOverride else convertedType( member.type() )
+         out.write( u"      '%s': %s,\n" %
+               ( fname, toDictValue( typ, fieldGet( u"obj", fname ), True ) ) )
+      out.write( u"   }\n\n" )
+
+      out.write( u"def %s_from_dict( d, obj=None ):\n" % name )
+      out.write( u"   if obj is None:\n" )
+      out.write( u"      obj = %s()\n" % name )
+      for member in self.members:
+         fname = self.fieldName( member )
+         typ = None if member.ctypeOverride else convertedType( member.type() )
+         indent = 3
+         if isinstance( self, UnionType ):
+            # Union members overlap: only set those present.
+            out.write( u"   if '%s' in d:\n" % fname )
+            indent = 6
+         writeFromDict( out, indent, typ, fieldGet( u"obj", fname ),
+               lambda value, fname=fname: fieldSet( u"obj", fname, value ),
+               u"d[ '%s' ]" % fname, True )
+      out.write( u"   return obj\n\n" )
+
+# Helpers for MemberType.writeConverters
+
+def convertedType( typ ):
+   ''' Strip typedefs and qualifiers from typ, which don't affect how we
+   convert it '''
+   while isinstance( typ, ( Typedef, ModifierType ) ) and typ.baseType():
+      typ = typ.baseType()
+   return typ
+
+def isIdentifier( name ):
+   return re.match( u"^[A-Za-z_][A-Za-z0-9_]*$", name ) is not None and \
+         not keyword.iskeyword( name )
+
+def fieldGet( obj, name ):
+   if isIdentifier( name ):
+      return u"%s.%s" % ( obj, name )
+   return u"getattr( %s, '%s' )" % ( obj, name )
+
+def fieldSet( obj, name, value ):
+   if isIdentifier( name ):
+      return u"%s.%s = %s" % ( obj, name, value )
+   return u"setattr( %s, '%s', %s )" % ( obj, name, value )
+
+def isCharType( typ ):
+   return isinstance( typ, PrimitiveType ) and typ.ctype() == u"c_char"
+
+def isRecordType( typ ):
+   ''' True for structures and unions, including those from a registry '''
+   if isinstance( typ, RegisteredType ):
+      return typ.kind != u"enum"
+   return isinstance( typ, MemberType )
+
+def isEnumType( typ ):
+   if isinstance( typ, RegisteredType ):
+      return typ.kind == u"enum"
+   return isinstance( typ, EnumType )
+
+def isScalarType( typ ):
+   ''' True if a value of typ converts to and from python by assignment '''
+   if isinstance( typ, PointerType ):
+      return typ.ctype() in ( u"c_char_p", u"c_void_p" )
+   return not isinstance( typ, ( MemberType, ArrayType, EnumType, RegisteredType ) )
+
+def toDictValue( typ, expr, isField, depth=0 ):
+   ''' Return an expression converting expr, of type typ, to python data.
+   Fields that are arrays of char are already converted to bytes by ctypes.
+   '''
+   if isRecordType( typ ):
+      return u"%s_to_dict( %s )" % ( typ.ctype(), expr )
+   if isEnumType( typ ):
+      return u"%s.value" % expr
+   if isinstance( typ, PointerType ) and not isScalarType( typ ):
+      return u"cast( %s, c_void_p ).value" % expr
+   if isinstance( typ, ArrayType ):
+      return arrayToDictValue( typ, len( typ.dimensions ), expr, isField, depth )
+   return expr
+
+def arrayToDictValue( typ, level, expr, isField, depth ):
+   element = convertedType( typ.baseType() )
+   if level == 1:
+      if isCharType( element ):
+         return expr if isField else u"%s.value" % expr
+      if isScalarType( element ):
+         return u"list( %s )" % expr
+   var = u"e%d" % depth
+   if level == 1:
+      inner = toDictValue( element, var, False, depth + 1 )
+   else:
+      inner = arrayToDictValue( typ, level - 1, var, False, depth + 1 )
+   return u"[ %s for %s in %s ]" % ( inner, var, expr )
+
+def writeFromDict( out, indent, typ, getExpr, setStmt, value, isField, depth=0 ):
+   ''' Write statements that set the object getExpr (with setStmt) of type typ
+   from the python data value '''
+   if isRecordType( typ ):
+      out.write( u"%s%s_from_dict( %s, %s )\n" %
+            ( pad( indent ), typ.ctype(), value, getExpr ) )
+   elif isinstance( typ, PointerType ) and not isScalarType( typ ):
+      out.write( u"%s%s\n" %
+            ( pad( indent ), setStmt( u"cast( %s, %s )" % ( value, typ.ctype() ) ) ) )
+   elif isinstance( typ, ArrayType ):
+      dims = len( typ.dimensions )
+      if isField and dims == 1 and isCharType( convertedType( typ.baseType() ) ):
+         out.write( u"%s%s\n" % ( pad( indent ), setStmt( value ) ) )
+         return
+      array = u"a%d" % depth
+      out.write( u"%s%s = %s\n" % ( pad( indent ), array, getExpr ) )
+      writeArrayFromDict( out, indent, typ, dims, array, value, depth )
+   else:
+      out.write( u"%s%s\n" % ( pad( indent ), setStmt( value ) ) )
+
+def writeArrayFromDict( out, indent, typ, level, array, value, depth ):
+   element = convertedType( typ.baseType() )
+   if level == 1:
+      if isCharType( element ):
+         out.write( u"%s%s.value = %s\n" % ( pad( indent ), array, value ) )
+         return
+      if isScalarType( element ) or isEnumType( element ):
+         out.write( u"%s%s[ : ] = %s\n" % ( pad( indent ), array, value ) )
+         return
+   index, var = u"i%d" % depth, u"v%d" % depth
+   out.write( u"%sfor %s, %s in enumerate( %s ):\n" %
+         ( pad( indent ), index, var, value ) )
+   item = u"%s[ %s ]" % ( array, index )
+   if level == 1:
+      writeFromDict( out, indent + 3, element, item,
+            lambda v: u"%s = %s" % ( item, v ), var, False, depth + 1 )
+   else:
+      writeArrayFromDict( out, indent + 3, typ, level - 1, item, var, depth + 1 )
 
 class StructType( MemberType ):
    ''' A member type for a structure (or class) '''
@@ -503,16 +823,55 @@ class EnumType( Type ):
       else:
          out.write( u'# Values of %s (nameless enum)\n' % self.pyName() )
 
+      # Render values as they appear through the enum's ctype.
+      intType = getattr( ctypes, self.intType() )
+      enumerators = []
       for child in self.definition():
          if self.dieComment():
             out.write( u"%s%s\n" % ( indent, self.dieComment() ) )
          if child.tag() == tags.DW_TAG_enumerator:
             value = child[ attrs.DW_AT_const_value ]
             name = asPythonId( child[ attrs.DW_AT_name ] )
-            out.write( u"%s%s = %s(%d).value # 0x%x\n" % (
-               indent, name, self.intType(), value, value ) )
+            enumerators.append( ( name, intType( value ).value ) )
+            out.write( u"%s%s = %d # 0x%x\n" % (
+               indent, name, enumerators[ -1 ][ 1 ], value ) )
+
+      if not nameless:
+         # Tables for enumName and decodeFlags in CTypeGenRun. Where values
+         # have more than one name, we use the first. ctypes claims _flags_
+         # for itself, so we avoid that name.
+         names = {}
+         for name, value in enumerators:
+            names.setdefault( value, name )
+         out.write( u"%s_names_ = {\n" % indent )
+         for value, name in sorted( names.items() ):
+            out.write( u"%s   %d: '%s',\n" % ( indent, value, name ) )
+         out.write( u"%s}\n" % indent )
+         out.write( u'%s_c_name_ = "%s"\n' % ( indent, self.layoutName() ) )
+         out.write( u"%s_flag_values_ = (\n" % indent )
+         for value, name in sorted( names.items() ):
+            if value > 0 and value & ( value - 1 ) == 0:
+               out.write( u"%s   ( 0x%x, '%s' ),\n" % ( indent, value, name ) )
+         out.write( u"%s)\n" % indent )
       out.write( u"\n\n" )
 
+   def layout( self ):
+      if self.die[ attrs.DW_AT_name ] is None:
+         return self.definitionLayout()
+      return [ u"ref", self.layoutName() ]
+
+   def definitionLayout( self ):
+      # As in the _names_ table, where values have more than one name, we
+      # use the first.
+      intType = getattr( ctypes, self.intType() )
+      names = {}
+      for child in self.definition():
+         if child.tag() == tags.DW_TAG_enumerator:
+            value = intType( child[ attrs.DW_AT_const_value ] ).value
+            names.setdefault( value, asPythonId( child[ attrs.DW_AT_name ] ) )
+      return [ u"enum", self.size(),
+               [ [ value, name ] for value, name in sorted( names.items() ) ] ]
+
    def intType( self ):
       size = self.definition()[ attrs.DW_AT_byte_size ]
       if size == 4:
@@ -549,15 +908,21 @@ class PrimitiveType( Type ):
          u"wchar_t" : u"c_wchar",
    }
 
-   def name( self ):
+   def renderName( self ):
       return self.ctype()
 
-   def ctype( self ):
+   def renderCtype( self ):
       name = self.die[ attrs.DW_AT_name ]
       if not name in PrimitiveType.baseTypes:
          raise Exception( "no python ctype for primitive C type %s" % name )
       return PrimitiveType.baseTypes[ name ]
 
+   def definitionLayout( self ):
+      name = self.die[ attrs.DW_AT_name ]
+      if not name in PrimitiveType.baseTypes:
+         return [ u"opaque", self.size() ]
+      return scalarLayout( getattr( ctypes, PrimitiveType.baseTypes[ name ] ) )
+
 class ArrayType( Type ):
    __slots__ = [ "dimensions" ]
 
@@ -576,7 +941,7 @@ class ArrayType( Type ):
    def define( self, out ):
       self.resolver.defineType( self.baseType(), out )
 
-   def ctype( self ):
+   def renderCtype( self ):
       text = self.baseType().ctype()
       for d in self.dimensions:
          text = u"%s * %d" % ( text, d )
@@ -588,6 +953,9 @@ class ArrayType( Type ):
          size *= d
       return size
 
+   def definitionLayout( self ):
+      return arrayLayout( reversed( self.dimensions ), self.baseType().layout() )
+
 class PointerType( Type ):
    __slots__ = []
 
@@ -597,7 +965,7 @@ class PointerType( Type ):
    def define( self, out ):
       self.resolver.declareType( self.baseType(), out )
 
-   def ctype( self ):
+   def renderCtype( self ):
       baseDie = self.definition()[ attrs.DW_AT_type ]
       if not baseDie:
          return u"c_void_p"
@@ -609,6 +977,9 @@ class PointerType( Type ):
          return u"c_char_p"
       return u"POINTER( %s )" % baseCtype
 
+   def definitionLayout( self ):
+      return [ u"pointer" ]
+
 class Typedef( Type ):
    ''' Typedefs are basic types that alias others. When delcaring/defining, we just
    declare/define the underlying type, and create an alias with a python
@@ -621,7 +992,9 @@ class Typedef( Type ):
 
    def applyHints( self, spec ):
       super( Typedef, self ).applyHints( spec )
-      self.baseType().applyHints( spec )
+      base = self.baseType()
+      if base is not None: # typedef void
+         base.applyHints( spec )
 
    def define( self, out ):
       self.resolver.defineType( self.baseType(), out )
@@ -640,10 +1013,30 @@ class Typedef( Type ):
          sep = u' '
       out.write( u'%s = %s%s%s # typedef\n' %
                  ( name, sep, ctype, self.dieComment() ) )
+      if self.anonymousBase() is not None:
+         out.write( u'nameTypedef( %s, "%s" )\n' % ( ctype, self.layoutName() ) )
+
+   def anonymousBase( self ):
+      ''' Return the anonymous structure, union or enum this names, through
+      any other typedefs and modifiers, or None if it names something else '''
+      base = self.baseType()
+      while isinstance( base, ( Typedef, ModifierType ) ):
+         base = base.baseType()
+      if not isinstance( base, ( MemberType, EnumType ) ) or \
+            base.die[ attrs.DW_AT_name ] is not None or \
+            base.spec is not None and base.spec.nameless_enum:
+         return None
+      return base
 
    def size( self ):
       return self.baseType().size()
 
+   def layout( self ):
+      return self.baseType().layout()
+
+   def definitionLayout( self ):
+      return self.baseType().definitionLayout()
+
 class ModifierType( Type ):
    ''' Modifier types represent things like volatile, const, etc. These
    don't really have an effect on ctypes, but we render them for
@@ -654,7 +1047,15 @@ class ModifierType( Type ):
    def size( self ):
       return self.baseType().size()
 
-   def ctype( self ):
+   def layout( self ):
+      base = self.baseType()
+      return base.layout() if base is not None else [ u"void" ]
+
+   def definitionLayout( self ):
+      base = self.baseType()
+      return base.definitionLayout() if base is not None else [ u"void" ]
+
+   def renderCtype( self ):
       return self.baseType().ctype()
 
    def declare( self, out ):
@@ -666,7 +1067,7 @@ class ModifierType( Type ):
 class ConstType( ModifierType ):
    __slots__ = []
 
-   def ctype( self ):
+   def renderCtype( self ):
       base = self.baseType()
       name = base.ctype() if base is not None else u"c_void_p"
       return u"CONST( %s )" % name
@@ -674,15 +1075,27 @@ class ConstType( ModifierType ):
 class VolatileType( ModifierType ):
    __slots__ = []
 
-   def ctype( self ):
+   def renderCtype( self ):
       return u"VOLATILE( %s )" % self.baseType().ctype()
 
 class RestrictType( ModifierType ):
    __slots__ = []
 
-   def ctype( self ):
+   def renderCtype( self ):
       return u"RESTRICT( %s )" % self.baseType().ctype()
 
+class UnspecifiedType( Type ):
+   ''' A type the compiler doesn't describe, such as C++'s decltype(nullptr).
+   The only such type we see in practice is the type of nullptr, so we treat
+   them as void pointers. '''
+   __slots__ = []
+
+   def renderCtype( self ):
+      return u"c_void_p"
+
+   def definitionLayout( self ):
+      return [ u"pointer" ]
+
 typeFromTag = {
       tags.DW_TAG_typedef : Typedef,
       tags.DW_TAG_pointer_type : PointerType,
@@ -698,6 +1111,7 @@ typeFromTag = {
       tags.DW_TAG_volatile_type : VolatileType,
       tags.DW_TAG_subprogram : FunctionDefType,
       tags.DW_TAG_restrict_type : RestrictType,
+      tags.DW_TAG_unspecified_type : UnspecifiedType,
 }
 
 class Namespace( object ):
@@ -711,7 +1125,8 @@ class Namespace( object ):
    '''
 
    __slots__ = [ "types", "variables", "functions",
-         "subspaces", "parent", "name_", "unresolvedCount", "resolver" ]
+         "subspaces", "parent", "name_", "unresolvedCount", "resolver",
+         "selectors" ]
 
    def __init__( self, parent, resolver, name ):
       self.types = {}
@@ -722,6 +1137,9 @@ class Namespace( object ):
       self.name_ = name
       self.unresolvedCount = 0
       self.resolver = resolver
+      # ( kind, Selector ) pairs for patterns that may match things within
+      # this namespace. These are inherited from our parent.
+      self.selectors = list( parent.selectors ) if parent else []
 
    def recurse( self, func ):
       func( self )
@@ -781,13 +1199,212 @@ class Namespace( object ):
          self.subspaces[ thisName ].addToSet( nameList[ 1 : ], accessor )
 
    def addType( self, spec ):
-      self.addToSet( spec.cName.split( "::" ), lambda ns: ( ns.types, spec ) )
+      self.addToSet( splitScopedName( spec.cName ), lambda ns: ( ns.types, spec ) )
+
+   def subspace( self, name ):
+      ''' Return the namespace for name within this one, creating it if
+      required '''
+      if not name in self.subspaces:
+         self.subspaces[ name ] = Namespace( self, self.resolver, name )
+      return self.subspaces[ name ]
+
+   def addSelector( self, kind, selector ):
+      ''' Add a selector for the names in the list called kind ("types",
+      "variables" or "functions") to the namespace its pattern is confined to.
+      We can never be sure we've found everything a selector matches, so
+      the namespace always remains unresolved, and the scan is complete.
+      '''
+      ns = self
+      for name in selector.prefix:
+         ns = ns.subspace( name )
+      ns.incUnresolved()
+      ns.inheritSelector( kind, selector )
+
+   def inheritSelector( self, kind, selector ):
+      self.selectors.append( ( kind, selector ) )
+      for subns in itervalues( self.subspaces ):
+         subns.inheritSelector( kind, selector )
 
    def addVar( self, fqn ):
-      self.addToSet( fqn.split( "::" ), lambda ns: ( ns.variables, None ) )
+      self.addToSet( splitScopedName( fqn ), lambda ns: ( ns.variables, None ) )
 
    def addFunc( self, fqn ):
-      self.addToSet( fqn.split( "::" ), lambda ns: ( ns.functions, None ) )
+      self.addToSet( splitScopedName( fqn ), lambda ns: ( ns.functions, None ) )
+
+class Segment( object ):
+   ''' A chunk of generated code produced by a single declare or define of a
+   type (or one of the module-level objects like Globals), along with the keys
+   of the segments that must run before it. '''
+
+   __slots__ = [ "key", "text", "deps", "index", "names" ]
+
+   # top-level names bound by a segment: "class Foo(", "def foo(" or "Foo = ",
+   # but not calls, like "foo( Foo )"
+   bindingRe = re.compile(
+         r"^(?:class\s+|def\s+|(?=[A-Za-z_]\w*\s*=))([A-Za-z_]\w*)", re.MULTILINE )
+
+   def __init__( self, key ):
+      self.key = key
+      self.text = io.StringIO()
+      self.deps = set()
+      self.index = None
+      self.names = None
+
+class SegmentedStream( object ):
+   ''' A stream that partitions the generated code into Segments, rather than
+   writing it out in one piece. TypeResolver opens a new segment for each type
+   it declares or defines, so nested declarations land in their own segments.
+   Segments are numbered in the order they complete: as with the eager
+   output, a segment's dependencies always complete before it does, so running
+   any dependency-closed subset of segments in index order is valid.'''
+
+   __slots__ = [ "stack", "segments", "byKey" ]
+
+   def __init__( self ):
+      self.stack = []
+      self.segments = []
+      self.byKey = {}
+
+   def begin( self, key ):
+      self.stack.append( Segment( key ) )
+
+   def end( self ):
+      seg = self.stack.pop()
+      seg.index = len( self.segments )
+      text = seg.text.getvalue()
+      seg.text.close()
+      seg.text = text
+      seg.names = Segment.bindingRe.findall( text )
+      self.segments.append( seg )
+      self.byKey[ seg.key ] = seg
+
+   def depend( self, key ):
+      if self.stack:
+         self.stack[ -1 ].deps.add( key )
+
+   def write( self, text ):
+      self.stack[ -1 ].text.write( text )
+
+   def resolve( self ):
+      ''' Convert the dependency keys of all segments into segment indexes.
+      The declaration of a type also depends on its definition, if there is
+      one: materializing a type must complete everything it can reach, or
+      we'd hand out classes with no _fields_ for the targets of pointers. '''
+      for seg in self.segments:
+         deps = set()
+         for key in seg.deps:
+            dep = self.byKey.get( key )
+            # A dependency on a segment still open when this one completed is
+            # on an enclosing segment, which will include us anyway.
+            if dep is not None and dep.index < seg.index:
+               deps.add( dep.index )
+         if seg.key[ 0 ] == "declare":
+            definition = self.byKey.get( ( "define", seg.key[ 1 ] ) )
+            if definition is not None and definition is not seg:
+               deps.add( definition.index )
+         seg.deps = sorted( deps )
+
+   def codeDeps( self, seg ):
+      ''' Segments that produced no code just carry dependencies: find the
+      indexes of the segments with code that seg depends on, looking through
+      any that have none. '''
+      result = set()
+      seen = set()
+      stack = list( seg.deps )
+      while stack:
+         dep = self.segments[ stack.pop() ]
+         if dep.index in seen:
+            continue
+         seen.add( dep.index )
+         if dep.text.strip():
+            result.add( dep.index )
+         else:
+            stack.extend( dep.deps )
+      return result
+
+def maxRss():
+   ''' The peak resident size of the process so far, in bytes '''
+   # ru_maxrss is in kilobytes on linux.
+   return resource.getrusage( resource.RUSAGE_SELF ).ru_maxrss * 1024
+
+class GenerationStats( object ):
+   ''' Where the time goes when generating a module. We record the wall time
+   spent in each phase of generation - opening the binaries, scanning their
+   units for DIEs, applying hints, looking up definitions, emitting the code,
+   and loading and testing the module - and, for all but the definition
+   lookups, which are too frequent to afford it, how much the peak resident
+   size of the process grew while in them. Phases nested in others, like the
+   definition lookups made while emitting, are not counted in the time of the
+   enclosing phase, though their memory is. We also count DIEs visited, calls
+   to findDefinition, hits and misses in the resolver's type cache, and types
+   emitted. '''
+
+   __slots__ = [
+         "phases",
+         "active",
+         "diesVisited",
+         "findDefinitionCalls",
+         "typeCacheHits",
+         "typeCacheMisses",
+         "typesEmitted",
+   ]
+
+   counters = ( "diesVisited", "findDefinitionCalls", "typeCacheHits",
+                "typeCacheMisses", "typesEmitted" )
+
+   def __init__( self ):
+      self.phases = {}
+      self.active = []
+      for counter in self.counters:
+         setattr( self, counter, 0 )
+
+   def charge( self, name, seconds ):
+      phase = self.phases.get( name )
+      if phase is None:
+         phase = self.phases[ name ] = { "seconds": 0.0, "count": 0,
+                                         "maxRssGrowth": 0 }
+      phase[ "seconds" ] += seconds
+      return phase
+
+   def begin( self, name ):
+      ''' Charge the time from now until the matching end() to the named
+      phase. Unlike phase(), this is cheap enough to call very often. '''
+      now = timeit.default_timer()
+      if self.active:
+         self.charge( self.active[ -1 ][ 0 ], now - self.active[ -1 ][ 1 ] )
+      self.active.append( [ name, now ] )
+
+   def end( self ):
+      now = timeit.default_timer()
+      name, start = self.active.pop()
+      phase = self.charge( name, now - start )
+      phase[ "count" ] += 1
+      if self.active:
+         self.active[ -1 ][ 1 ] = now
+      return phase
+
+   @contextlib.contextmanager
+   def phase( self, name ):
+      ''' Context manager to charge the time spent in it to the named phase,
+      along with any growth in the peak resident size of the process '''
+      before = maxRss()
+      self.begin( name )
+      try:
+         yield
+      finally:
+         self.end()[ "maxRssGrowth" ] += maxRss() - before
+
+   def asDict( self ):
+      stats = dict( ( counter, getattr( self, counter ) )
+                    for counter in self.counters )
+      stats[ "phases" ] = dict( ( name, dict( phase ) )
+                                for name, phase in iteritems( self.phases ) )
+      return stats
+
+   def writeJson( self, path ):
+      with open( path, "w" ) as out:
+         json.dump( self.asDict(), out, indent=3, sort_keys=True )
+         out.write( "\n" )
 
 class TypeResolver( object ):
 
@@ -799,54 +1416,103 @@ class TypeResolver( object ):
          "typesByDieKey",
          "declaredTypes",
          "definedTypes",
-         "pkgname",
+         "_pkgname",
+         "epoch",
+         "voidType",
          "existingTypes",
+         "existingIndex",
          "errorfunc",
          "errors",
          "rootNamespace",
          "requiredTypes",
+         "lazy",
+         "shards",
+         "numpy",
+         "codecs",
+         "converters",
+         "unitName",
+         "prototypes",
+         "definedPrototypes",
+         "stats",
+         "binaryNames",
+         "buildIds",
    ]
 
    def __init__( self, libnames, requiredTypes, functions, existingTypes,
-         errorfunc=None, globalVars=None ):
+         errorfunc=None, globalVars=None, lazy=False, shards=None, numpy=False,
+         codecs=False, converters=False ):
 
       if globalVars is None:
          globalVars = []
 
-      self.dwarves = [ libCTypeGen.open( libname ) for libname in libnames ]
+      self.stats = GenerationStats()
+      with self.stats.phase( "open" ):
+         self.dwarves = [ libCTypeGen.open( libname ) for libname in libnames ]
+         self.binaryNames = [ os.path.basename( libname ) for libname in libnames ]
+         self.buildIds = dict( ( os.path.basename( libname ), buildId( libname ) )
+                               for libname in libnames )
       self.typesByDieKey = {}
       self.declaredTypes = {}
       self.definedTypes = {}
-      self.pkgname = None
-      self.existingTypes = existingTypes if existingTypes else []
+      self.prototypes = {}
+      self.definedPrototypes = set()
+      self._pkgname = None
+      self.epoch = 0
+      self.voidType = None
+      self.existingTypes = []
+      self.existingIndex = {}
+      self.addExistingTypes( existingTypes if existingTypes else [] )
       self.errorfunc = errorfunc if errorfunc else self.error
       self.errors = 0
+      self.lazy = lazy
+      self.shards = shards
+      self.numpy = numpy
+      self.codecs = codecs
+      self.converters = converters
+      self.unitName = None
       self.rootNamespace = Namespace( None, self, None )
       self.requiredTypes = [ r if isinstance( r, PythonType ) else PythonType( r )
-              for r in requiredTypes ]
+              for r in requiredTypes if not isinstance( r, Selector ) ]
 
       # Add all the names we're interested in.
       for n in self.requiredTypes:
          self.rootNamespace.addType( n )
       for n in globalVars:
-         self.rootNamespace.addVar( n )
+         if not isinstance( n, Selector ):
+            self.rootNamespace.addVar( n )
       for n in functions:
-         self.rootNamespace.addFunc( n )
-
-      try:
-         for dwarf in self.dwarves:
-            for u in dwarf.units():
-               self.enumerateDIEs( u, self.examineDIE, self.rootNamespace )
-      except StopIteration:
-         pass
+         if not isinstance( n, Selector ):
+            self.rootNamespace.addFunc( n )
+
+      # Then add any patterns.
+      for kind, names in ( ( "types", requiredTypes ),
+                           ( "variables", globalVars ),
+                           ( "functions", functions ) ):
+         for n in names:
+            if not isinstance( n, Selector ):
+               continue
+            if kind == "functions" and n.prefix:
+               self.errorfunc( "functions are only bound from the top level, "
+                               "so %s selects nothing" % n.pattern )
+               continue
+            self.rootNamespace.addSelector( kind, n )
+
+      with self.stats.phase( "scan" ):
+         try:
+            for dwarf in self.dwarves:
+               for u in dwarf.units():
+                  self.enumerateDIEs( u, self.examineDIE, self.rootNamespace )
+         except StopIteration:
+            pass
 
       # We should now have DIEs for everything we care about. Go through and apply
       # hints
-      for i in self.requiredTypes:
-         if i.type is None:
-            self.errorfunc( "no type for %s" % i.pythonName )
-            continue
-         i.type.applyHints( i )
+      with self.stats.phase( "hints" ):
+         for i in self.requiredTypes:
+            if i.type is None:
+               self.errorfunc( "no type for %s" % i.pythonName )
+               continue
+            i.type.applyHints( i )
 
    # These are the named types we can generate definitions for
    typeDieTags = (
@@ -862,34 +1528,52 @@ class TypeResolver( object ):
       ''' Convert a DWARF DIE to a Type object '''
 
       if die is None:
-         return VoidType( self )
+         if self.voidType is None:
+            self.voidType = VoidType( self )
+         return self.voidType
 
       key = self.dieKey( die )
 
       if key in self.typesByDieKey:
+         self.stats.typeCacheHits += 1
          return self.typesByDieKey[ key ]
 
-      for existingSet in self.existingTypes:
-         if key in existingSet.definedTypes:
-            return existingSet.definedTypes[ key ]
+      existing = self.existingIndex.get( key )
+      if existing is not None:
+         self.stats.typeCacheHits += 1
+         return existing
 
+      self.stats.typeCacheMisses += 1
       newType = typeFromTag[ die.tag() ]( self, die )
 
       self.typesByDieKey[ key ] = newType
       return newType
 
+   def addExistingTypes( self, existingTypes ):
+      ''' Add the types defined by already-generated resolvers, so we refer to
+      them rather than generating our own. If more than one defines a type,
+      the first one added wins. Each entry may be a TypeResolver, or a
+      TypeRegistry or the path of one written by writeRegistry. '''
+      for existingSet in existingTypes:
+         if isinstance( existingSet, baseString ):
+            existingSet = TypeRegistry( existingSet )
+         self.existingTypes.append( existingSet )
+         for key, typ in iteritems( existingSet.definedTypes ):
+            self.existingIndex.setdefault( key, typ )
+
    def declareType( self, typ, out ):
       ''' Idempotent wrapper for Type.declare '''
       if typ is None:
          return
+      if typ.resolver != self: # This type came from a different module - use as is
+         return
 
       key = self.dieKey( typ.die )
+      self.dependOn( ( "declare", key ), out )
       if key in self.declaredTypes:
          return
-      if typ.resolver != self: # This type came from a different module - use as is
-         return
       self.declaredTypes[ key ] = typ
-      typ.declare( out )
+      self.emitSegment( ( "declare", key ), typ.declare, out )
 
    def defineType( self, typ, out ):
       ''' Idempotent wrapper for Type.define '''
@@ -899,9 +1583,63 @@ class TypeResolver( object ):
          return
 
       key = self.dieKey( typ.die )
+      self.dependOn( ( "define", key ), out )
       if key not in self.definedTypes:
          self.definedTypes[ key ] = typ
-         typ.define( out )
+         self.stats.typesEmitted += 1
+         self.emitSegment( ( "define", key ), typ.define, out )
+
+   def invalidate( self ):
+      ''' Discard the names and ctypes types have rendered so far, as something
+      they may depend on has changed '''
+      self.epoch += 1
+
+   @property
+   def pkgname( self ):
+      return self._pkgname
+
+   @pkgname.setter
+   def pkgname( self, pkgname ):
+      # Once generated, our types are referred to through the package.
+      self._pkgname = pkgname
+      self.invalidate()
+
+   def prototypeName( self, signature ):
+      ''' Return the module-level name for the CFUNCTYPE with the given
+      signature. Function types with the same signature share the same name. '''
+      name = self.prototypes.get( signature )
+      if name is None:
+         name = u"cfunc_%d" % len( self.prototypes )
+         self.prototypes[ signature ] = name
+      return name
+
+   def definePrototype( self, function, out ):
+      ''' Idempotent: assign the CFUNCTYPE for function's signature to its
+      name '''
+      name = self.prototypeName( function.signature() )
+      key = ( "prototype", name )
+      self.dependOn( key, out )
+      if name in self.definedPrototypes:
+         return
+      self.definedPrototypes.add( name )
+      text = function.prototype()
+      self.emitSegment( key,
+            lambda out: out.write( u"%s = %s\n" % ( name, text ) ), out )
+
+   def dependOn( self, key, out ):
+      ''' Note that the code being written to out requires the segment for key '''
+      if isinstance( out, SegmentedStream ):
+         out.depend( key )
+
+   def emitSegment( self, key, emit, out ):
+      ''' Call emit( out ), capturing what it writes in its own segment if we
+      are generating a segmented module '''
+      if isinstance( out, SegmentedStream ):
+         out.begin( key )
+         emit( out )
+         out.end()
+      else:
+         emit( out )
 
    def dieKey( self, die ):
       return ( die.tag(), die.fullname() )
@@ -918,12 +1656,16 @@ class TypeResolver( object ):
       tag = die.tag()
       if tag == tags.DW_TAG_compile_unit or tag == tags.DW_TAG_partial_unit:
          # Just decend compile units without affecting any namespace scope
+         self.unitName = die[ attrs.DW_AT_name ]
          return namespace
 
       name = die.name()
       if name is None:
          return None # We won't find anything in nested namespaces here.
 
+      if namespace.selectors:
+         self.selectDIE( die, name, namespace )
+
       if tag == tags.DW_TAG_variable:
          if name in namespace.variables and namespace.variables[ name ] is None:
             namespace.variables[ name ] = die
@@ -947,15 +1689,56 @@ class TypeResolver( object ):
       # If its a struct or namespace, and we're interested in any DIEs inside
       # the namespace, decend it.
       if ( tag == tags.DW_TAG_namespace or tag == tags.DW_TAG_structure_type or
-            tag == tags.DW_TAG_class_type ) and name in namespace.subspaces:
-         return namespace.subspaces.get( name )
+            tag == tags.DW_TAG_class_type ):
+         if name in namespace.subspaces:
+            return namespace.subspaces.get( name )
+         if namespace.selectors:
+            # Selectors may match things anywhere within this namespace.
+            return namespace.subspace( name )
       return None
 
+   def selectDIE( self, die, name, namespace ):
+      ''' Add die to namespace if any of its selectors match it. '''
+      tag = die.tag()
+      if tag in ( tags.DW_TAG_variable, tags.DW_TAG_subprogram ):
+         if die[ attrs.DW_AT_linkage_name ] is not None:
+            return # We can only bind things with C linkage by name.
+      if tag == tags.DW_TAG_variable:
+         kind, found = "variables", namespace.variables
+      elif die[ attrs.DW_AT_declaration ] or die[ attrs.DW_AT_name ] is None:
+         return
+      elif tag == tags.DW_TAG_subprogram:
+         if namespace is not self.rootNamespace:
+            return # We only bind functions at the top level.
+         kind, found = "functions", namespace.functions
+      elif tag in TypeResolver.typeDieTags:
+         kind, found = "types", namespace.types
+      else:
+         return
+      if name in found:
+         return
+
+      fullname = u"::".join( die.fullname() )
+      for selKind, selector in namespace.selectors:
+         if selKind == kind and selector.matches( die, fullname, self.unitName ):
+            break
+      else:
+         return
+
+      if kind == "types":
+         spec = PythonType( asPythonId( fullname ), fullname )
+         spec.type = self.dieToType( die )
+         self.requiredTypes.append( spec )
+         found[ name ] = spec
+      else:
+         found[ name ] = die
+
    def error( self, txt ):
       self.errors += 1
       print( "error: %s" % txt )
 
    def enumerateDIEs( self, die, func, ctx ):
+      self.stats.diesVisited += 1
       ctx = func( self, die, ctx )
       if self.rootNamespace.unresolvedCount == 0:
          raise StopIteration()
@@ -965,6 +1748,90 @@ class TypeResolver( object ):
 
    def write( self, stream ):
       ''' Actually write the python file to a stream '''
+      self.writeImports( stream )
+
+      # In lazy mode, we capture the content in segments, and render those
+      # as functions, to be run on demand.
+      out = SegmentedStream() if self.lazy else stream
+      self.writeContent( out )
+      if self.lazy:
+         self.writeLazy( out, stream )
+      self.writeVerification( stream )
+
+      # Make the whole shebang test itself when run.
+      stream.write( u'\nif __name__ == "__main__":\n' )
+      if self.lazy:
+         stream.write( u'   materializeTypes()\n' )
+      stream.write( u'   test_classes()\n' )
+
+   def writeVerification( self, stream ):
+      ''' Write the build-ids of our binaries, and the fingerprints of the
+      layouts of the named types we've defined, grouped by the binary that
+      defines them, for the module's verify() to check a library against '''
+      stream.write( u"\nbuildIds = {\n" )
+      for name, ident in sorted( self.buildIds.items() ):
+         stream.write( u"   '%s': %s,\n" %
+                       ( name, u"'%s'" % ident if ident else u"None" ) )
+      stream.write( u"}\n\nlayoutHashes = {\n" )
+      # DIEs know the file they came from, so find the binary for each file.
+      # Definitions may come from files we didn't open, like supplementary
+      # debug files: we can only attribute those if there's one binary, and
+      # otherwise leave them unverified.
+      binaries = {}
+      for name, dwarf in zip( self.binaryNames, self.dwarves ):
+         for unit in dwarf.units():
+            binaries.setdefault( unit.file(), name )
+      onlyBinary = self.binaryNames[ 0 ] if len( self.binaryNames ) == 1 else None
+      hashes = dict( ( name, {} ) for name in self.binaryNames )
+      for typ in itervalues( self.definedTypes ):
+         layout = namedLayout( typ )
+         if layout is None:
+            continue
+         binary = binaries.get( typ.definition().file(), onlyBinary )
+         if binary is not None:
+            hashes[ binary ][ typ.layoutName() ] = layoutFingerprint( layout )
+      for binary, fingerprints in sorted( hashes.items() ):
+         stream.write( u"   '%s': {\n" % binary )
+         for name, fingerprint in sorted( fingerprints.items() ):
+            stream.write( u'      "%s": "%s",\n' % ( name, fingerprint ) )
+         stream.write( u"   },\n" )
+      stream.write( u"}\n\ndef verify( lib_path, binary=None ):\n" )
+      stream.write( u"   return verifyLayouts( lib_path, buildIds, layoutHashes, "
+                    u"binary )\n" )
+
+   def writeRegistry( self, path ):
+      ''' Write a registry of the types we've defined to path, mapping each to
+      its python name in our module. Another resolver can load it as a
+      TypeRegistry, and use our types as it would ours. '''
+      entries = []
+      for key, typ in iteritems( self.definedTypes ):
+         # Only structures, unions and enums have classes of their own. Other
+         # types, like base types, typedefs and pointers, are cheaply
+         # resolved again by whoever uses the registry.
+         if not isinstance( typ, ( MemberType, EnumType ) ):
+            continue
+         entries.append( {
+            "tag": key[ 0 ],
+            "name": list( key[ 1 ] ),
+            "pyName": typ.pyName(),
+            "ctype": typ.ctype(),
+            "module": self.pkgname,
+            "kind": registeredKind( typ ),
+            "size": typ.size(),
+            "layout": typ.layout(),
+            "definitionLayout": typ.definitionLayout(),
+         } )
+      entries.sort( key=lambda entry: ( entry[ "name" ], entry[ "tag" ] ) )
+      with io.open( path, "w" ) as registry:
+         # One type per line. json.dumps gives str in python 2, which io
+         # won't write, hence the formatting into unicode.
+         registry.write( u'{"module": %s, "types": [\n' %
+                         json.dumps( self.pkgname ) )
+         registry.write( u",\n".join( u"%s" % json.dumps( entry, sort_keys=True )
+                                       for entry in entries ) )
+         registry.write( u"\n]}\n" )
+
+   def writeImports( self, stream ):
       stream.write(
 u'''from ctypes import * # pylint: disable=wildcard-import
 from CTypeGenRun import * # pylint: disable=wildcard-import
@@ -977,10 +1844,14 @@ from CTypeGenRun import * # pylint: disable=wildcard-import
          stream.write( u"import %s\n" % pkg.pkgname )
       stream.write( u"\n" )
 
+   def writeContent( self, out ):
+      ''' Write the types, global variables and functions we want to out '''
+      segmented = isinstance( out, SegmentedStream )
+
       def doNSTypes( ns ):
          # Define types we wanted.
          for spec in itervalues( ns.types ):
-            self.defineType( spec.type, stream )
+            self.defineType( spec.type, out )
 
          # Define types for variables we wanted.
          for name, die in iteritems( ns.variables ):
@@ -988,12 +1859,12 @@ from CTypeGenRun import * # pylint: disable=wildcard-import
                self.errorfunc( "variable %s not found in namespace %s" %
                                ( name, ns.name() ) )
             else:
-               self.defineType( self.dieToType( die[ attrs.DW_AT_type ] ), stream )
+               self.defineType( self.dieToType( die[ attrs.DW_AT_type ] ), out )
 
          # define function types we wanted.
          for name, die in iteritems( ns.functions ):
             if die:
-               self.dieToType( die ).define( stream )
+               self.defineType( self.dieToType( die ), out )
             else:
                self.errorfunc( "function %s not found" % name )
 
@@ -1001,56 +1872,331 @@ from CTypeGenRun import * # pylint: disable=wildcard-import
 
       # Now write out a class definition containing an entry for each global
       # variable.
-      stream.write( u"class Globals(object):\n" )
-      stream.write( u"%sdef __init__(self, dll):\n" % pad( 3 ) )
+      def writeGlobals( out ):
+         out.write( u"class Globals( LazyGlobals ):\n" )
+
+         def doGlobalVars( ns ):
+            for name, die in iteritems( ns.variables ):
+               if die is None:
+                  continue
+               t = self.dieToType( die[ attrs.DW_AT_type ] )
+               self.defineType( t, out )
+               out.write( u"%s%s = GlobalVariable( '%s', %s )\n" %
+                     ( pad( 3 ), name, name, t.ctype() ) )
+
+         self.rootNamespace.recurse( doGlobalVars )
+
+         out.write( u"%spass" % pad( 3 ) )
+
+      self.emitSegment( ( "module", "Globals" ), writeGlobals, out )
+
+      functions = [ self.dieToType( die )
+                    for die in itervalues( self.rootNamespace.functions ) if die ]
+
+      def writeDecorateFunctions( out ):
+         out.write( u'\ndef decorateFunctions( lib, profile=False, stackDepth=0 ):\n' )
+         for t in functions:
+            self.defineType( t, out )
+            t.writeLibUpdates( 3, out )
+         if functions:
+            out.write( u'   if profile:\n' )
+            out.write( u'      profileFunctions( lib, [\n' )
+            for t in functions:
+               out.write( u"         '%s',\n" % t.name() )
+            out.write( u'      ], stackDepth=stackDepth )\n' )
+         out.write( u'   pass\n' )
+
+      self.emitSegment( ( "module", "decorateFunctions" ),
+                        writeDecorateFunctions, out )
+
+      def writeFunctionTypes( out ):
+         out.write( u"\nfunctionTypes = {\n" )
+         for t in functions:
+            self.defineType( t, out )
+            out.write( u"   '%s': %s,\n" % ( t.pyName(), t.ctype() ) )
+         out.write( u"}" )
+
+      if functions:
+         self.emitSegment( ( "module", "functionTypes" ), writeFunctionTypes, out )
+
+      def writeLazyLibrary( out ):
+         out.write( u"\n\nclass LazyLibrary( LazyCDLL ):\n" )
+         if functions:
+            self.dependOn( ( "module", "functionTypes" ), out )
+            out.write( u"   prototypes = functionTypes\n" )
+         else:
+            out.write( u"   prototypes = {}\n" )
 
-      def doGlobalVars( ns ):
-         for name, die in iteritems( ns.variables ):
-            if die is None:
+      self.emitSegment( ( "module", "LazyLibrary" ), writeLazyLibrary, out )
+
+      if not segmented:
+         out.write( u'\n\n' )
+
+      # If the python typename is different to the C type name, then just use
+      # an assignment.
+      for spec in self.requiredTypes:
+         if spec.type is None:
+            continue
+         if spec.pythonName != spec.type.ctype():
+            def writeAlias( out, spec=spec ):
+               self.defineType( spec.type, out )
+               out.write( u'%s = %s\n' %
+                     ( spec.pythonName, spec.type.ctype() ) )
+            self.emitSegment( ( "module", spec.pythonName ), writeAlias, out )
+
+   def shardOf( self, fullname ):
+      ''' Return the name of the shard for a type with the given
+      fully-qualified name, or None if it belongs in the base module. '''
+      if callable( self.shards ):
+         return self.shards( u"::".join( fullname ) )
+      # By default, we shard on the top-level namespace.
+      return fullname[ 0 ] if len( fullname ) > 1 else None
+
+   def writeShards( self, modname, preamble ):
+      ''' Write the content as a set of modules rather than a single one: a
+      module for each shard, a base module for the types that are not in a
+      shard or are shared between shards, and modname itself, which holds the
+      globals and functions, and imports everything from the others. A type in
+      a shard may only refer to types in its own shard or the base, so when
+      types in different shards refer to each other, they move to the base.
+
+      Returns a list of ( module name, content ) in the order the modules
+      must be loaded. '''
+      segmented = SegmentedStream()
+      self.writeContent( segmented )
+      segmented.resolve()
+      segments = segmented.segments
+
+      base = u"%s_base" % modname
+
+      def moduleOf( seg ):
+         if seg.key[ 0 ] == "module":
+            return modname
+         if seg.key[ 0 ] == "prototype":
+            return base
+         shard = self.shardOf( seg.key[ 1 ][ 1 ] )
+         return base if shard is None else u"%s_%s" % ( modname, asPythonId( shard ) )
+
+      modules = [ moduleOf( seg ) for seg in segments ]
+      changed = True
+      while changed:
+         changed = False
+         for seg in segments:
+            home = modules[ seg.index ]
+            if home == modname:
+               continue
+            for dep in seg.deps:
+               if modules[ dep ] != home and modules[ dep ] != base:
+                  modules[ dep ] = base
+                  changed = True
+
+      # The names each module binds for a type (or module-level object).
+      ownerNames = {}
+      for seg in segments:
+         ownerNames.setdefault( ( modules[ seg.index ], seg.key[ 1 ] ), set() ) \
+               .update( seg.names )
+
+      shardNames = sorted( set( modules ) - set( [ base, modname ] ) )
+      result = []
+      for module in [ base ] + shardNames + [ modname ]:
+         imports = {}
+         for seg in segments:
+            if modules[ seg.index ] != module:
+               if module == modname:
+                  imports.setdefault( modules[ seg.index ], set() ).update( seg.names )
+               continue
+            for dep in segmented.codeDeps( seg ):
+               depModule = modules[ dep ]
+               if depModule != module:
+                  imports.setdefault( depModule, set() ).update(
+                        ownerNames[ ( depModule, segments[ dep ].key[ 1 ] ) ] )
+
+         stream = io.StringIO()
+         stream.write( u"%s" % preamble )
+         self.writeImports( stream )
+         for imported in sorted( imports ):
+            if not imports[ imported ]:
                continue
-            t = self.dieToType( die[ attrs.DW_AT_type ] )
-            stream.write( u"%sself.%s = ( %s ).in_dll( dll, '%s' )\n" %
-                  ( pad( 6 ), name, t.ctype(), name ) )
+            stream.write( u"from %s import ( # pylint: disable=unused-import\n" %
+                          imported )
+            for name in sorted( imports[ imported ] ):
+               stream.write( u"   %s,\n" % name )
+            stream.write( u")\n" )
+         for seg in segments:
+            if modules[ seg.index ] == module and seg.text.strip():
+               stream.write( seg.text )
+               if not seg.text.endswith( u"\n" ):
+                  stream.write( u"\n" )
+         if module == modname:
+            self.writeVerification( stream )
+            stream.write( u'\nif __name__ == "__main__":\n' )
+            stream.write( u'   test_classes()\n' )
+         result.append( ( module, stream.getvalue() ) )
+         stream.close()
+      return result
+
+   def writeLazy( self, segmented, stream ):
+      ''' Render the segments of a lazy module as functions, and hook the
+      module's __getattr__ so each name is materialized (along with everything
+      it refers to) on first access. Module-level __getattr__ requires
+      python 3.7 or later. '''
+      segmented.resolve()
+      code = [ seg for seg in segmented.segments if seg.text.strip() ]
+      renumber = dict( ( seg.index, i ) for i, seg in enumerate( code ) )
+      names = {}
+      for i, seg in enumerate( code ):
+         for name in seg.names:
+            names.setdefault( name, i )
+         stream.write( u"def _lazy%d():\n" % i )
+         if seg.names:
+            stream.write( u"   global %s\n" % u", ".join( sorted( set( seg.names ) ) ) )
+         for line in seg.text.strip( u"\n" ).split( u"\n" ):
+            stream.write( u"   %s\n" % line if line else u"\n" )
+         stream.write( u"\n" )
+
+      stream.write( u"lazyTypes = LazyTypes( globals(), [\n" )
+      for i, seg in enumerate( code ):
+         deps = sorted( renumber[ dep ] for dep in segmented.codeDeps( seg )
+                        if dep != seg.index )
+         stream.write( u"   ( _lazy%d, [ %s ] ),\n" %
+                       ( i, u", ".join( u"%d" % dep for dep in deps ) ) )
+      stream.write( u"], {\n" )
+      for name, index in sorted( names.items() ):
+         stream.write( u"   '%s': %d,\n" % ( name, index ) )
+      stream.write( u"} )\n\n" )
+      stream.write( u"__getattr__ = lazyTypes.getattr\n" )
+      stream.write( u"__dir__ = lazyTypes.dir\n" )
+      stream.write( u"materializeTypes = lazyTypes.materializeAll\n" )
+
+def registeredKind( typ ):
+   ''' What a RegisteredType records of the class of the type it stands for '''
+   return u"enum" if isinstance( typ, EnumType ) else typ.ctype_subclass().lower()
+
+class RegisteredType( object ):
+   ''' A structure, union or enum defined by another module, as loaded from its
+   registry. This stands in for the Type objects of that module's resolver: we
+   refer to it by name, and otherwise only need its kind, size and layout. '''
+
+   __slots__ = [ "resolver", "die", "_name", "_pyName", "_ctype", "kind", "_size",
+                 "_layout", "_definitionLayout" ]
+
+   def __init__( self, registry, name, entry ):
+      self.resolver = registry
+      self.die = None
+      self._name = name
+      self._pyName = entry[ "pyName" ]
+      self._ctype = entry[ "ctype" ]
+      self.kind = entry[ "kind" ]
+      self._size = entry[ "size" ]
+      self._layout = entry[ "layout" ]
+      self._definitionLayout = entry[ "definitionLayout" ]
+
+   def name( self ):
+      return self._name
 
-      self.rootNamespace.recurse( doGlobalVars )
+   def hasName( self ):
+      return True
 
-      stream.write( u"%spass" % pad( 6 ) )
+   def pyName( self ):
+      return self._pyName
 
-      ctypesProtos = {}
+   def ctype( self ):
+      return self._ctype
 
-      stream.write( u'\ndef decorateFunctions( lib ):\n' )
+   def size( self ):
+      return self._size
 
-      def doFunctions( ns ):
-         for die in itervalues( ns.functions ):
-            if not die:
-               continue
-            t = self.dieToType( die )
-            t.writeLibUpdates( 3, stream )
-            ctypesProtos[ t.pyName() ] = t.ctype()
+   def layout( self ):
+      return self._layout
 
-      doFunctions( self.rootNamespace )
-      stream.write( u'   pass\n' )
+   def definitionLayout( self ):
+      return self._definitionLayout
 
-      if ctypesProtos:
-         stream.write( u"\nfunctionTypes = {\n" )
-         for funcName, proto in ctypesProtos.items():
-            stream.write( u"   '%s': %s,\n" % ( funcName, proto ) )
-         stream.write( u"}" )
+   def applyHints( self, spec ):
+      pass
 
-      stream.write( u'\n\n' )
+class TypeRegistry( object ):
+   ''' The types defined by a generated module, loaded from the registry
+   TypeResolver.writeRegistry wrote for it. This can be passed in
+   existingTypes instead of the resolver that generated the module. '''
 
-      # If the python typename is different to the C type name, then just use
-      # an assignment.
-      for spec in self.requiredTypes:
-         if spec.type is None:
-            continue
-         if spec.pythonName != spec.type.ctype():
-            stream.write( u'%s = %s\n' %
-                  ( spec.pythonName, spec.type.ctype() ) )
+   __slots__ = [ "pkgname", "definedTypes" ]
 
-      # Make the whole shebang test itself when run.
-      stream.write( u'\nif __name__ == "__main__":\n' )
-      stream.write( u'   test_classes()\n' )
+   def __init__( self, path ):
+      with io.open( path ) as registry:
+         content = json.load( registry )
+      self.pkgname = content[ "module" ]
+      self.definedTypes = {}
+      for entry in content[ "types" ]:
+         name = tuple( entry[ "name" ] )
+         self.definedTypes[ ( entry[ "tag" ], name ) ] = RegisteredType( self,
+               u"::".join( name ), entry )
+
+class Selector( object ):
+   ''' A pattern that selects all the types, functions or global variables
+   whose fully-qualified C names match it. Selectors can be used in place of
+   names in the lists of types, functions and globals passed to generate.
+   Types selected get a python name derived from their C name.
+
+   Parameters:
+      pattern: a glob pattern (or a regular expression if regex is set)
+         matched against the whole qualified name, eg, "Outer::*", or "foo_*".
+      tags: for types, the DWARF tags of the types to select, which may
+         include DW_TAG_base_type. By default, we select structs, classes,
+         unions, enums and typedefs.
+      unit: a glob pattern the name of the compilation unit must match,
+         eg, "src/api/*"
+      external: if True, only select things with external linkage, if False,
+         only those without.
+
+   Functions and variables are only selected if they have C linkage, and
+   functions only from the top level, as those are all we can bind by name.
+   '''
+
+   # Base types are never selected unless requested.
+   typeTags = (
+         tags.DW_TAG_structure_type,
+         tags.DW_TAG_class_type,
+         tags.DW_TAG_union_type,
+         tags.DW_TAG_enumeration_type,
+         tags.DW_TAG_typedef,
+   )
+
+   __slots__ = [ "pattern", "regex", "tags", "unit", "external", "prefix",
+                 "nameMatch", "unitMatch" ]
+
+   def __init__( self, pattern, regex=False, tags=None, unit=None, external=None ):
+      self.pattern = pattern
+      self.regex = regex
+      self.tags = tags
+      self.unit = unit
+      self.external = external
+      # The leading components of a glob that contain no wildcards give the
+      # only namespace we need to search.
+      self.prefix = []
+      if regex:
+         self.nameMatch = re.compile( u"(?:%s)\\Z" % pattern ).match
+      else:
+         self.nameMatch = re.compile( fnmatch.translate( pattern ) ).match
+         for component in splitScopedName( pattern )[ : -1 ]:
+            if any( c in component for c in "*?[" ):
+               break
+            self.prefix.append( component )
+      self.unitMatch = None
+      if unit is not None:
+         self.unitMatch = re.compile( fnmatch.translate( unit ) ).match
+
+   def matches( self, die, fullname, unitName ):
+      tag = die.tag()
+      if tag in TypeResolver.typeDieTags and \
+            tag not in ( self.typeTags if self.tags is None else self.tags ):
+         return False
+      if self.external is not None and \
+            bool( die[ attrs.DW_AT_external ] ) != self.external:
+         return False
+      if self.unitMatch and ( unitName is None or not self.unitMatch( unitName ) ):
+         return False
+      return self.nameMatch( fullname ) is not None
 
 class Hint( object ):
    ''' Hints indicate some modification to a field in a struct/union
@@ -1062,6 +2208,8 @@ class Hint( object ):
      python bugs with bitfields.
    '''
 
+   __slots__ = [ "typename", "name", "typeOverride", "allowUnaligned" ]
+
    def __init__( self, typename=None, name=None, typeOverride=None,
          allowUnaligned=False ):
       self.typename = typename
@@ -1102,7 +2250,9 @@ class PythonType( object ):
       return hash( self.cName )
 
 def generateOrThrow( binaries, outname, types, functions, header=None, modname=None,
-      existingTypes=None, errorfunc=None, globalVars=None ):
+      existingTypes=None, errorfunc=None, globalVars=None, lazy=False,
+      shards=None, registry=None, numpy=False, codecs=False,
+      converters=False, stats=None ):
    '''  External interface to generate code from a set of binaries, into a python
    module.
    Parameters:
@@ -1121,7 +2271,40 @@ def generateOrThrow( binaries, outname, types, functions, header=None, modname=N
          to types in the generated code will be resolved in those modules
          before attempting to render new copies of them. Eg, when generating
          GatedBgpCTypes, we pass GatedBgpTypes first, so the same type instances
-         are used in both for the basic gated types.
+         are used in both for the basic gated types. Rather than the resolver
+         returned when generating a module, you can pass the path of the
+         registry written for it (see below), to avoid having to generate
+         them in the same process.
+      lazy: generate a module that creates its types on first access, rather
+         than at import time. Accessing a type also creates everything it
+         refers to. This relies on module-level __getattr__ (python 3.7+), and
+         as with any module __getattr__, "from module import *" will only see
+         types that have already been created.
+      shards: split the types over several modules, written alongside outname.
+         If True, types go in a module for the top-level namespace they are
+         declared in, named <modname>_<namespace>. Otherwise, shards is a
+         function taking a type's fully-qualified C name (eg, "A::B::C"), and
+         returning the name of its shard. Types outside any shard, or shared
+         between shards, go in <modname>_base. The module for outname itself
+         imports all the types, and holds the globals and functions.
+      registry: if present, the path of a file to write a registry of the
+         generated types to, for use in existingTypes when generating other
+         modules.
+      numpy: give each generated structure and union a _numpy_dtype_
+         attribute, a numpy dtype with the same layout. The generated module
+         will then require numpy.
+      codecs: give each generated structure with no pointers, unions or
+         bit-fields a _struct_codec_ attribute, a struct.Struct for it. You can
+         then use unpackFrom, iterUnpack and packInto from CTypeGenRun to
+         read and write such objects without creating ctypes objects.
+      converters: write <Type>_to_dict and <Type>_from_dict functions for
+         each generated structure and union, converting objects to and from
+         python data.
+         Nested structures become dicts, arrays lists, char arrays bytes,
+         enums ints, and pointers addresses.
+      stats: if present, the path of a file to write the time spent in each
+         phase of generation, and other statistics, to, as JSON. These are
+         also available from the returned resolver's stats attribute.
    '''
 
    # Allow binaries to be a single string, or list thereof.
@@ -1132,15 +2315,19 @@ def generateOrThrow( binaries, outname, types, functions, header=None, modname=N
       errorfunc( "CTypeGen.generate requires a list of ELF images as its first" +
                  " argument" )
       return ( None, None )
+   if lazy and shards:
+      errorfunc( "CTypeGen.generate can't produce sharded lazy modules" )
+      return ( None, None )
    resolver = TypeResolver( binaries, types, functions, existingTypes, errorfunc,
-         globalVars )
-   with open( outname, 'w' ) as content:
+         globalVars, lazy, shards, numpy, codecs, converters )
+   if modname is None:
+      modname = outname.split( "." )[ 0 ]
 
-      stack = inspect.stack()
-      frame = stack[ 1 ]
-      callerSource = frame[ 1 ]
+   stack = inspect.stack()
+   frame = stack[ 1 ]
+   callerSource = frame[ 1 ]
 
-      warning = \
+   warning = \
 '''# Copyright (c) %d Arista Networks, Inc.  All rights reserved.
 # Arista Networks, Inc. Confidential and Proprietary.
 #
@@ -1149,28 +2336,100 @@ def generateOrThrow( binaries, outname, types, functions, header=None, modname=N
 # Please see AID/3558 for details on the contents of this file
 #
 ''' % ( datetime.datetime.now().year, callerSource )
-
-      content.write( warning )
-      if header is not None:
-         content.write( header )
-      resolver.write( content )
-
-   if modname is None:
-      modname = outname.split( "." )[ 0 ]
-   mod = imp.load_source( modname, outname )
-   mod.test_classes()
+   if header is not None:
+      warning += header
+
+   phase = resolver.stats.phase
+   if shards:
+      # Write each module, and load them in order, so later ones can
+      # import from the earlier ones.
+      rootName = os.path.basename( modname )
+      with phase( "emit" ):
+         modules = resolver.writeShards( rootName, warning )
+      for name, text in modules:
+         if name == rootName:
+            path, name = outname, modname
+         else:
+            path = os.path.join( os.path.dirname( outname ), name + ".py" )
+         with io.open( path, 'w' ) as content:
+            content.write( text )
+         with phase( "load" ):
+            mod = imp.load_source( name, path )
+   else:
+      with phase( "emit" ):
+         with open( outname, 'w' ) as content:
+            content.write( warning )
+            resolver.write( content )
+      with phase( "load" ):
+         mod = imp.load_source( modname, outname )
+
+   if lazy:
+      with phase( "load" ):
+         mod.materializeTypes()
+   with phase( "test" ):
+      mod.test_classes()
    resolver.pkgname = modname
+   if registry is not None:
+      resolver.writeRegistry( registry )
+   if stats is not None:
+      resolver.stats.writeJson( stats )
    print( "generated and tested %s" % modname )
    return ( mod, resolver )
 
 def generate( binaries, outname, types, functions, header=None, modname=None,
-      existingTypes=None, errorfunc=None, globalVars=None ):
+      existingTypes=None, errorfunc=None, globalVars=None, lazy=False,
+      shards=None, registry=None, numpy=False, codecs=False,
+      converters=False, stats=None ):
    try:
       return generateOrThrow( binaries, outname, types, functions, header,
-                modname, existingTypes, errorfunc, globalVars )
+                modname, existingTypes, errorfunc, globalVars, lazy, shards,
+                registry, numpy, codecs, converters, stats )
    except Exception as e: # pylint: disable=broad-except
       if errorfunc:
          errorfunc( "Fatal error: %s" % e )
       else:
          print( "Fatal error: %s" % e )
       return None, None
+
+def namedLayout( typ ):
+   ''' Return the layout of typ if it's a structure, union or enum with a name,
+   or a typedef for an anonymous one, or None otherwise. Other anonymous types
+   only appear in the layouts of those that use them. '''
+   if isinstance( typ, Typedef ):
+      base = typ.anonymousBase()
+      return base.definitionLayout() if base is not None else None
+   if isinstance( typ, ( MemberType, EnumType ) ) and \
+         typ.die[ attrs.DW_AT_name ] is not None:
+      return typ.definitionLayout()
+   return None
+
+def binaryLayouts( binaries, errorfunc=None ):
+   ''' Return a dict mapping the C name of each named structure, union,
+   class and enum defined in binaries to its layout (see
+   CTypeGenRun.classLayout). Anonymous types appear under the name of any
+   typedef for them. This uses the same type graph as generate, but renders
+   no python, so is cheap enough to run over every type in a large library. '''
+   if isinstance( binaries, baseString ):
+      binaries = [ binaries ]
+   resolver = TypeResolver( binaries, [ Selector( u"*" ) ], [], None, errorfunc )
+   layouts = {}
+   with resolver.stats.phase( "layout" ):
+      for spec in resolver.requiredTypes:
+         if spec.type.layoutName() in layouts:
+            continue
+         layout = namedLayout( spec.type )
+         if layout is not None:
+            layouts[ spec.type.layoutName() ] = layout
+   return layouts
+
+def binaryLayoutHashes( binaries, names, errorfunc=None ):
+   ''' Return the fingerprints of the layouts of the types with the given C
+   names in binaries, as generated modules record them in layoutHashes. Types
+   binaries don't define are left out. '''
+   if isinstance( binaries, baseString ):
+      binaries = [ binaries ]
+   resolver = TypeResolver( binaries,
+                            [ PythonType( asPythonId( name ), name ) for name in names ],
+                            [], None, errorfunc if errorfunc else lambda _: None )
+   return dict( ( spec.cName, layoutFingerprint( spec.type.definitionLayout() ) )
+                for spec in resolver.requiredTypes if spec.type is not None )
@@ -15,10 +15,769 @@
 # We need to look inside ctypes a bit, so do this globally:
 # pylint: disable=protected-access
 
+import collections
 import ctypes
+import hashlib
+import json
+import os
+import pickle
+import re
+import struct
+import sys
+import threading
+import time
+
+def viewRange( cls, buffer, offset, count, stride=None ):
+   ''' Check count objects of type cls, stride bytes apart, starting at
+   offset, lie within buffer and are properly aligned. Returns the count,
+   defaulting to as many objects as will fit in the buffer '''
+   size = ctypes.sizeof( cls )
+   stride = size if stride is None else stride
+   memory = memoryview( buffer )
+   length = memory.nbytes if hasattr( memory, "nbytes" ) else \
+         len( memory ) * memory.itemsize # python 2 has no nbytes
+   if count is None:
+      count = ( length - offset - size ) // stride + 1 if length - offset >= size \
+            else 0
+   if offset < 0 or count < 0 or stride < size or \
+         ( count and offset + ( count - 1 ) * stride + size > length ):
+      raise ValueError( "%d %s objects at offset %d, stride %d, "
+                        "exceed buffer of %d bytes" %
+                        ( count, cls.__name__, offset, stride, length ) )
+   alignment = ctypes.alignment( cls )
+   if alignment > 1 and length:
+      # ctypes keeps every array type it creates, so use the same one for
+      # every buffer, whatever its length.
+      address = ctypes.addressof( ( ctypes.c_char * 1 ).from_buffer( buffer ) )
+      if ( address + offset ) % alignment or stride % alignment:
+         raise ValueError( "%s objects at offset %d, stride %d are not %d byte "
+                           "aligned" % ( cls.__name__, offset, stride, alignment ) )
+   return count
+
+def viewObject( cls, buffer, offset=0 ):
+   ''' Return an object of type cls that shares the memory at offset in
+   buffer, which may be anything that provides a writable buffer, such as
+   a bytearray, mmap or shared memory segment. '''
+   viewRange( cls, buffer, offset, 1 )
+   return cls.from_buffer( buffer, offset )
+
+def viewArray( cls, buffer, offset=0, count=None ):
+   ''' Return an array of count objects of type cls that shares the memory
+   at offset in buffer. By default, the array fills the rest of buffer. '''
+   count = viewRange( cls, buffer, offset, count )
+   return ( cls * count ).from_buffer( buffer, offset )
+
+def iterView( cls, buffer, offset=0, count=None, stride=None ):
+   ''' Return an iterator over objects of type cls sharing the memory of
+   buffer, starting at offset, and stride bytes apart (by default, the size
+   of the type, ie, an array). The range is checked before we return. '''
+   stride = ctypes.sizeof( cls ) if stride is None else stride
+   count = viewRange( cls, buffer, offset, count, stride )
+   return ( cls.from_buffer( buffer, offset + i * stride ) for i in range( count ) )
 
 class TestableCtypeClass( object ):
-   pass
+
+   # How to pickle pointers in objects of this type: the addresses they hold
+   # are meaningless in another process. "null" (the default) sends them
+   # as null pointers, "raw" sends the addresses as they are (for processes
+   # that share the memory they point to, eg, forked workers), and "error"
+   # refuses to pickle objects containing pointers. Pointers in unions can't
+   # be nulled without corrupting the members they overlap, so only "raw"
+   # pickles those.
+   _pickle_pointers_ = "null"
+
+   def __init_subclass__( cls, **kwargs ):
+      super( TestableCtypeClass, cls ).__init_subclass__( **kwargs )
+      # ctypes' own __reduce__ precedes ours in the MRO of generated classes,
+      # so install ours on each class directly.
+      cls.__reduce__ = TestableCtypeClass.reduceCtype
+
+   def reduceCtype( self ):
+      ''' Pickle as the raw bytes of the object, subject to _pickle_pointers_ '''
+      return ( unpackArray, ( type( self ), packArray( [ self ] ), True ) )
+
+class LazyTypes( object ):
+   ''' Runtime support for modules generated in "lazy" mode. Such modules
+   consist of a list of segments - functions that declare or define a type,
+   and the indexes of the segments they need run first - and a map from each
+   module-level name to the segment that creates it. The module's __getattr__
+   runs the segments for a name, and all their dependencies, on first access.
+   '''
+
+   def __init__( self, namespace, segments, names ):
+      self.namespace = namespace
+      self.segments = segments
+      self.names = names
+      self.done = set()
+      self.lock = threading.RLock()
+
+   def materialize( self, index ):
+      ''' Run segment index, and everything it depends on, in the order the
+      generator emitted them '''
+      with self.lock:
+         pending = set()
+         stack = [ index ]
+         while stack:
+            i = stack.pop()
+            if i in pending or i in self.done:
+               continue
+            pending.add( i )
+            stack.extend( self.segments[ i ][ 1 ] )
+         for i in sorted( pending ):
+            self.segments[ i ][ 0 ]()
+            self.done.add( i )
+
+   def materializeAll( self ):
+      for i in range( len( self.segments ) ):
+         self.materialize( i )
+
+   def getattr( self, name ):
+      index = self.names.get( name )
+      if index is None:
+         raise AttributeError( "module %s has no attribute %s" %
+                               ( self.namespace.get( "__name__" ), name ) )
+      self.materialize( index )
+      return self.namespace[ name ]
+
+   def dir( self ):
+      return sorted( set( self.namespace ) | set( self.names ) )
+
+def bindPrototype( func, proto ):
+   ''' Set the return and argument types of func from a CFUNCTYPE '''
+   func.restype = proto._restype_
+   func.argtypes = proto._argtypes_
+
+class LazyCDLL( ctypes.CDLL ):
+   ''' A CDLL that sets the restype and argtypes of each function from its
+   prototype the first time it is accessed, rather than all at once as
+   decorateFunctions does. Generated modules derive LazyLibrary from this,
+   with prototypes set to their functionTypes. '''
+   prototypes = {}
+
+   def __getattr__( self, name ):
+      # CDLL looks up the symbol, and caches the function as an attribute, so
+      # we only get here the first time a function is used.
+      func = super( LazyCDLL, self ).__getattr__( name )
+      proto = self.prototypes.get( name )
+      if proto is not None:
+         bindPrototype( func, proto )
+      return func
+
+# Use the best timer we have: perf_counter is new in python 3.3
+profileTimer = getattr( time, "perf_counter", time.time )
+
+class BindingStats( object ):
+   ''' Counters for calls to a function through a profiled binding: the number
+   of calls, their total time in seconds, and a histogram of their latencies,
+   where histogram[ i ] counts the calls that took less than 2**i
+   nanoseconds, but at least 2**(i-1). Calls from the Python stacks in stacks
+   are also timed separately, if requested when profiling. The counters are
+   updated without locking, so concurrent calls from several threads may
+   occasionally be missed. '''
+   __slots__ = [ "library", "name", "calls", "total", "histogram", "stacks" ]
+
+   def __init__( self, library, name ):
+      self.library = library
+      self.name = name
+      self.calls = 0
+      self.total = 0.0
+      self.histogram = [ 0 ] * 64
+      self.stacks = collections.defaultdict( float )
+
+   def record( self, elapsed ):
+      self.calls += 1
+      self.total += elapsed
+      self.histogram[ min( int( elapsed * 1e9 ).bit_length(), 63 ) ] += 1
+
+   def mean( self ):
+      return self.total / self.calls if self.calls else 0.0
+
+   def percentile( self, fraction ):
+      ''' Return the upper bound, in seconds, of the histogram bucket holding
+      the given fraction of calls, eg, 0.99 for the 99th percentile '''
+      wanted = fraction * self.calls
+      seen = 0
+      for bucket, count in enumerate( self.histogram ):
+         seen += count
+         if count and seen >= wanted:
+            return 2 ** bucket / 1e9
+      return 0.0
+
+   def asDict( self ):
+      return {
+         "library": self.library,
+         "name": self.name,
+         "calls": self.calls,
+         "total": self.total,
+         "mean": self.mean(),
+         "histogram": dict( ( 2 ** bucket, count )
+                            for bucket, count in enumerate( self.histogram )
+                            if count ),
+      }
+
+profiledBindings = {}
+
+def callerStack( depth ):
+   ''' Return the python call stack of our caller's caller, outermost first,
+   in the form flame graph tools expect, of at most depth frames '''
+   frames = []
+   frame = sys._getframe( 2 )
+   while frame is not None and len( frames ) < depth:
+      code = frame.f_code
+      frames.append( "%s (%s:%d)" % ( code.co_name,
+                                      os.path.basename( code.co_filename ),
+                                      code.co_firstlineno ) )
+      frame = frame.f_back
+   return ";".join( reversed( frames ) )
+
+class ProfiledFunction( object ):
+   ''' Wraps a function from a CDLL to count and time calls to it. Other
+   attributes, like restype and argtypes, are those of the function. '''
+   __slots__ = [ "function", "stats", "stackDepth" ]
+
+   def __init__( self, function, stats, stackDepth ):
+      object.__setattr__( self, "function", function )
+      object.__setattr__( self, "stats", stats )
+      object.__setattr__( self, "stackDepth", stackDepth )
+
+   def __call__( self, *args ):
+      start = profileTimer()
+      try:
+         return self.function( *args )
+      finally:
+         elapsed = profileTimer() - start
+         self.stats.record( elapsed )
+         if self.stackDepth:
+            self.stats.stacks[ callerStack( self.stackDepth ) ] += elapsed
+
+   @property
+   def _as_parameter_( self ):
+      # Passed to C, or to cast, we're the function we wrap.
+      return self.function
+
+   def __getattr__( self, name ):
+      return getattr( self.function, name )
+
+   def __setattr__( self, name, value ):
+      setattr( self.function, name, value )
+
+def profileFunctions( lib, names, stackDepth=0 ):
+   ''' Replace each of the named functions of lib with a ProfiledFunction,
+   which keeps a BindingStats for it. If stackDepth is set, also time calls
+   separately for each python call stack they're made from, up to that many
+   frames deep, which is useful, but not cheap. Functions not in lib are
+   ignored, and those already profiled just take the new stackDepth.
+   Generated decorateFunctions call this for all their functions when passed
+   profile=True, along with their stackDepth: when they are not, nothing is
+   wrapped, and calls cost what they did before. '''
+   library = os.path.basename( lib._name or "" )
+   for name in names:
+      try:
+         function = getattr( lib, name )
+      except AttributeError:
+         continue
+      if isinstance( function, ProfiledFunction ):
+         object.__setattr__( function, "stackDepth", stackDepth )
+         continue
+      key = ( library, name )
+      stats = profiledBindings.get( key )
+      if stats is None:
+         stats = profiledBindings[ key ] = BindingStats( library, name )
+      setattr( lib, name, ProfiledFunction( function, stats, stackDepth ) )
+
+def bindingStats():
+   ''' Return the BindingStats of each profiled function, keyed by library
+   and function name '''
+   return dict( profiledBindings )
+
+def resetBindingStats():
+   for stats in profiledBindings.values():
+      stats.__init__( stats.library, stats.name )
+
+def dumpBindingStats( stream ):
+   ''' Write the time spent in each profiled function, in microseconds, in
+   the "folded" format flame graph tools (eg, flamegraph.pl) read: a line for
+   each stack, with the frames separated by semicolons. The frames are the
+   python caller's stack, if recorded, then the library, then the function. '''
+   for ( library, name ), stats in sorted( profiledBindings.items() ):
+      stacks = stats.stacks or { "": stats.total }
+      for stack, total in sorted( stacks.items() ):
+         frames = [ stack ] if stack else []
+         frames += [ library, name ]
+         stream.write( "%s %d\n" % ( ";".join( frames ), round( total * 1e6 ) ) )
+
+class GlobalVariable( object ):
+   ''' Descriptor for a global variable in a generated Globals class. The
+   variable is looked up in the library the first time it is accessed, and
+   then cached in the instance. '''
+
+   def __init__( self, name, ctype ):
+      self.name = name
+      self.ctype = ctype
+
+   def __get__( self, obj, owner ):
+      if obj is None:
+         return self
+      value = self.ctype.in_dll( obj._dll, self.name )
+      obj.__dict__[ self.name ] = value
+      return value
+
+class LazyGlobals( object ):
+   ''' Base for generated Globals classes. Each global is a GlobalVariable,
+   so it's only looked up when used, and missing symbols raise ValueError on
+   access rather than when constructing the Globals object. Globals can have
+   any names, so the helpers for these classes, globalVariables and
+   snapshotGlobals, are module functions rather than methods. '''
+
+   def __init__( self, dll ):
+      self._dll = dll
+      self._snapshotType = None
+      self._snapshotCopies = None
+
+def globalVariables( globalsClass ):
+   ''' Return the GlobalVariable descriptors of a generated Globals class,
+   by name '''
+   found = {}
+   for klass in reversed( globalsClass.__mro__ ):
+      for name, value in vars( klass ).items():
+         if isinstance( value, GlobalVariable ):
+            found[ name ] = value
+   return found
+
+def snapshotGlobals( globalsObject, into=None ):
+   ''' Copy the current values of all the globals present in the library
+   into a single structure, with a field for each. Pass a previous snapshot
+   as "into" to reuse its storage. '''
+   if globalsObject._snapshotType is None:
+      fields = []
+      sources = []
+      for name, var in sorted( globalVariables( type( globalsObject ) ).items() ):
+         try:
+            value = getattr( globalsObject, name )
+         except ValueError:
+            continue # not present in this library.
+         fields.append( ( name, var.ctype ) )
+         sources.append( ( name, ctypes.addressof( value ),
+                           ctypes.sizeof( var.ctype ) ) )
+
+      class Snapshot( ctypes.Structure ):
+         _fields_ = fields
+
+      globalsObject._snapshotType = Snapshot
+      globalsObject._snapshotCopies = [
+            ( getattr( Snapshot, name ).offset, address, size )
+            for name, address, size in sources ]
+   if into is None:
+      into = globalsObject._snapshotType()
+   base = ctypes.addressof( into )
+   for offset, address, size in globalsObject._snapshotCopies:
+      ctypes.memmove( base + offset, address, size )
+   return into
+
+def enumName( cls, value, default=None ):
+   ''' Return the name of the enumerator of cls with the given value '''
+   return cls._names_.get( value, default )
+
+def decodeFlags( cls, value ):
+   ''' Treating cls as a set of bit flags, return the names of those set in
+   value. Any bits set that have no name appear as a hex number at the end. '''
+   names = []
+   for bit, name in cls._flag_values_:
+      if value & bit:
+         names.append( name )
+         value &= ~bit
+   if value:
+      names.append( "0x%x" % value )
+   return names
+
+def numpyDtype( t ):
+   ''' Return a numpy dtype with the same layout as the ctypes type t.
+   Structures and unions become structured dtypes, with their fields at the
+   same offsets, and arrays become sub-array dtypes. Pointers are unsigned
+   integers of the same size. Bit-fields can't be described in a dtype, so
+   are left out, though the space they occupy is still accounted for. '''
+   import numpy # pylint: disable=import-error
+   cached = t.__dict__.get( "_numpy_dtype_" )
+   if cached is not None:
+      return cached
+
+   if issubclass( t, ( ctypes.Structure, ctypes.Union ) ):
+      names, formats, offsets = [], [], []
+      for fieldinfo in t._fields_:
+         if len( fieldinfo ) > 2:
+            continue # bit-field
+         fname, ftype = fieldinfo[ 0 ], fieldinfo[ 1 ]
+         names.append( fname )
+         formats.append( numpyDtype( ftype ) )
+         offsets.append( getattr( t, fname ).offset )
+      return numpy.dtype( { "names": names, "formats": formats,
+                            "offsets": offsets, "itemsize": ctypes.sizeof( t ) } )
+   if issubclass( t, ctypes.Array ):
+      element = numpyDtype( t._type_ )
+      if element.subdtype is not None:
+         # Multi-dimensional array: add our dimension to the element's.
+         base, shape = element.subdtype
+         return numpy.dtype( ( base, ( t._length_, ) + shape ) )
+      return numpy.dtype( ( element, ( t._length_, ) ) )
+   if issubclass( t, ctypes._SimpleCData ):
+      code = t._type_
+      if code == "c":
+         return numpy.dtype( "S1" )
+      if code == "u":
+         return numpy.dtype( "U1" )
+      if code not in "PzZO":
+         return numpy.dtype( code )
+   # Pointers of all kinds, including to functions.
+   return numpy.dtype( "u%d" % ctypes.sizeof( t ) )
+
+def numpyArray( obj ):
+   ''' Return a numpy array sharing memory with obj, a ctypes array. '''
+   import numpy # pylint: disable=import-error
+   t = type( obj )
+   return numpy.frombuffer( obj, dtype=numpyDtype( t._type_ ), count=t._length_ )
+
+# Codes for struct, of ctypes' simple types, that have standard sizes in
+# struct. We pick the integer codes by size.
+structSimpleCodes = { "c": "c", "?": "?", "f": "f", "d": "d" }
+structIntCodes = { 1: "b", 2: "h", 4: "i", 8: "q" }
+
+def structFormat( t ):
+   ''' Return the struct format, without byte order, of the ctypes type t,
+   including padding. Returns None if t can't be described by struct. '''
+   if issubclass( t, ctypes.Structure ):
+      fmt = []
+      pos = 0
+      for fieldinfo in t._fields_:
+         if len( fieldinfo ) > 2:
+            return None # bit-field
+         fname, ftype = fieldinfo[ 0 ], fieldinfo[ 1 ]
+         offset = getattr( t, fname ).offset
+         sub = structFormat( ftype )
+         if sub is None or offset < pos:
+            return None
+         if offset > pos:
+            fmt.append( "%dx" % ( offset - pos ) )
+         fmt.append( sub )
+         pos = offset + ctypes.sizeof( ftype )
+      if ctypes.sizeof( t ) > pos:
+         fmt.append( "%dx" % ( ctypes.sizeof( t ) - pos ) )
+      return "".join( fmt )
+   if issubclass( t, ctypes.Array ):
+      if t._type_ is ctypes.c_char:
+         return "%ds" % t._length_
+      sub = structFormat( t._type_ )
+      if sub is None:
+         return None
+      if len( sub ) == 1:
+         return "%d%s" % ( t._length_, sub )
+      return sub * t._length_
+   if issubclass( t, ctypes._SimpleCData ):
+      code = t._type_
+      if code in structSimpleCodes:
+         return structSimpleCodes[ code ]
+      if code in "bBhHiIlLqQ":
+         intCode = structIntCodes[ ctypes.sizeof( t ) ]
+         return intCode.upper() if code.isupper() else intCode
+   return None
+
+def structCodec( t ):
+   ''' Return a struct.Struct that packs and unpacks objects of the ctypes type
+   t, with the values of all its fields flattened into a tuple. Only
+   plain-old-data types, with no pointers, unions or bit-fields, have codecs:
+   for others, returns None. '''
+   if hasPointers( t ):
+      return None
+   fmt = structFormat( t )
+   if fmt is None:
+      return None
+   return struct.Struct( "=" + fmt )
+
+def classCodec( cls ):
+   ''' The struct.Struct generated for cls, when generating with codecs '''
+   codec = cls.__dict__.get( "_struct_codec_" )
+   if codec is None:
+      raise TypeError( "%s has no struct codec" % cls.__name__ )
+   return codec
+
+def unpackFrom( cls, buffer, offset=0 ):
+   ''' Return the values of the fields of the object of type cls at offset in
+   buffer as a tuple, without creating a ctypes object. Fields of nested
+   structures and elements of arrays are flattened into the tuple. '''
+   return classCodec( cls ).unpack_from( buffer, offset )
+
+def iterUnpack( cls, buffer ):
+   ''' Iterate over the objects of type cls in buffer, as with unpackFrom '''
+   return classCodec( cls ).iter_unpack( buffer )
+
+def packInto( cls, buffer, offset, *values ):
+   ''' Write values, as returned by unpackFrom, to the object of type cls at
+   offset in buffer '''
+   classCodec( cls ).pack_into( buffer, offset, *values )
+
+# Layouts describe the ABI of a type as plain lists, so the same description
+# can come from DWARF (see the layout methods of CTypeGen's types) or from the
+# ctypes classes of a generated module, and be hashed to compare them.
+# Structures, unions and enums are described in full by classLayout, and
+# appear in the types of fields as a reference to their name, unless they are
+# anonymous. Pointers are just pointers, whatever they point at.
+
+scalarKinds = dict( [ ( code, "int" ) for code in "bhilq" ] +
+                    [ ( code, "uint" ) for code in "BHILQ" ] +
+                    [ ( "f", "float" ), ( "d", "float" ), ( "g", "float" ),
+                      ( "c", "char" ), ( "u", "wchar" ), ( "?", "bool" ) ] )
+
+anonymousName = re.compile( r"(^|_cn_)anon_\d+$" )
+
+def isEnumClass( t ):
+   return issubclass( t, ctypes._SimpleCData ) and "_names_" in t.__dict__
+
+def isAnonymous( t ):
+   return anonymousName.search( t.__name__ ) is not None
+
+def scalarLayout( t ):
+   ''' Return the layout of the ctypes simple type t '''
+   kind = scalarKinds.get( t._type_ )
+   if kind is None:
+      return [ "opaque", ctypes.sizeof( t ) ]
+   return [ kind, ctypes.sizeof( t ) ]
+
+def arrayLayout( dimensions, element ):
+   ''' Return the layout of an array, with the outermost dimension first.
+   Arrays of arrays are flattened, however the dimensions were declared. '''
+   if element[ 0 ] == "array":
+      return [ "array", list( dimensions ) + element[ 1 ], element[ 2 ] ]
+   return [ "array", list( dimensions ), element ]
+
+def typeLayout( t ):
+   ''' Return the layout of the ctypes type t as it appears in a field '''
+   if issubclass( t, ( ctypes.Structure, ctypes.Union ) ) or isEnumClass( t ):
+      return classLayout( t ) if isAnonymous( t ) else [ "ref", t._c_name_ ]
+   if issubclass( t, ctypes.Array ):
+      return arrayLayout( [ t._length_ ], typeLayout( t._type_ ) )
+   if isPointer( t ):
+      return [ "pointer" ]
+   if issubclass( t, ctypes._SimpleCData ):
+      return scalarLayout( t )
+   return [ "opaque", ctypes.sizeof( t ) ]
+
+def classLayout( cls ):
+   ''' Return the layout of the generated structure, union or enum cls. For
+   structures and unions, this gives the size, and the name, offset, bit size
+   and type of each field. We can't rely on ctypes placing bit-fields as the
+   compiler does, so they have no offset. Fields renamed or retyped by hints
+   are described as the DWARF described them when the module was generated,
+   from _c_fields_. For enums, it gives the size and enumerator values. '''
+   if isEnumClass( cls ):
+      return [ "enum", ctypes.sizeof( cls ),
+               [ [ value, name ] for value, name in sorted( cls._names_.items() ) ] ]
+   kind = "union" if issubclass( cls, ctypes.Union ) else "structure"
+   if not getattr( cls, "have_definition", False ):
+      return [ kind, None, None ]
+   hinted = vars( cls ).get( "_c_fields_", {} )
+   members = []
+   for fieldinfo in cls._fields_:
+      fname, ftype = fieldinfo[ 0 ], fieldinfo[ 1 ]
+      if fname in hinted:
+         members.append( hinted[ fname ] )
+      elif len( fieldinfo ) > 2:
+         members.append( [ fname, None, fieldinfo[ 2 ], typeLayout( ftype ) ] )
+      else:
+         members.append( [ fname, getattr( cls, fname ).offset, None,
+                           typeLayout( ftype ) ] )
+   return [ kind, cls.native_size, members ]
+
+def layoutFingerprint( layout ):
+   ''' Return a hash of layout, as a hex string '''
+   text = json.dumps( layout, separators=( ",", ":" ) )
+   return hashlib.sha1( text.encode( "utf-8" ) ).hexdigest()
+
+def moduleLayouts( module ):
+   ''' Return a dict mapping the C name of each structure, union and enum
+   generated in module to its layout, as CTypeGen.binaryLayouts does for
+   binaries. Anonymous types appear under the names of any typedefs for them,
+   from _c_typedefs_: otherwise, they're left out, as their layouts are part
+   of those of the types that use them. '''
+   if hasattr( module, "materializeTypes" ):
+      module.materializeTypes()
+   layouts = {}
+   for name, value in list( vars( module ).items() ):
+      if not isinstance( value, type ) or value.__name__ != name:
+         continue
+      if not ( issubclass( value, TestableCtypeClass ) and
+               issubclass( value, ( ctypes.Structure, ctypes.Union ) ) or
+               isEnumClass( value ) ):
+         continue
+      if isAnonymous( value ):
+         names = vars( value ).get( "_c_typedefs_", () )
+      else:
+         names = ( value._c_name_, )
+      for cName in names:
+         layouts[ cName ] = classLayout( value )
+   return layouts
+
+def nameTypedef( cls, name ):
+   ''' Record that the C typedef name names the anonymous class cls, so
+   moduleLayouts describes cls under that name '''
+   cls._c_typedefs_ = vars( cls ).get( "_c_typedefs_", () ) + ( name, )
+
+layoutVerifications = {}
+
+def verifyLayouts( libPath, buildIds, layoutHashes, binary=None ):
+   ''' Check the library at libPath has the layouts a generated module expects.
+   buildIds and layoutHashes are those the module was generated with, keyed by
+   the file names of the binaries it was generated from. binary names the one
+   libPath stands for: by default, the one with the same file name, or the
+   only one. If libPath has that binary's build-id, it's the binary the module
+   was generated from. Otherwise, we find the types the module took from that
+   binary in libPath's DWARF, and compare the fingerprints of their layouts.
+   Returns the C names of the types that differ, or are missing from the
+   library, so an empty list means the module can be used with it. Results are
+   cached until the file changes. Only the check by build-id works without
+   CTypeGen and libCTypeGen: otherwise, raises ImportError. '''
+   if binary is None:
+      binary = os.path.basename( libPath )
+      if binary not in buildIds and len( buildIds ) == 1:
+         binary = next( iter( buildIds ) )
+   if binary not in buildIds:
+      raise ValueError( "%s is not one of the binaries the module was generated "
+                        "from: %s" % ( binary, ", ".join( sorted( buildIds ) ) ) )
+   expected = layoutHashes.get( binary, {} )
+   info = os.stat( libPath )
+   key = ( buildIds[ binary ], layoutFingerprint( sorted( expected.items() ) ),
+           info.st_dev, info.st_ino, info.st_size, info.st_mtime )
+   result = layoutVerifications.get( key )
+   if result is None:
+      from CTypeMemory import buildId
+      ident = buildId( libPath )
+      if ident is not None and ident == buildIds[ binary ]:
+         result = []
+      else:
+         # Only CTypeGen can read DWARF, and it needs libCTypeGen, which
+         # hosts that only run generated modules may not have.
+         try:
+            from CTypeGen import binaryLayoutHashes
+         except ImportError as e:
+            raise ImportError( "%s isn't the %s the module was generated from, "
+                               "and checking its layouts needs CTypeGen: %s" %
+                               ( libPath, binary, e ) )
+         hashes = binaryLayoutHashes( [ libPath ], list( expected ) )
+         result = sorted( name for name, fingerprint in expected.items()
+                          if hashes.get( name ) != fingerprint )
+      layoutVerifications[ key ] = result
+   return list( result )
+
+# ctypes type codes the native batch caller handles, other than pointers.
+batchCodes = "bBhHiIlLqQfdg?c"
+
+def batchCode( t ):
+   ''' Return the code libCTypeBatch uses for arguments or results of type t '''
+   if isPointer( t ):
+      return "P"
+   if issubclass( t, ctypes._SimpleCData ) and t._type_ in batchCodes:
+      return t._type_
+   raise TypeError( "can't batch-call with arguments or results of type %s" %
+                    t.__name__ )
+
+def batchArgument( argtype, value, keep ):
+   ''' Return the address and stride of the elements of value to pass as
+   arguments of type argtype, whether to pass them by address, and how many
+   there are: None for scalars, which are passed to every call. Objects whose
+   memory must outlive the call are added to keep. '''
+   if not isinstance( value, ( ctypes.Array, bytearray, memoryview ) ) and \
+         not hasattr( value, "__array_interface__" ):
+      if isPointer( argtype ):
+         if isinstance( value, ( ctypes.Structure, ctypes.Union ) ):
+            value = ctypes.pointer( value )
+         value = ctypes.cast( value, ctypes.c_void_p )
+      elif not isinstance( value, argtype ):
+         value = argtype( value )
+      keep.append( value )
+      return ctypes.addressof( value ), 0, False, None
+   memory = memoryview( value )
+   if memory.ndim != 1:
+      raise ValueError( "batch arguments must be one-dimensional arrays" )
+   count = len( memory )
+   itemsize = memory.itemsize
+   if memory.strides not in ( None, ( itemsize, ) ): # None: python 2, contiguous
+      raise ValueError( "batch arguments must be contiguous arrays: copy "
+                        "strided ones first" )
+   if memory.readonly:
+      storage = ( ctypes.c_char * ( count * itemsize ) ).from_buffer_copy( value )
+   else:
+      storage = ( ctypes.c_char * ( count * itemsize ) ).from_buffer( value )
+   keep.append( storage )
+   pointee = getattr( argtype, "_type_", None )
+   byAddress = isinstance( argtype, ctypes._Pointer.__class__ ) and \
+         ( getattr( value, "_type_", None ) is pointee or
+           ( getattr( pointee, "_numpy_dtype_", None ) is not None and
+             getattr( value, "dtype", None ) == pointee._numpy_dtype_ ) )
+   expected = ctypes.sizeof( pointee if byAddress else argtype )
+   if itemsize != expected:
+      raise TypeError( "%d byte elements passed for %d byte %s arguments" %
+                       ( itemsize, expected, argtype.__name__ ) )
+   return ctypes.addressof( storage ), itemsize, byAddress, count
+
+def batchCall( func, arguments, out=None, proto=None ):
+   ''' Call func, a function from a CDLL, once for each element of the
+   arrays in arguments, in a native loop, and return an array of the
+   results. Each argument is an array (a ctypes array, NumPy array, or other
+   buffer) of values of the argument's type, all the same length, or a single
+   value to pass to every call. Arrays of the objects pointer arguments point
+   to pass the address of each element. The argument and return types come
+   from proto, a prototype from the generated functionTypes, or else from
+   func's argtypes and restype, as set by decorateFunctions. Results are
+   stored in out, or a new ctypes array, which is returned: functions that
+   return void return None. Calls through a ProfiledFunction are made to the
+   function it wraps, and are not profiled. '''
+   import libCTypeBatch # pylint: disable=import-error
+   if isinstance( func, ProfiledFunction ):
+      func = func.function
+   if proto is not None:
+      argtypes, restype = proto._argtypes_, proto._restype_
+   else:
+      argtypes, restype = func.argtypes, func.restype
+   if argtypes is None:
+      raise TypeError( "%s has no prototype: call decorateFunctions, or pass "
+                       "proto" % getattr( func, "__name__", func ) )
+   if len( arguments ) != len( argtypes ):
+      raise TypeError( "%d arguments passed for %d parameters" %
+                       ( len( arguments ), len( argtypes ) ) )
+   keep = []
+   codes = []
+   described = []
+   counts = set()
+   for argtype, value in zip( argtypes, arguments ):
+      codes.append( batchCode( argtype ) )
+      address, stride, byAddress, count = batchArgument( argtype, value, keep )
+      described.append( ( address, stride, int( byAddress ) ) )
+      if count is not None:
+         counts.add( count )
+   if len( counts ) > 1:
+      raise ValueError( "batch argument arrays have different lengths: %s" %
+                        sorted( counts ) )
+   if counts:
+      count = counts.pop()
+   elif out is not None:
+      count = len( out )
+   else:
+      raise ValueError( "batchCall needs at least one argument array" )
+
+   if restype is None:
+      libCTypeBatch.call( ctypes.cast( func, ctypes.c_void_p ).value, "",
+                          "".join( codes ), described, 0, 0, count )
+      return None
+   restypeCode = batchCode( restype )
+   if out is None:
+      out = ( restype * count )()
+   memory = memoryview( out )
+   if memory.itemsize != ctypes.sizeof( restype ) or len( memory ) < count:
+      raise ValueError( "output array can't hold %d %s results" %
+                        ( count, restype.__name__ ) )
+   results = ( ctypes.c_char * ( count * memory.itemsize ) ).from_buffer( out )
+   libCTypeBatch.call( ctypes.cast( func, ctypes.c_void_p ).value, restypeCode,
+                       "".join( codes ), described, ctypes.addressof( results ),
+                       memory.itemsize, count )
+   return out
 
 def CONST( t ):
    return t
@@ -29,6 +788,85 @@ def VOLATILE( t ):
 def RESTRICT( t ):
    return t
 
+def isPointer( t ):
+   return isinstance( t, ctypes._Pointer.__class__ ) or \
+         issubclass( t, ctypes._CFuncPtr ) or \
+         ( issubclass( t, ctypes._SimpleCData ) and t._type_ in "PzZ" )
+
+pointerOffsetsMemo = {}
+
+def pointerOffsets( t ):
+   ''' Return the offsets of all pointers within an object of type t, and
+   their sizes, or None if some are in a union, where they overlap other
+   members '''
+   if t in pointerOffsetsMemo:
+      return pointerOffsetsMemo[ t ]
+   offsets = []
+   if isPointer( t ):
+      offsets.append( ( 0, ctypes.sizeof( t ) ) )
+   elif issubclass( t, ( ctypes.Structure, ctypes.Union ) ):
+      for fieldinfo in t._fields_:
+         if len( fieldinfo ) > 2:
+            continue # bit-fields can't be pointers.
+         inner = pointerOffsets( fieldinfo[ 1 ] )
+         if inner is None or inner and issubclass( t, ctypes.Union ):
+            offsets = None
+            break
+         base = getattr( t, fieldinfo[ 0 ] ).offset
+         offsets.extend( ( base + offset, size ) for offset, size in inner )
+   elif issubclass( t, ctypes.Array ):
+      inner = pointerOffsets( t._type_ )
+      if inner is None:
+         offsets = None
+      elif inner:
+         stride = ctypes.sizeof( t._type_ )
+         offsets.extend( ( i * stride + offset, size )
+                         for i in range( t._length_ ) for offset, size in inner )
+   pointerOffsetsMemo[ t ] = offsets
+   return offsets
+
+def packArray( objects ):
+   ''' Return the raw bytes of a sequence of ctypes objects of the same
+   type (such as a ctypes array), as a single buffer, to send to another
+   process. Pointers are treated according to the type's _pickle_pointers_.
+   Use unpackArray to turn the result back into objects. '''
+   if isinstance( objects, ctypes.Array ):
+      t = objects._type_
+      blocks = [ objects ]
+   else:
+      if not objects:
+         return bytes()
+      t = type( objects[ 0 ] )
+      blocks = objects
+   data = bytes().join( ctypes.string_at( ctypes.addressof( block ),
+                                          ctypes.sizeof( block ) )
+                        for block in blocks )
+   offsets = pointerOffsets( t )
+   policy = getattr( t, "_pickle_pointers_", "null" )
+   if offsets == [] or policy == "raw":
+      return data
+   if policy == "error":
+      raise pickle.PicklingError( "%s contains pointers" % t.__name__ )
+   if offsets is None:
+      # Nulling a pointer in a union would corrupt the members it overlaps.
+      raise pickle.PicklingError( "%s has pointers in a union, so can only be "
+                                  "pickled with _pickle_pointers_ = 'raw'" %
+                                  t.__name__ )
+   data = bytearray( data )
+   stride = ctypes.sizeof( t )
+   for base in range( 0, len( data ), stride ):
+      for offset, size in offsets:
+         data[ base + offset : base + offset + size ] = bytearray( size )
+   return bytes( data )
+
+def unpackArray( cls, data, single=False ):
+   ''' Return an array of objects of type cls, copied from data, as
+   returned by packArray. If single is set, data holds a single object, and
+   we return that. '''
+   if single:
+      return cls.from_buffer_copy( data )
+   return ( cls * ( len( data ) // ctypes.sizeof( cls ) ) ).from_buffer_copy( data )
+
 hasPointersMemo = {}
 
 def hasPointers( t ):
@@ -108,10 +946,37 @@ def checkOffsets( cls ):
             raise Exception( "field %s of %s has offset %d, should be %d" %
                   ( field[ 0 ], str( cls ), ctypesOffset, offset ) )
 
+def checkNumpy( cls ):
+   ''' If we have a numpy dtype for the class, make sure its size and offsets
+   agree with the dwarf definitions '''
+   dtype = cls.__dict__.get( "_numpy_dtype_" )
+   if dtype is None:
+      return
+   if dtype.itemsize != ctypes.sizeof( cls ):
+      raise Exception( "numpy dtype for %s has size %d, should be %d" %
+            ( cls.__name__, dtype.itemsize, ctypes.sizeof( cls ) ) )
+   if not hasattr( cls, "offsets" ):
+      return
+   for field, offset in zip( cls._fields_, cls.offsets ):
+      if offset is None or field[ 0 ] not in dtype.fields:
+         continue
+      dtypeOffset = dtype.fields[ field[ 0 ] ][ 1 ]
+      if dtypeOffset != offset:
+         raise Exception( "field %s of %s has numpy offset %d, should be %d" %
+               ( field[ 0 ], str( cls ), dtypeOffset, offset ) )
+
+def checkCodec( cls ):
+   codec = cls.__dict__.get( "_struct_codec_" )
+   if codec is not None and codec.size != ctypes.sizeof( cls ):
+      raise Exception( "struct codec for %s has size %d, should be %d" %
+            ( cls.__name__, codec.size, ctypes.sizeof( cls ) ) )
+
 def test_class( cls ):
    checkSize( cls )
    checkUnalignedPtrs( cls )
    checkOffsets( cls )
+   checkNumpy( cls )
+   checkCodec( cls )
 
 def test_classes():
    # pylint: disable=no-member
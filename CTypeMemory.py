@@ -0,0 +1,629 @@
+# Copyright 2018 Arista Networks.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#     Unless required by applicable law or agreed to in writing, software
+#     distributed under the License is distributed on an "AS IS" BASIS,
+#     WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#     See the License for the specific language governing permissions and
+#     limitations under the License.
+
+# Read objects of generated types from memory other than our own: a live
+# process, via /proc/<pid>/mem, or a core file. Objects are copied out of the
+# target, so pointers in them hold addresses in the target, not in this
+# process. Follow them with MemorySource.dereference, rather than through
+# ctypes.
+
+import binascii
+import bisect
+import collections
+import ctypes
+import numbers
+import os
+import struct
+
+from CTypeGenRun import globalVariables, isPointer, structFormat
+
+PT_LOAD = 1
+PT_NOTE = 4
+SHT_SYMTAB = 2
+SHT_DYNSYM = 11
+NT_GNU_BUILD_ID = 3
+NT_FILE = 0x46494c45
+
+Mapping = collections.namedtuple( "Mapping", [ "start", "end", "offset", "path" ] )
+Segment = collections.namedtuple( "Segment",
+                                  [ "type", "offset", "vaddr", "filesz", "memsz" ] )
+Node = collections.namedtuple( "Node",
+                               [ "address", "type", "depth", "parent", "data" ] )
+
+def pread( fd, size, offset ):
+   ''' os.pread, where available (python 3), or a seek and read otherwise '''
+   if hasattr( os, "pread" ):
+      return os.pread( fd, size, offset )
+   os.lseek( fd, offset, os.SEEK_SET )
+   return os.read( fd, size )
+
+class ElfImage( object ):
+   ''' Just enough of an ELF parser to find the loadable segments and notes of
+   a core file, and the symbols of a library, with no help from pstack. '''
+
+   def __init__( self, path ):
+      self.path = path
+      self.fd = os.open( path, os.O_RDONLY )
+      ident = pread( self.fd, 16, 0 )
+      if ident[ : 4 ] != b"\x7fELF":
+         os.close( self.fd )
+         raise ValueError( "not an ELF image: %s" % path )
+      self.wide = bytearray( ident )[ 4 ] == 2
+      self.order = "<" if bytearray( ident )[ 5 ] == 1 else ">"
+      self.word = "Q" if self.wide else "I"
+      if self.wide:
+         header = self.unpack( "HHIQQQIHHHHHH", 16 )
+      else:
+         header = self.unpack( "HHIIIIIHHHHHH", 16 )
+      ( self.type, _, _, _, self.phoff, self.shoff, _, _,
+        self.phentsize, self.phnum, self.shentsize, self.shnum, _ ) = header
+      self._symbols = None
+
+   def close( self ):
+      os.close( self.fd )
+
+   def unpack( self, fmt, offset ):
+      fmt = self.order + fmt
+      return struct.unpack( fmt, pread( self.fd, struct.calcsize( fmt ), offset ) )
+
+   def segments( self ):
+      ''' Return the program headers, in file order '''
+      segments = []
+      for i in range( self.phnum ):
+         offset = self.phoff + i * self.phentsize
+         if self.wide:
+            ptype, _, poffset, vaddr, _, filesz, memsz, _ = \
+                  self.unpack( "IIQQQQQQ", offset )
+         else:
+            ptype, poffset, vaddr, _, filesz, memsz, _, _ = \
+                  self.unpack( "IIIIIIII", offset )
+         segments.append( Segment( ptype, poffset, vaddr, filesz, memsz ) )
+      return segments
+
+   def loadBase( self ):
+      ''' The page-aligned address the image asks to be loaded at: the
+      difference between this and where it is mapped is the load bias '''
+      for segment in self.segments():
+         if segment.type == PT_LOAD:
+            return ( segment.vaddr - segment.offset ) & ~0xfff
+      return 0
+
+   def notes( self ):
+      ''' Yield the name, type and content of each note in the image '''
+      for segment in self.segments():
+         if segment.type != PT_NOTE:
+            continue
+         data = pread( self.fd, segment.filesz, segment.offset )
+         offset = 0
+         while offset + 12 <= len( data ):
+            namesz, descsz, ntype = struct.unpack_from( self.order + "III", data,
+                                                        offset )
+            offset += 12
+            name = data[ offset : offset + namesz ].rstrip( b"\0" )
+            offset += ( namesz + 3 ) & ~3
+            yield name, ntype, data[ offset : offset + descsz ]
+            offset += ( descsz + 3 ) & ~3
+
+   def fileMappings( self ):
+      ''' Return the files mapped into the process a core file was taken of,
+      from its NT_FILE note '''
+      size = struct.calcsize( self.word )
+      for name, ntype, desc in self.notes():
+         if name != b"CORE" or ntype != NT_FILE:
+            continue
+         count, pageSize = struct.unpack_from( self.order + self.word * 2, desc )
+         entries = struct.unpack_from( self.order + self.word * 3 * count, desc,
+                                       2 * size )
+         paths = desc[ ( 2 + 3 * count ) * size : ].split( b"\0" )
+         return [ Mapping( entries[ i * 3 ], entries[ i * 3 + 1 ],
+                           entries[ i * 3 + 2 ] * pageSize,
+                           paths[ i ].decode( "utf-8", "replace" ) )
+                  for i in range( count ) ]
+      return []
+
+   def buildId( self ):
+      ''' Return the image's GNU build-id, as a hex string, or None if it has
+      none '''
+      for name, ntype, desc in self.notes():
+         if name == b"GNU" and ntype == NT_GNU_BUILD_ID:
+            return binascii.hexlify( desc ).decode( "ascii" )
+      return None
+
+   def sections( self ):
+      sections = []
+      for i in range( self.shnum ):
+         offset = self.shoff + i * self.shentsize
+         if self.wide:
+            _, stype, _, _, soffset, size, link, _, _, entsize = \
+                  self.unpack( "IIQQQQIIQQ", offset )
+         else:
+            _, stype, _, _, soffset, size, link, _, _, entsize = \
+                  self.unpack( "IIIIIIIIII", offset )
+         sections.append( ( stype, soffset, size, link, entsize ) )
+      return sections
+
+   def symbols( self ):
+      ''' Return the values of the symbols in the image's symbol tables, by
+      name. The static symbol table takes precedence over the dynamic one. '''
+      if self._symbols is not None:
+         return self._symbols
+      self._symbols = {}
+      sections = self.sections()
+      for wanted in ( SHT_DYNSYM, SHT_SYMTAB ):
+         for stype, offset, size, link, entsize in sections:
+            if stype != wanted or not entsize:
+               continue
+            strings = pread( self.fd, sections[ link ][ 2 ], sections[ link ][ 1 ] )
+            table = pread( self.fd, size, offset )
+            for entry in range( 0, size - entsize + 1, entsize ):
+               if self.wide:
+                  name, _, _, shndx, value, _ = struct.unpack_from(
+                        self.order + "IBBHQQ", table, entry )
+               else:
+                  name, value, _, _, _, shndx = struct.unpack_from(
+                        self.order + "IIIBBH", table, entry )
+               if not name or not shndx:
+                  continue # unnamed, or undefined in this image.
+               end = strings.find( b"\0", name )
+               self._symbols[ strings[ name : end ].decode( "utf-8" ) ] = value
+      return self._symbols
+
+def buildId( path ):
+   ''' Return the GNU build-id of the ELF image at path, or None '''
+   image = ElfImage( path )
+   try:
+      return image.buildId()
+   finally:
+      image.close()
+
+class MemorySource( object ):
+   ''' Base for sources of target memory. Reads go through a cache of
+   pageSize byte pages, and the pages missing from each request are fetched
+   with one readRaw call per contiguous run. Subclasses provide readRaw and,
+   to find libraries in the target, mappings. '''
+
+   pageSize = 4096
+
+   def __init__( self, cachePages=4096 ):
+      self.cachePages = cachePages
+      self.cache = collections.OrderedDict()
+      self.syscalls = 0
+
+   def readRaw( self, address, size ):
+      ''' Return up to size bytes from address. This may return fewer, if the
+      memory after the first few bytes can't be read. '''
+      raise NotImplementedError()
+
+   def mappings( self ):
+      ''' Return the files mapped into the target, as a list of Mapping '''
+      raise NotImplementedError()
+
+   def invalidate( self ):
+      ''' Forget all cached pages: call when a live target may have run '''
+      self.cache.clear()
+
+   def store( self, page, data ):
+      self.cache[ page ] = data
+      while len( self.cache ) > self.cachePages:
+         self.cache.popitem( last=False )
+
+   def fetch( self, first, count ):
+      ''' Read count pages from page first into the cache. Pages we can't
+      read are cached as None. '''
+      size = self.pageSize
+      while count:
+         data = self.readRaw( first * size, count * size )
+         self.syscalls += 1
+         got = len( data ) // size
+         for i in range( got ):
+            self.store( first + i, data[ i * size : ( i + 1 ) * size ] )
+         if got == count:
+            break
+         self.store( first + got, None )
+         first += got + 1
+         count -= got + 1
+
+   def prefetch( self, ranges ):
+      ''' Bring the pages covering each ( address, size ) in ranges into the
+      cache, coalescing the missing ones into as few reads as possible '''
+      missing = set()
+      for address, size in ranges:
+         if size > 0:
+            missing.update( page for page in
+                            range( address // self.pageSize,
+                                   ( address + size - 1 ) // self.pageSize + 1 )
+                            if page not in self.cache )
+      first = count = None
+      for page in sorted( missing ):
+         if count and page == first + count:
+            count += 1
+            continue
+         if count:
+            self.fetch( first, count )
+         first, count = page, 1
+      if count:
+         self.fetch( first, count )
+
+   def page( self, page ):
+      data = self.cache.pop( page, False )
+      if data is False:
+         self.fetch( page, 1 )
+         data = self.cache.pop( page )
+      self.cache[ page ] = data # most recently used.
+      if data is None:
+         raise ValueError( "address 0x%x is not readable in %s" %
+                           ( page * self.pageSize, self ) )
+      return data
+
+   def read( self, address, size ):
+      ''' Return size bytes from address in the target '''
+      if size <= 0:
+         return b""
+      self.prefetch( [ ( address, size ) ] )
+      first = address // self.pageSize
+      last = ( address + size - 1 ) // self.pageSize
+      data = b"".join( self.page( page ) for page in range( first, last + 1 ) )
+      start = address - first * self.pageSize
+      return data[ start : start + size ]
+
+   def readObject( self, cls, address ):
+      ''' Return a copy of the object of type cls at address in the target '''
+      return cls.from_buffer_copy( self.read( address, ctypes.sizeof( cls ) ) )
+
+   def readArray( self, cls, address, count ):
+      ''' Return a copy of the array of count objects of type cls at address '''
+      return self.readObject( cls * count, address )
+
+   def readObjects( self, cls, addresses ):
+      ''' Return copies of the objects of type cls at each of addresses,
+      fetching all the memory they need at once '''
+      size = ctypes.sizeof( cls )
+      self.prefetch( [ ( address, size ) for address in addresses ] )
+      return [ self.readObject( cls, address ) for address in addresses ]
+
+   def readCString( self, address, limit=4096 ):
+      ''' Return the nul-terminated string at address, of at most limit bytes '''
+      chunks = []
+      while limit > 0:
+         size = min( limit, self.pageSize - address % self.pageSize )
+         chunk = self.read( address, size )
+         end = chunk.find( b"\0" )
+         if end != -1:
+            chunks.append( chunk[ : end ] )
+            break
+         chunks.append( chunk )
+         address += size
+         limit -= size
+      return b"".join( chunks )
+
+   def dereference( self, pointer ):
+      ''' Return a copy of the object the pointer, read from the target,
+      points to there. Returns None for null pointers. '''
+      address = ctypes.cast( pointer, ctypes.c_void_p ).value
+      if not address:
+         return None
+      return self.readObject( pointer._type_, address )
+
+   def libraryBias( self, library ):
+      ''' Return the load bias of library in the target: the difference
+      between its addresses there and those in its symbol table '''
+      realpath = os.path.realpath( library )
+      basename = os.path.basename( realpath )
+      candidates = [ m for m in self.mappings() if m.offset == 0 ]
+      for match in ( lambda path: path == realpath,
+                     lambda path: os.path.basename( path ) == basename ):
+         starts = [ m.start for m in candidates if match( m.path ) ]
+         if starts:
+            image = ElfImage( library )
+            try:
+               return min( starts ) - image.loadBase()
+            finally:
+               image.close()
+      raise ValueError( "%s is not mapped in %s" % ( library, self ) )
+
+   def traverse( self, cls, roots, follow, **kwargs ):
+      ''' Walk the objects reachable from roots: see traverse() '''
+      return traverse( self, cls, roots, follow, **kwargs )
+
+   def globals( self, globalsClass, library ):
+      ''' Return the globals of a generated Globals class, as found in the
+      copy of library loaded in the target '''
+      return TargetGlobals( self, globalsClass, library )
+
+class LocalMemory( MemorySource ):
+   ''' Memory in this process. Nothing is cached, and the caller must ensure
+   the addresses it reads are valid. '''
+
+   def read( self, address, size ):
+      return ctypes.string_at( address, size ) if size > 0 else b""
+
+   def prefetch( self, ranges ):
+      pass
+
+   def mappings( self ):
+      return processMappings( "self" )
+
+   def __repr__( self ):
+      return "local memory"
+
+class ProcessMemory( MemorySource ):
+   ''' Memory of a live process, read from /proc/<pid>/mem. This needs
+   permission to ptrace the process. Call invalidate() to see changes the
+   process has made since the memory was last read. '''
+
+   def __init__( self, pid, cachePages=4096 ):
+      super( ProcessMemory, self ).__init__( cachePages )
+      self.pid = pid
+      self.fd = os.open( "/proc/%d/mem" % pid, os.O_RDONLY )
+
+   def readRaw( self, address, size ):
+      try:
+         return pread( self.fd, size, address )
+      except ( OSError, OverflowError ):
+         return b""
+
+   def mappings( self ):
+      return processMappings( self.pid )
+
+   def close( self ):
+      os.close( self.fd )
+
+   def __enter__( self ):
+      return self
+
+   def __exit__( self, *args ):
+      self.close()
+
+   def __repr__( self ):
+      return "process %d" % self.pid
+
+class CoreMemory( MemorySource ):
+   ''' Memory of the process a core file was taken of. Memory the kernel
+   left out of the core, such as the text of shared libraries, can't be
+   read. '''
+
+   def __init__( self, path, cachePages=4096 ):
+      super( CoreMemory, self ).__init__( cachePages )
+      self.path = path
+      self.image = ElfImage( path )
+      self.segments = sorted( ( s for s in self.image.segments()
+                                if s.type == PT_LOAD and s.filesz ),
+                              key=lambda s: s.vaddr )
+      self.starts = [ s.vaddr for s in self.segments ]
+
+   def readRaw( self, address, size ):
+      chunks = []
+      while size > 0:
+         index = bisect.bisect_right( self.starts, address ) - 1
+         if index < 0:
+            break
+         segment = self.segments[ index ]
+         available = segment.vaddr + segment.filesz - address
+         if available <= 0:
+            break
+         count = min( size, available )
+         chunk = pread( self.image.fd, count,
+                        segment.offset + address - segment.vaddr )
+         chunks.append( chunk )
+         if len( chunk ) < count:
+            break
+         address += count
+         size -= count
+      return b"".join( chunks )
+
+   def mappings( self ):
+      return self.image.fileMappings()
+
+   def close( self ):
+      self.image.close()
+
+   def __enter__( self ):
+      return self
+
+   def __exit__( self, *args ):
+      self.close()
+
+   def __repr__( self ):
+      return "core file %s" % self.path
+
+def processMappings( pid ):
+   ''' Return the files mapped into a process, from /proc/<pid>/maps '''
+   mappings = []
+   with open( "/proc/%s/maps" % pid ) as maps:
+      for line in maps:
+         fields = line.split( None, 5 )
+         if len( fields ) < 6 or not fields[ 5 ].startswith( "/" ):
+            continue
+         start, end = fields[ 0 ].split( "-" )
+         mappings.append( Mapping( int( start, 16 ), int( end, 16 ),
+                                   int( fields[ 2 ], 16 ),
+                                   fields[ 5 ].rstrip( "\n" ) ) )
+   return mappings
+
+class TargetGlobals( object ):
+   ''' The variables of a generated Globals class, read from a memory source
+   rather than a loaded library. Each access reads the variable afresh
+   (through the source's cache). '''
+
+   def __init__( self, source, globalsClass, library ):
+      self._source = source
+      self._variables = globalVariables( globalsClass )
+      self._bias = source.libraryBias( library )
+      image = ElfImage( library )
+      try:
+         self._symbols = image.symbols()
+      finally:
+         image.close()
+
+   def address( self, name ):
+      ''' Return the address of the global name in the target '''
+      var = self._variables.get( name )
+      if var is None:
+         raise AttributeError( "no global variable %s" % name )
+      value = self._symbols.get( var.name )
+      if value is None:
+         raise ValueError( "symbol %s not found" % var.name )
+      return self._bias + value
+
+   def __getattr__( self, name ):
+      if name.startswith( "_" ):
+         raise AttributeError( name )
+      address = self.address( name )
+      return self._source.readObject( self._variables[ name ].ctype, address )
+
+def fieldLayout( t, path ):
+   ''' Return the offset and type of the field of t named by path, a list of
+   field names and array indexes separated by dots, eg, "buckets.3.next" '''
+   offset = 0
+   for name in path.split( "." ):
+      if issubclass( t, ctypes.Array ):
+         index = int( name )
+         if not 0 <= index < t._length_:
+            raise IndexError( "index %d out of range in %s" % ( index, path ) )
+         offset += index * ctypes.sizeof( t._type_ )
+         t = t._type_
+         continue
+      fieldinfo = [ f for f in getattr( t, "_fields_", () ) if f[ 0 ] == name ]
+      if not fieldinfo:
+         raise AttributeError( "%s has no field %s" % ( t.__name__, name ) )
+      if len( fieldinfo[ 0 ] ) > 2:
+         raise TypeError( "%s.%s is a bit-field" % ( t.__name__, name ) )
+      offset += getattr( t, name ).offset
+      t = fieldinfo[ 0 ][ 1 ]
+   return offset, t
+
+def followLayout( t, path ):
+   ''' Return the offset of the pointers to follow at path in t, a Struct to
+   unpack them, and the type they point to. Arrays of pointers are followed
+   element by element. '''
+   offset, ftype = fieldLayout( t, path )
+   count = 1
+   while issubclass( ftype, ctypes.Array ):
+      count *= ftype._length_
+      ftype = ftype._type_
+   if not isinstance( ftype, ctypes._Pointer.__class__ ):
+      raise TypeError( "can't follow %s.%s: it's not a pointer to a known type" %
+                       ( t.__name__, path ) )
+   return offset, struct.Struct( "%dP" % count ), ftype._type_
+
+def valueLayout( t, path ):
+   ''' Return the offset of the field at path in t, and a Struct to unpack
+   its value. Pointers are unpacked as addresses. '''
+   offset, ftype = fieldLayout( t, path )
+   if isPointer( ftype ):
+      return offset, struct.Struct( "P" )
+   fmt = structFormat( ftype )
+   if fmt is None:
+      raise TypeError( "can't unpack %s.%s" % ( t.__name__, path ) )
+   return offset, struct.Struct( "=" + fmt )
+
+def unpackValue( codec, data, offset ):
+   ''' Unpack a field with codec from valueLayout: scalars are unpacked as
+   themselves, and aggregates as tuples of the values in them '''
+   value = codec.unpack_from( data, offset )
+   return value[ 0 ] if len( value ) == 1 else value
+
+def pathsFor( spec, t ):
+   if isinstance( spec, dict ):
+      return spec.get( t, () )
+   return spec
+
+def traverse( source, cls, roots, follow, fields=None, maxDepth=None, limit=None,
+              skipUnreadable=False ):
+   ''' Walk the graph of objects reachable from roots, the addresses of
+   objects of type cls in source, breadth first, following the pointer fields
+   named in follow. Yield a Node for each object, giving its address, type,
+   depth, the address of the object we found it through, and its data: its
+   raw bytes, or, if fields are given, a tuple of their values.
+
+   follow and fields are lists of paths, as for fieldLayout, that apply to
+   objects of every type, or dicts with such a list for each type. Each
+   object is visited once, however many pointers to it there are. The
+   objects at each depth are read together, in chunks that fit in the
+   source's cache, so the source can coalesce its reads, and we never create
+   a ctypes object for them. maxDepth and limit
+   bound the depth of the walk, and the number of objects visited. Objects
+   we can't read raise ValueError, unless skipUnreadable is set. '''
+   if isinstance( roots, numbers.Integral ):
+      roots = [ roots ]
+   plans = {}
+
+   def plan( t ):
+      if t not in plans:
+         pointers = [ followLayout( t, path ) for path in pathsFor( follow, t ) ]
+         values = None
+         if fields is not None:
+            values = [ valueLayout( t, path ) for path in pathsFor( fields, t ) ]
+         plans[ t ] = ( ctypes.sizeof( t ), pointers, values )
+      return plans[ t ]
+
+   visited = set()
+   frontier = []
+   for address in roots:
+      if address and ( address, cls ) not in visited:
+         visited.add( ( address, cls ) )
+         frontier.append( ( address, cls, None ) )
+   def prefetched( frontier ):
+      # Prefetch the frontier in chunks whose pages fit in the source's cache,
+      # so none are evicted before we read them.
+      budget = getattr( source, "cachePages", None )
+      pageSize = getattr( source, "pageSize", 1 )
+      start = 0
+      while start < len( frontier ):
+         end = start
+         pages = 0
+         while end < len( frontier ):
+            address, t, _ = frontier[ end ]
+            size = plan( t )[ 0 ]
+            span = ( address + size - 1 ) // pageSize - address // pageSize + 1
+            if budget is not None and end > start and pages + span > budget:
+               break
+            pages += span
+            end += 1
+         chunk = frontier[ start : end ]
+         source.prefetch( [ ( address, plan( t )[ 0 ] ) for address, t, _ in chunk ] )
+         for entry in chunk:
+            yield entry
+         start = end
+
+   depth = 0
+   count = 0
+   while frontier:
+      following = []
+      for address, t, parent in prefetched( frontier ):
+         size, pointers, values = plan( t )
+         try:
+            data = source.read( address, size )
+         except ValueError:
+            if skipUnreadable:
+               continue
+            raise
+         if values is None:
+            record = data
+         else:
+            record = tuple( unpackValue( codec, data, offset )
+                            for offset, codec in values )
+         yield Node( address, t, depth, parent, record )
+         count += 1
+         if limit is not None and count >= limit:
+            return
+         if maxDepth is not None and depth >= maxDepth:
+            continue
+         for offset, codec, target in pointers:
+            for pointer in codec.unpack_from( data, offset ):
+               if pointer and ( pointer, target ) not in visited:
+                  visited.add( ( pointer, target ) )
+                  following.append( ( pointer, target, address ) )
+      frontier = following
+      depth += 1
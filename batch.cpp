@@ -0,0 +1,236 @@
+/*
+   Copyright 2018 Arista Networks.
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+       Unless required by applicable law or agreed to in writing, software
+       distributed under the License is distributed on an "AS IS" BASIS,
+       WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+       See the License for the specific language governing permissions and
+       limitations under the License.
+*/
+
+/*
+ * Call a C function once for each element of a set of argument arrays, in a
+ * native loop, using libffi. CTypeGenRun.batchCall works out the types,
+ * addresses and strides of the arrays from the function's ctypes prototype,
+ * and calls us with them.
+ */
+
+#include <Python.h>
+#include <ffi.h>
+
+#include <stdint.h>
+#include <string.h>
+#include <vector>
+
+namespace {
+
+/*
+ * Map a ctypes type code to the corresponding libffi type.
+ */
+ffi_type *
+ffiType( char code ) {
+   switch ( code ) {
+    case 'b':
+    case 'c':
+      return &ffi_type_sint8;
+    case 'B':
+    case '?':
+      return &ffi_type_uint8;
+    case 'h':
+      return &ffi_type_sint16;
+    case 'H':
+      return &ffi_type_uint16;
+    case 'i':
+      return &ffi_type_sint32;
+    case 'I':
+      return &ffi_type_uint32;
+    case 'l':
+      return &ffi_type_slong;
+    case 'L':
+      return &ffi_type_ulong;
+    case 'q':
+      return &ffi_type_sint64;
+    case 'Q':
+      return &ffi_type_uint64;
+    case 'f':
+      return &ffi_type_float;
+    case 'd':
+      return &ffi_type_double;
+    case 'g':
+      return &ffi_type_longdouble;
+    case 'P':
+      return &ffi_type_pointer;
+    default:
+      return nullptr;
+   }
+}
+
+/*
+ * libffi widens integral return values narrower than a register to ffi_arg:
+ * narrow them again as we store them in the output array.
+ */
+void
+storeResult( char code, const void * rvalue, char * out ) {
+   switch ( code ) {
+    case 'b':
+    case 'c':
+      *( int8_t * )out = ( int8_t ) * ( const ffi_sarg * )rvalue;
+      break;
+    case 'B':
+    case '?':
+      *( uint8_t * )out = ( uint8_t ) * ( const ffi_arg * )rvalue;
+      break;
+    case 'h':
+      *( int16_t * )out = ( int16_t ) * ( const ffi_sarg * )rvalue;
+      break;
+    case 'H':
+      *( uint16_t * )out = ( uint16_t ) * ( const ffi_arg * )rvalue;
+      break;
+    case 'i':
+      *( int32_t * )out = ( int32_t ) * ( const ffi_sarg * )rvalue;
+      break;
+    case 'I':
+      *( uint32_t * )out = ( uint32_t ) * ( const ffi_arg * )rvalue;
+      break;
+    default:
+      memcpy( out, rvalue, ffiType( code )->size );
+      break;
+   }
+}
+
+} // namespace
+
+extern "C" {
+
+/*
+ * call( function, restype, argtypes, arguments, result, resultStride, count )
+ *
+ * function is the address of the function, and restype and argtypes the
+ * ctypes codes of its return and argument types ("" for a void return).
+ * arguments has an ( address, stride, byAddress ) tuple for each argument:
+ * for the i'th call, the argument is at address + i * stride, or, if
+ * byAddress is set, is that address itself. Results are stored at
+ * result + i * resultStride.
+ */
+static PyObject *
+batch_call( PyObject * self, PyObject * args ) {
+   unsigned long long function, result;
+   const char * restype;
+   const char * argtypes;
+   PyObject * arguments;
+   Py_ssize_t resultStride, count;
+   if ( !PyArg_ParseTuple( args, "KssOKnn", &function, &restype, &argtypes,
+                           &arguments, &result, &resultStride, &count ) )
+      return nullptr;
+
+   size_t nargs = strlen( argtypes );
+   if ( !PySequence_Check( arguments ) ||
+        PySequence_Size( arguments ) != ( Py_ssize_t )nargs ) {
+      PyErr_SetString( PyExc_ValueError,
+                       "need an argument array for each argument type" );
+      return nullptr;
+   }
+   std::vector< ffi_type * > types( nargs );
+   std::vector< char * > bases( nargs );
+   std::vector< Py_ssize_t > strides( nargs );
+   std::vector< char * > addresses( nargs );
+   std::vector< void * > argp( nargs );
+   std::vector< bool > byAddress( nargs );
+   for ( size_t i = 0; i < nargs; ++i ) {
+      unsigned long long base;
+      int indirect;
+      PyObject * argument = PySequence_GetItem( arguments, i );
+      if ( argument == nullptr )
+         return nullptr;
+      int ok = PyArg_ParseTuple( argument, "Kni", &base, &strides[ i ], &indirect );
+      Py_DECREF( argument );
+      if ( !ok )
+         return nullptr;
+      types[ i ] = ffiType( argtypes[ i ] );
+      if ( types[ i ] == nullptr ) {
+         PyErr_Format( PyExc_TypeError, "unsupported argument type '%c'",
+                       argtypes[ i ] );
+         return nullptr;
+      }
+      bases[ i ] = ( char * )( uintptr_t )base;
+      byAddress[ i ] = indirect != 0;
+      argp[ i ] = byAddress[ i ] ? ( void * )&addresses[ i ] : nullptr;
+   }
+   ffi_type * rtype = *restype ? ffiType( *restype ) : &ffi_type_void;
+   if ( rtype == nullptr ) {
+      PyErr_Format( PyExc_TypeError, "unsupported return type '%c'", *restype );
+      return nullptr;
+   }
+
+   ffi_cif cif;
+   if ( ffi_prep_cif( &cif, FFI_DEFAULT_ABI, nargs, rtype, types.data() ) !=
+        FFI_OK ) {
+      PyErr_SetString( PyExc_RuntimeError, "can't prepare call interface" );
+      return nullptr;
+   }
+
+   void ( *fn )() = ( void ( * )() )( uintptr_t )function;
+   char * out = ( char * )( uintptr_t )result;
+   // big enough, and aligned enough, for any return type, and an ffi_arg.
+   union {
+      ffi_arg integral;
+      long double floating;
+      void * pointer;
+   } rvalue;
+
+   Py_BEGIN_ALLOW_THREADS
+   for ( Py_ssize_t call = 0; call < count; ++call ) {
+      for ( size_t i = 0; i < nargs; ++i ) {
+         char * arg = bases[ i ] + call * strides[ i ];
+         if ( byAddress[ i ] )
+            addresses[ i ] = arg;
+         else
+            argp[ i ] = arg;
+      }
+      ffi_call( &cif, fn, &rvalue, argp.data() );
+      if ( *restype )
+         storeResult( *restype, &rvalue, out + call * resultStride );
+   }
+   Py_END_ALLOW_THREADS
+
+   Py_INCREF( Py_None );
+   return Py_None;
+}
+
+static PyMethodDef batch_methods[] = {
+   { "call", batch_call, METH_VARARGS,
+     "call a function once for each element of its argument arrays" },
+   { 0, 0, 0, 0 }
+};
+
+PyMODINIT_FUNC
+#if PY_MAJOR_VERSION >= 3
+PyInit_libCTypeBatch( void )
+#else
+initlibCTypeBatch( void )
+#endif
+{
+#if PY_MAJOR_VERSION >= 3
+   static struct PyModuleDef ctypeBatchModule = {
+      PyModuleDef_HEAD_INIT,
+      "libCTypeBatch", /* m_name */
+      "CTypeGen batch call support", /* m_doc */
+      -1, /* m_size */
+      batch_methods, /* m_methods */
+      NULL, /* m_reload */
+      NULL, /* m_traverse */
+      NULL, /* m_clear */
+      NULL, /* m_free */
+   };
+   return PyModule_Create( &ctypeBatchModule );
+#else
+   Py_InitModule3( "libCTypeBatch", batch_methods, "CTypeGen batch call support" );
+#endif
+}
+}
@@ -0,0 +1,261 @@
+#!/usr/bin/env python
+# Copyright 2018 Arista Networks.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#     Unless required by applicable law or agreed to in writing, software
+#     distributed under the License is distributed on an "AS IS" BASIS,
+#     WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#     See the License for the specific language governing permissions and
+#     limitations under the License.
+
+# Benchmark CTypeGen.generate on synthetic shared libraries.
+#
+# We write C or C++ sources with a configurable number of compilation units,
+# structures per unit, fields per structure, namespaces, templates and forward
+# declarations, build them into a shared library, and time generating a module
+# for all the structures and functions in it. Each run is made in a fresh
+# python process, so caches and the process's peak RSS start afresh, and we
+# keep the fastest of several. Results are appended, one JSON object per line,
+# to a results file, tagged with the commit they were measured at, so they can
+# be compared across commits with --compare.
+
+from __future__ import print_function
+import argparse
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import timeit
+
+benchdir = os.path.dirname( os.path.abspath( __file__ ) )
+
+def namespaceOpen( args ):
+   return "".join( "namespace ns%d { " % i for i in range( args.namespaces ) )
+
+def namespaceClose( args ):
+   return "}" * args.namespaces
+
+def qualified( args, name ):
+   return "::".join( [ "ns%d" % i for i in range( args.namespaces ) ] + [ name ] )
+
+def structName( unit, index ):
+   return "S_%d_%d" % ( unit, index )
+
+fieldTypes = [ "int", "long", "double", "char", "unsigned short", "float" ]
+
+def writeUnit( args, unit, out ):
+   ''' Write the source for one compilation unit. Each structure has
+   args.fields scalar fields, an array, a pointer to the previous structure
+   in the unit, and, for the first args.forward structures, a pointer to a
+   structure only declared here, and defined in the next unit. '''
+   cplusplus = args.language == "c++"
+   nextUnit = ( unit + 1 ) % args.units
+   out.write( "#include <stddef.h>\n" )
+   if cplusplus:
+      out.write( namespaceOpen( args ) + "\n" )
+   for i in range( args.forward ):
+      out.write( "struct %s;\n" % structName( nextUnit, i ) )
+   if cplusplus:
+      for i in range( args.templates ):
+         out.write( "template <typename T> struct Box_%d_%d { T value; T values[ 4 ]; "
+                    "int count; };\n" % ( unit, i ) )
+   for index in range( args.structs ):
+      name = structName( unit, index )
+      out.write( "struct %s {\n" % name )
+      for field in range( args.fields ):
+         out.write( "   %s f%d;\n" % ( fieldTypes[ field % len( fieldTypes ) ],
+                                      field ) )
+      out.write( "   int anArray[ %d ];\n" % ( index % 7 + 1 ) )
+      if index:
+         out.write( "   struct %s * prev;\n" % structName( unit, index - 1 ) )
+      if index < args.forward:
+         out.write( "   struct %s * elsewhere;\n" % structName( nextUnit, index ) )
+      if cplusplus and args.templates:
+         out.write( "   Box_%d_%d< %s > box;\n" %
+                    ( unit, index % args.templates,
+                      fieldTypes[ index % len( fieldTypes ) ] ) )
+      out.write( "};\n" )
+   if cplusplus:
+      out.write( namespaceClose( args ) + "\n" )
+      out.write( 'extern "C" ' )
+   out.write( "size_t unit_%d( %s * s ) { return sizeof *s; }\n" %
+              ( unit, qualified( args, structName( unit, 0 ) ) if cplusplus
+                else "struct " + structName( unit, 0 ) ) )
+
+def buildLibrary( args ):
+   ''' Write the sources for the library described by args, and build it,
+   unless we already have. Returns its path. '''
+   tag = "%s-u%d-s%d-f%d-n%d-t%d-d%d" % (
+         "cpp" if args.language == "c++" else "c", args.units, args.structs,
+         args.fields, args.namespaces, args.templates, args.forward )
+   builddir = os.path.join( args.builddir, tag )
+   library = os.path.join( builddir, "libbench.so" )
+   if os.path.exists( library ):
+      return library
+   if not os.path.isdir( builddir ):
+      os.makedirs( builddir )
+   compiler = os.environ.get( "CXX", "c++" ) if args.language == "c++" \
+         else os.environ.get( "CC", "cc" )
+   suffix = ".cpp" if args.language == "c++" else ".c"
+   sources = []
+   for unit in range( args.units ):
+      source = os.path.join( builddir, "unit%d%s" % ( unit, suffix ) )
+      with open( source, "w" ) as out:
+         writeUnit( args, unit, out )
+      sources.append( source )
+   # Keep the debug information for types nothing in the library uses.
+   subprocess.check_call( [ compiler, "-g", "-fno-eliminate-unused-debug-types",
+                            "-fPIC", "-shared", "-o", library ] +
+                          sources )
+   return library
+
+def generateOnce( args, library ):
+   ''' Generate the module for library, and return the measurements '''
+   from CTypeGen import generateOrThrow, PythonType
+   types = [ PythonType( structName( unit, index ),
+                         qualified( args, structName( unit, index ) )
+                         if args.language == "c++" else structName( unit, index ) )
+             for unit in range( args.units ) for index in range( args.structs ) ]
+   functions = [ "unit_%d" % unit for unit in range( args.units ) ]
+   outname = os.path.join( os.path.dirname( library ), "bench_%d.py" % os.getpid() )
+   errors = []
+   start = timeit.default_timer()
+   _, resolver = generateOrThrow( [ library ], outname, types, functions,
+                                  errorfunc=errors.append )
+   elapsed = timeit.default_timer() - start
+   for name in ( outname, outname + "c" ):
+      if os.path.exists( name ):
+         os.unlink( name )
+   stats = resolver.stats.asDict()
+   return {
+      "seconds": elapsed,
+      "phases": dict( ( name, phase[ "seconds" ] )
+                      for name, phase in stats[ "phases" ].items() ),
+      "diesVisited": stats[ "diesVisited" ],
+      "diesPerSecond": stats[ "diesVisited" ] / elapsed,
+      "typesEmitted": stats[ "typesEmitted" ],
+      "peakRss": resource.getrusage( resource.RUSAGE_SELF ).ru_maxrss * 1024,
+      "errors": len( errors ),
+   }
+
+def gitCommit():
+   try:
+      with open( os.devnull, "w" ) as devnull:
+         return subprocess.check_output( [ "git", "describe", "--always",
+                                           "--dirty" ],
+                                         cwd=benchdir,
+                                         stderr=devnull ).decode().strip()
+   except ( OSError, subprocess.CalledProcessError ):
+      return None
+
+def parameters( args ):
+   return dict( ( name, getattr( args, name ) )
+                for name in ( "language", "units", "structs", "fields",
+                              "namespaces", "templates", "forward" ) )
+
+def runBenchmark( args ):
+   library = buildLibrary( args )
+   command = [ sys.executable, os.path.abspath( __file__ ), "--child" ] + \
+         [ "--%s=%s" % ( name, value ) for name, value in
+           sorted( parameters( args ).items() ) ] + [ "--builddir", args.builddir ]
+   runs = []
+   for _ in range( args.repeat ):
+      output = subprocess.check_output( command ).decode()
+      runs.append( json.loads( output.strip().splitlines()[ -1 ] ) )
+   best = min( runs, key=lambda run: run[ "seconds" ] )
+   result = {
+      "benchmark": "generation",
+      "commit": gitCommit(),
+      "python": platform.python_version(),
+      "parameters": parameters( args ),
+      "repeat": args.repeat,
+      "best": best,
+      "peakRss": max( run[ "peakRss" ] for run in runs ),
+   }
+   return result
+
+def findBaseline( path, result ):
+   ''' Find the most recent result in path for the same benchmark, parameters
+   and python version as result, from another commit '''
+   baseline = None
+   with open( path ) as results:
+      for line in results:
+         previous = json.loads( line )
+         if previous.get( "benchmark" ) == result[ "benchmark" ] and \
+               previous[ "parameters" ] == result[ "parameters" ] and \
+               previous[ "python" ] == result[ "python" ] and \
+               previous[ "commit" ] != result[ "commit" ]:
+            baseline = previous
+   return baseline
+
+def report( result, baseline ):
+   best = result[ "best" ]
+   print( "generation %s at %s: %.3fs, %d DIEs, %.0f DIEs/s, peak RSS %.1fMB" %
+          ( " ".join( "%s=%s" % item
+                      for item in sorted( result[ "parameters" ].items() ) ),
+            result[ "commit" ], best[ "seconds" ], best[ "diesVisited" ],
+            best[ "diesPerSecond" ], result[ "peakRss" ] / 1048576.0 ) )
+   for name, seconds in sorted( best[ "phases" ].items() ):
+      line = "   %-12s %8.3fs" % ( name, seconds )
+      old = baseline[ "best" ][ "phases" ].get( name ) if baseline else None
+      if old:
+         line += "  (%+.1f%% vs %s)" % ( ( seconds / old - 1 ) * 100,
+                                          baseline[ "commit" ] )
+      print( line )
+   if baseline:
+      print( "   %-12s %8.3fs  (%+.1f%% vs %s)" %
+             ( "total", best[ "seconds" ],
+               ( best[ "seconds" ] / baseline[ "best" ][ "seconds" ] - 1 ) * 100,
+               baseline[ "commit" ] ) )
+
+def main():
+   parser = argparse.ArgumentParser( description="benchmark CTypeGen.generate" )
+   parser.add_argument( "--language", choices=[ "c", "c++" ], default="c++" )
+   parser.add_argument( "--units", type=int, default=20,
+                        help="number of compilation units" )
+   parser.add_argument( "--structs", type=int, default=50,
+                        help="structures per unit" )
+   parser.add_argument( "--fields", type=int, default=10,
+                        help="scalar fields per structure" )
+   parser.add_argument( "--namespaces", type=int, default=2,
+                        help="depth of namespaces around each unit's types (C++)" )
+   parser.add_argument( "--templates", type=int, default=5,
+                        help="class templates per unit (C++)" )
+   parser.add_argument( "--forward", type=int, default=10,
+                        help="structures per unit only declared in the unit "
+                        "before" )
+   parser.add_argument( "--repeat", type=int, default=3,
+                        help="runs to take the fastest of" )
+   parser.add_argument( "--builddir", default=os.path.join( benchdir, "build" ) )
+   parser.add_argument( "--output", default=os.path.join( benchdir, "results.jsonl" ),
+                        help="file to append results to" )
+   parser.add_argument( "--compare", action="store_true",
+                        help="compare with the last result in the output file "
+                        "from another commit" )
+   parser.add_argument( "--child", action="store_true", help=argparse.SUPPRESS )
+   args = parser.parse_args()
+   if args.language == "c":
+      args.namespaces = args.templates = 0
+   args.forward = min( args.forward, args.structs )
+
+   if args.child:
+      print( json.dumps( generateOnce( args, buildLibrary( args ) ) ) )
+      return
+
+   result = runBenchmark( args )
+   baseline = None
+   if args.compare and os.path.exists( args.output ):
+      baseline = findBaseline( args.output, result )
+   report( result, baseline )
+   with open( args.output, "a" ) as out:
+      out.write( json.dumps( result, sort_keys=True ) + "\n" )
+
+if __name__ == "__main__":
+   main()
@@ -0,0 +1,276 @@
+#!/usr/bin/env python
+# Copyright 2018 Arista Networks.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#     Unless required by applicable law or agreed to in writing, software
+#     distributed under the License is distributed on an "AS IS" BASIS,
+#     WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#     See the License for the specific language governing permissions and
+#     limitations under the License.
+
+# Benchmark the code CTypeGen generates, rather than the generator.
+#
+# We build the sample libraries from test/ and docs/src, and a large synthetic
+# one (see GenerationBench.py), generate modules for them, and measure:
+#  - the time to import the large module, eagerly and lazily, in a fresh
+#    python process, and to run its test_classes,
+#  - reads and writes of fields of generated structures,
+#  - the time decorateFunctions takes to set up a library,
+#  - calls through generated prototypes, with and without callbacks.
+# Results are appended, as JSON, to the same results file as the generation
+# benchmark, and --compare reports the change from the last result from
+# another commit.
+
+from __future__ import print_function
+import argparse
+import ctypes
+import glob
+import json
+import os
+import platform
+import subprocess
+import sys
+import timeit
+
+from GenerationBench import benchdir, buildLibrary, findBaseline, gitCommit
+from GenerationBench import qualified, structName
+
+sourcedir = os.path.dirname( benchdir )
+
+def buildSample( builddir, name, sources ):
+   ''' Build the named shared library from sources, relative to the top of the
+   source tree, unless we already have '''
+   library = os.path.join( builddir, "lib%s.so" % name )
+   if os.path.exists( library ):
+      return library
+   objects = []
+   for source in sources:
+      cplusplus = source.endswith( ".cpp" )
+      compiler = os.environ.get( "CXX", "c++" ) if cplusplus \
+            else os.environ.get( "CC", "cc" )
+      obj = os.path.join( builddir, os.path.basename( source ) + ".o" )
+      subprocess.check_call( [ compiler, "-g", "-fPIC", "-c", "-o", obj,
+                               os.path.join( sourcedir, source ) ] )
+      objects.append( obj )
+   subprocess.check_call( [ os.environ.get( "CXX", "c++" ), "-shared", "-o",
+                            library ] + objects )
+   return library
+
+def largeLibrary( args ):
+   ''' Build the synthetic library, with the generation benchmark's defaults
+   for anything we don't set '''
+   return buildLibrary( argparse.Namespace( language="c++", units=args.units,
+                                            structs=args.structs, fields=10,
+                                            namespaces=2, templates=5,
+                                            forward=10,
+                                            builddir=args.builddir ) )
+
+def largeTypes( args ):
+   from CTypeGen import PythonType
+   return [ PythonType( structName( unit, index ),
+                        qualified( argparse.Namespace( namespaces=2 ),
+                                   structName( unit, index ) ) )
+            for unit in range( args.units ) for index in range( args.structs ) ]
+
+def prepare( args ):
+   ''' Build the libraries, and generate their modules, in our build
+   directory. Returns the paths of the libraries. '''
+   from CTypeGen import generateOrThrow, PythonType
+   builddir = os.path.join( args.builddir, "runtime" )
+   if not os.path.isdir( builddir ):
+      os.makedirs( builddir )
+   libraries = {
+      "sanity": buildSample( builddir, "CTypeSanity",
+                             [ "test/CTypeSanityC.c", "test/CTypeSanity.cpp" ] ),
+      "basic": buildSample( builddir, "basic", [ "docs/src/basic.c" ] ),
+      "callback": buildSample( builddir, "callback",
+                               [ "docs/src/callback.c" ] ),
+      "large": largeLibrary( args ),
+   }
+   def generate( name, library, types, functions, **kwargs ):
+      generateOrThrow( [ library ], os.path.join( builddir, name + ".py" ), types,
+                       functions, errorfunc=lambda _: None, **kwargs )
+   generate( "RtSanity", libraries[ "sanity" ],
+             [ PythonType( "Foo" ), PythonType( "Bar" ) ],
+             [ "make_foo", "print_foo", "void_return_func", "test_qualifiers",
+               "bythree" ] )
+   generate( "RtBasic", libraries[ "basic" ], [ PythonType( "SomeStructure" ) ],
+             [ "someFunction" ] )
+   generate( "RtCallback", libraries[ "callback" ], [ PythonType( "Callback" ) ],
+             [ "callme" ] )
+   functions = [ "unit_%d" % unit for unit in range( args.units ) ]
+   generate( "RtLarge", libraries[ "large" ], largeTypes( args ), functions )
+   if sys.version_info >= ( 3, 7 ):
+      generate( "RtLargeLazy", libraries[ "large" ], largeTypes( args ),
+                functions, lazy=True )
+   return builddir, libraries
+
+def best( func, number, repeat ):
+   ''' Return the fastest time for one call of func, of repeat runs of
+   number calls '''
+   return min( timeit.Timer( func ).repeat( repeat, number ) ) / number
+
+def importChild( module ):
+   ''' Import module, and time it, and its test_classes. We run in a fresh
+   process for this. '''
+   start = timeit.default_timer()
+   mod = __import__( module )
+   imported = timeit.default_timer()
+   if hasattr( mod, "materializeTypes" ):
+      mod.materializeTypes()
+   materialized = timeit.default_timer()
+   mod.test_classes()
+   tested = timeit.default_timer()
+   return { "import": imported - start, "materialize": materialized - imported,
+            "testClasses": tested - materialized }
+
+def measureImport( args, builddir, module ):
+   env = dict( os.environ )
+   env[ "PYTHONPATH" ] = os.pathsep.join(
+         [ builddir ] + [ p for p in [ env.get( "PYTHONPATH" ) ] if p ] )
+   env[ "PYTHONDONTWRITEBYTECODE" ] = "1"
+   runs = []
+   for _ in range( args.repeat ):
+      # Generating the module compiled it, and the environment only stops the
+      # child writing bytecode, not reading it, so remove any to import the
+      # source each time.
+      for pattern in ( module + ".pyc", os.path.join( "__pycache__",
+                                                      module + ".*.pyc" ) ):
+         for name in glob.glob( os.path.join( builddir, pattern ) ):
+            os.unlink( name )
+      output = subprocess.check_output(
+            [ sys.executable, os.path.abspath( __file__ ), "--child", module ],
+            env=env ).decode()
+      runs.append( json.loads( output.strip().splitlines()[ -1 ] ) )
+   return dict( ( key, min( run[ key ] for run in runs ) ) for key in runs[ 0 ] )
+
+def measure( args, builddir, libraries ):
+   ''' Run all the benchmarks, and return a dict of the results. Times are in
+   seconds, and rates per second. '''
+   results = {}
+   sys.path.insert( 0, builddir )
+   # pylint: disable=import-error
+   import RtSanity
+   import RtBasic
+   import RtCallback
+   number, repeat = args.number, args.repeat
+
+   large = measureImport( args, builddir, "RtLarge" )
+   results[ "import.eager.seconds" ] = large[ "import" ]
+   results[ "testClasses.seconds" ] = large[ "testClasses" ]
+   if sys.version_info >= ( 3, 7 ):
+      lazy = measureImport( args, builddir, "RtLargeLazy" )
+      results[ "import.lazy.seconds" ] = lazy[ "import" ]
+      results[ "import.lazyMaterialize.seconds" ] = lazy[ "materialize" ]
+
+   foo = RtSanity.Foo()
+   some = RtBasic.SomeStructure()
+   def write():
+      foo.anInt = 1
+   results[ "field.read.perSecond" ] = 1 / best( lambda: foo.anInt, number, repeat )
+   results[ "field.write.perSecond" ] = 1 / best( write, number, repeat )
+   results[ "field.nestedRead.perSecond" ] = \
+         1 / best( lambda: foo.aNestedStructure.y, number, repeat )
+   results[ "field.pointerRead.perSecond" ] = \
+         1 / best( lambda: some.s, number, repeat )
+   results[ "struct.create.perSecond" ] = \
+         1 / best( RtSanity.Foo, number // 10, repeat )
+
+   def decorate():
+      dll = ctypes.CDLL( libraries[ "sanity" ] )
+      start = timeit.default_timer()
+      RtSanity.decorateFunctions( dll )
+      return timeit.default_timer() - start
+   results[ "decorateFunctions.seconds" ] = min( decorate() for _ in range( repeat ) )
+
+   dll = ctypes.CDLL( libraries[ "sanity" ] )
+   RtSanity.decorateFunctions( dll )
+   bythree = dll.bythree
+   results[ "call.prototype.perSecond" ] = \
+         1 / best( lambda: bythree( 7 ), number, repeat )
+   raw = ctypes.CDLL( libraries[ "sanity" ] ).bythree
+   results[ "call.undecorated.perSecond" ] = \
+         1 / best( lambda: raw( 7 ), number, repeat )
+   lazyLib = RtSanity.LazyLibrary( libraries[ "sanity" ] )
+   results[ "call.lazyLibrary.perSecond" ] = \
+         1 / best( lambda: lazyLib.bythree( 7 ), number, repeat )
+   profiled = ctypes.CDLL( libraries[ "sanity" ] )
+   RtSanity.decorateFunctions( profiled, profile=True )
+   results[ "call.profiled.perSecond" ] = \
+         1 / best( lambda: profiled.bythree( 7 ), number, repeat )
+
+   callbackLib = ctypes.CDLL( libraries[ "callback" ] )
+   RtCallback.decorateFunctions( callbackLib )
+   callback = RtCallback.Callback( lambda a, b: a + b )
+   callme = callbackLib.callme
+   results[ "call.withCallback.perSecond" ] = \
+         1 / best( lambda: callme( 1, 2, callback ), number, repeat )
+
+   try:
+      from CTypeGenRun import batchCall
+      inputs = ( ctypes.c_int * number )( *range( number ) )
+      results[ "call.batch.perSecond" ] = \
+            number / best( lambda: batchCall( bythree, [ inputs ] ), 1, repeat )
+   except ImportError:
+      pass # libCTypeBatch isn't built.
+   return results
+
+def report( result, baseline ):
+   print( "runtime at %s (units=%d, structs=%d):" %
+          ( result[ "commit" ], result[ "parameters" ][ "units" ],
+            result[ "parameters" ][ "structs" ] ) )
+   for name, value in sorted( result[ "results" ].items() ):
+      line = "   %-36s %14.6g" % ( name, value )
+      old = baseline[ "results" ].get( name ) if baseline else None
+      if old:
+         line += "  (%+.1f%% vs %s)" % ( ( value / old - 1 ) * 100,
+                                          baseline[ "commit" ] )
+      print( line )
+
+def main():
+   parser = argparse.ArgumentParser(
+         description="benchmark the code CTypeGen generates" )
+   parser.add_argument( "--units", type=int, default=50,
+                        help="compilation units in the large library" )
+   parser.add_argument( "--structs", type=int, default=50,
+                        help="structures per unit in the large library" )
+   parser.add_argument( "--number", type=int, default=100000,
+                        help="operations per timing run" )
+   parser.add_argument( "--repeat", type=int, default=5,
+                        help="runs to take the fastest of" )
+   parser.add_argument( "--builddir", default=os.path.join( benchdir, "build" ) )
+   parser.add_argument( "--output", default=os.path.join( benchdir, "results.jsonl" ),
+                        help="file to append results to" )
+   parser.add_argument( "--compare", action="store_true",
+                        help="compare with the last result in the output file "
+                        "from another commit" )
+   parser.add_argument( "--child", help=argparse.SUPPRESS )
+   args = parser.parse_args()
+
+   if args.child:
+      print( json.dumps( importChild( args.child ) ) )
+      return
+
+   builddir, libraries = prepare( args )
+   result = {
+      "benchmark": "runtime",
+      "commit": gitCommit(),
+      "python": platform.python_version(),
+      "parameters": { "units": args.units, "structs": args.structs,
+                      "number": args.number },
+      "results": measure( args, builddir, libraries ),
+   }
+   baseline = None
+   if args.compare and os.path.exists( args.output ):
+      baseline = findBaseline( args.output, result )
+   report( result, baseline )
+   with open( args.output, "a" ) as out:
+      out.write( json.dumps( result, sort_keys=True ) + "\n" )
+
+if __name__ == "__main__":
+   main()
@@ -13,17 +13,37 @@
 #     See the License for the specific language governing permissions and
 #     limitations under the License.
 
+from __future__ import print_function
+from distutils.command.build_ext import build_ext
 from distutils.core import setup
+from distutils.errors import CCompilerError, DistutilsError
 from distutils.extension import Extension
 
+# Only batchCall needs libCTypeBatch, so we do without it if libffi isn't
+# installed.
+optionalExtensions = [ 'libCTypeBatch' ]
+
+class BuildExt( build_ext ):
+   def build_extension( self, ext ):
+      try:
+         build_ext.build_extension( self, ext )
+      except ( CCompilerError, DistutilsError ) as e:
+         if ext.name not in optionalExtensions:
+            raise
+         print( "not building %s: %s" % ( ext.name, e ) )
+
 setup( name="CTypeGen",
         version="0.9",
         py_modules=[
             "CTypeGen",
             "CMock",
             "CTypeGenRun",
+            "CTypeMemory",
+            "CTypeAbiDiff",
         ],
         ext_modules=[
             Extension( 'libCTypeGen', [ 'CTypeGen.cpp', ], libraries=[ 'dwelf' ] ),
             Extension( 'libCTypeMock', [ 'cmock.cpp' ], libraries=[ 'dwelf' ] ),
-        ] )
+            Extension( 'libCTypeBatch', [ 'batch.cpp' ], libraries=[ 'ffi' ] ),
+        ],
+        cmdclass={ 'build_ext': BuildExt } )
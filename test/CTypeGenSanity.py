@@ -13,29 +13,57 @@
 #     See the License for the specific language governing permissions and
 #     limitations under the License.
 from __future__ import print_function
+import binascii
 from ctypes import c_char, CDLL, c_void_p, c_long, c_int, cast, sizeof
-from ctypes import POINTER, c_char_p, c_ulong
+from ctypes import POINTER, c_char_p, c_ulong, addressof, string_at, pointer
+from ctypes import c_size_t, c_uint, create_string_buffer, Structure, Union
+import imp
+import io
+import json
+import os
+import pickle
+import struct
 import sys
 
-from CTypeGen import generate, PythonType, generateOrThrow
+from CTypeAbiDiff import abiDiff, diffLayouts
+from CTypeGen import generate, PythonType, generateOrThrow, Selector, binaryLayouts
+from CTypeGen import asPythonId, intern, splitScopedName, tags
+from CTypeGenRun import enumName, decodeFlags, numpyArray, packArray, unpackArray
+from CTypeGenRun import batchCall, bindingStats, dumpBindingStats
+from CTypeGenRun import resetBindingStats, layoutFingerprint, moduleLayouts
+from CTypeGenRun import layoutVerifications, verifyLayouts
+from CTypeGenRun import viewObject, viewArray, iterView
+from CTypeGenRun import GlobalVariable, globalVariables, snapshotGlobals
+from CTypeGenRun import unpackFrom, iterUnpack, packInto
+from CTypeMemory import ProcessMemory, CoreMemory, LocalMemory, buildId
+
+try:
+   import numpy # pylint: disable=import-error
+except ImportError:
+   numpy = None
 
 if len( sys.argv ) >= 2:
    sanitylib = sys.argv[ 1 ]
 else:
    sanitylib = ".libs/libCTypeSanity.so"
 
-types = [
-      PythonType( u"Foo" )
-         .field( u"anEnum", typename=u"TheEnum" )
-         .field( u"anonymousStructField", typename=u"AnonymousStructType" )
-         .field( u"anArrayField", typename=u"ArrayFieldType" ),
-      PythonType( "NoSuchType" ), # make sure we get a warning for notype.
-      PythonType( u"BigNum" ),
-      PythonType( u"AnonEnumWithTypedef" ),
-      PythonType( u"NamespacedLeaf", "Outer::Inner::Leaf" ),
-      PythonType( u"GlobalLeaf", "Leaf" ),
-      PythonType( u"NameSharedWithStructAndTypedef" ),
-]
+def sanityTypes():
+   # PythonType objects are bound to the types found in a generation, so each
+   # generation needs its own set.
+   return [
+         PythonType( u"Foo" )
+            .field( u"anEnum", typename=u"TheEnum" )
+            .field( u"anonymousStructField", typename=u"AnonymousStructType" )
+            .field( u"anArrayField", typename=u"ArrayFieldType" ),
+         PythonType( "NoSuchType" ), # make sure we get a warning for notype.
+         PythonType( u"BigNum" ),
+         PythonType( u"AnonEnumWithTypedef" ),
+         PythonType( u"NamespacedLeaf", "Outer::Inner::Leaf" ),
+         PythonType( u"GlobalLeaf", "Leaf" ),
+         PythonType( u"NameSharedWithStructAndTypedef" ),
+   ]
+
+types = sanityTypes()
 
 functions = [
       "make_foo",
@@ -43,6 +71,7 @@ functions = [
       "void_return_func",
       "nosuch_func", # make sure we get a warning for the non-existent function
       "test_qualifiers", # make sure restrict, volatile, etc, work
+      "bythree", # same signature as Foo::aFuncPtr
 ]
 
 globalVars = [
@@ -114,7 +143,9 @@ module, generator = generateOrThrow(
       types,
       functions,
       errorfunc=testwarning,
-      globalVars=globalVars )
+      globalVars=globalVars,
+      registry="CTypeSanity.json",
+      stats="CTypeSanity.stats.json" )
 assert warnCount == 3
 for warning in warnings:
    assert "nosuch" in warning.lower() # expect three warnings about missing things
@@ -164,11 +195,30 @@ module.AProperCplusplusNamespace_cn_cn_AStructureInTheCplusplusNamespace()
 
 assert module.AnonEnumWithTypedef.AETD_1 == 0
 assert module.AnonEnumWithTypedef.AETD_2 == 1
+assert enumName( module.AnonEnumWithTypedef, 2 ) == "AETD_3"
+assert enumName( module.AnonEnumWithTypedef, 42 ) is None
+assert module.BigNum._names_[ 0x123400000000 ] == "Big"
+assert decodeFlags( module.BigNum, module.BigNum.Small | 4 ) == [ "Small", "0x4" ]
+assert module.BigNum._flag_values_ == ( ( 0x1, "Small" ), )
 
 # Test global variable access
 glob = module.Globals( dll )
 assert glob.ExternalStrings[ 3 ] == b"three"
 assert glob.ExternalStruct.x == 42
+assert "ExternalStruct" in vars( glob ) # cached after first access
+assert "nameSharedWithStructAndTypedef" not in vars( glob )
+snap = snapshotGlobals( glob )
+assert snap.ExternalStruct.x == 42
+assert snap.ExternalStrings[ 3 ] == b"three"
+glob.ExternalStruct.x = 43
+assert snap.ExternalStruct.x == 42
+assert snapshotGlobals( glob, snap ) is snap
+assert snap.ExternalStruct.x == 43
+# Globals may have any names, without hiding our helpers.
+class ClashingGlobals( module.Globals ):
+   snapshot = GlobalVariable( "ExternalStruct", type( glob.ExternalStruct ) )
+assert snapshotGlobals( ClashingGlobals( dll ) ).snapshot.x == 43
+glob.ExternalStruct.x = 42
 
 # Two dimensional array sizes: the python declaration here lists the dimensions
 # non-obviously reversed wrt the C one
@@ -190,7 +240,8 @@ print( "Verify CFUNCTYPE generation" )
 assert set( module.functionTypes ) == { "make_foo",
                                         "print_foo",
                                         "void_return_func",
-                                        "test_qualifiers" }
+                                        "test_qualifiers",
+                                        "bythree" }
 
 # pylint: disable=protected-access
 methodType = module.functionTypes[ "make_foo" ]
@@ -209,3 +260,583 @@ methodType = module.functionTypes[ "void_return_func" ]
 assert methodType.__class__.__name__ == "PyCFuncPtrType"
 assert methodType._restype_ is None
 assert methodType._argtypes_ == ()
+
+# Functions and function pointers with the same signature share a prototype
+fooFieldTypes = dict( ( f[ 0 ], f[ 1 ] ) for f in module.Foo._fields_ )
+assert module.functionTypes[ "bythree" ] is fooFieldTypes[ "aFuncPtr" ]
+dll.bythree.restype = None
+module.decorateFunctions( dll )
+assert dll.bythree( 5 ) == 15
+
+print( "Verify prototypes are bound on first use by LazyLibrary" )
+lazyLib = module.LazyLibrary( sanitylib )
+assert "make_foo" not in vars( lazyLib )
+assert lazyLib.make_foo.restype == POINTER( module.Foo )
+assert lazyLib.make_foo().contents.anInt == 3
+assert "make_foo" in vars( lazyLib )
+assert "print_foo" not in vars( lazyLib )
+assert lazyLib.print_foo.argtypes == ( POINTER( module.Foo ), c_char_p, c_ulong )
+
+if sys.version_info >= ( 3, 7 ):
+   print( "Verify lazily materialized types" )
+   clearWarnings()
+   generateOrThrow( [ sanitylib ],
+                    "CTypeSanityLazy.py",
+                    sanityTypes(),
+                    functions,
+                    errorfunc=testwarning,
+                    globalVars=globalVars,
+                    lazy=True )
+   clearWarnings()
+
+   # generateOrThrow materializes everything to test it - load a fresh copy.
+   lazy = imp.load_source( "CTypeSanityLazyFresh", "CTypeSanityLazy.py" )
+   assert "Foo" not in vars( lazy )
+   assert lazy.Foo.native_size == sizeof( lazy.Foo )
+   # Foo's fields, including the pointer back to itself, are usable.
+   assert lazy.Foo._fields_[ 0 ][ 0 ] == "aCppString"
+   lazyFoo = lazy.Foo()
+   lazyFoo.aNestedStructure.x = 7
+   assert lazyFoo.aNestedStructure.x == 7
+   assert "Bar" in vars( lazy ) # Created as a dependency of Foo...
+   assert "Leaf" not in vars( lazy ) # ... but not unrelated types
+   assert lazy.NamespacedLeaf is lazy.Outer_cn_cn_Inner_cn_cn_Leaf
+   assert lazy.functionTypes[ "make_foo" ]._restype_ == POINTER( lazy.Foo )
+   lazyDll = CDLL( sanitylib )
+   lazy.decorateFunctions( lazyDll )
+   assert lazyDll.make_foo().contents.anInt == 3
+   assert lazy.Globals( lazyDll ).ExternalStruct.x == 42
+   assert lazy.layoutHashes == module.layoutHashes
+   assert lazy.verify( sanitylib ) == []
+   try:
+      lazy.NoSuchType # pylint: disable=pointless-statement
+      assert False, "expected AttributeError"
+   except AttributeError:
+      pass
+
+print( "Verify sharded output" )
+clearWarnings()
+sharded, _ = generateOrThrow( [ sanitylib ],
+                              "CTypeSanitySharded.py",
+                              sanityTypes(),
+                              functions,
+                              errorfunc=testwarning,
+                              globalVars=globalVars,
+                              shards=True )
+clearWarnings()
+outerShard = sys.modules[ "CTypeSanitySharded_Outer" ]
+assert sharded.Outer_cn_cn_Inner_cn_cn_Leaf is \
+      outerShard.Outer_cn_cn_Inner_cn_cn_Leaf
+assert sharded.NamespacedLeaf is outerShard.Outer_cn_cn_Inner_cn_cn_Leaf
+assert sharded.Foo.native_size == sizeof( sharded.Foo )
+with open( "CTypeSanitySharded_base.py" ) as baseSource:
+   assert "from CTypeSanitySharded_" not in baseSource.read()
+shardedDll = CDLL( sanitylib )
+sharded.decorateFunctions( shardedDll )
+assert shardedDll.make_foo().contents.anInt == 3
+
+print( "Verify types from existing modules are reused" )
+layered, layeredGenerator = generateOrThrow( [ sanitylib ],
+                                             "CTypeSanityLayered.py",
+                                             [],
+                                             [ "make_foo" ],
+                                             existingTypes=[ generator ] )
+assert layered.functionTypes[ "make_foo" ]._restype_ == POINTER( module.Foo )
+assert layeredGenerator.existingTypes == [ generator ]
+with open( "CTypeSanityLayered.py" ) as layeredSource:
+   assert "class Foo(" not in layeredSource.read()
+
+print( "Verify types from a registry are reused" )
+registered, _ = generateOrThrow( [ sanitylib ],
+                                 "CTypeSanityRegistered.py",
+                                 [ PythonType( "Foo" ) ],
+                                 [ "make_foo" ],
+                                 existingTypes=[ "CTypeSanity.json" ] )
+assert registered.functionTypes[ "make_foo" ]._restype_ == POINTER( module.Foo )
+assert registered.Foo is module.Foo
+
+print( "Verify types, functions and globals can be selected by pattern" )
+clearWarnings()
+selected, _ = generateOrThrow( [ sanitylib ],
+                               "CTypeSanitySelected.py",
+                               [ Selector( "Outer::*" ),
+                                 Selector( "unsigned *", tags=[ tags.DW_TAG_base_type ] ) ],
+                               [ Selector( "make_*" ),
+                                 Selector( "void_.*_func", regex=True ),
+                                 Selector( "Outer::*" ) ],
+                               globalVars=[ Selector( "External*",
+                                                      unit="*CTypeSanity.cpp" ),
+                                            Selector( "*", unit="nosuchunit" ) ],
+                               errorfunc=testwarning )
+assert warnCount == 1 and "Outer::* selects nothing" in warnings[ 0 ]
+clearWarnings()
+assert selected.Outer_cn_cn_Inner_cn_cn_Leaf.native_size == 4
+assert selected.unsigned_sp_int is c_uint
+assert not hasattr( selected, "GlobalLeaf" )
+assert set( selected.functionTypes ) == { "make_foo", "void_return_func" }
+selectedGlobals = globalVariables( selected.Globals )
+assert set( selectedGlobals ) == { "ExternalStrings", "ExternalStruct" }
+# Scopes are only split on "::" outside template arguments.
+assert splitScopedName( "A::B<C::D, E<F::G> >::H" ) == [ "A", "B<C::D, E<F::G> >", "H" ]
+assert Selector( "std::vector<std::string>::*" ).prefix == \
+      [ "std", "vector<std::string>" ]
+
+if numpy is not None:
+   print( "Verify numpy dtypes" )
+   clearWarnings()
+   numpyModule, _ = generateOrThrow( [ sanitylib ],
+                                     "CTypeSanityNumpy.py",
+                                     sanityTypes(),
+                                     functions,
+                                     errorfunc=testwarning,
+                                     globalVars=globalVars,
+                                     numpy=True )
+   clearWarnings()
+   fooDtype = numpyModule.Foo._numpy_dtype_
+   assert fooDtype.itemsize == sizeof( numpyModule.Foo )
+   assert fooDtype.fields[ "aNestedStructure" ][ 1 ] == \
+         numpyModule.Foo.aNestedStructure.offset
+   assert fooDtype.fields[ "aTwoDimensionalArrayOfLong" ][ 0 ].shape == ( 17, 13 )
+   foos = ( numpyModule.Foo * 3 )()
+   foos[ 1 ].aNestedStructure.x = 11
+   fooArray = numpyArray( foos )
+   assert fooArray[ 1 ][ "aNestedStructure" ][ "x" ] == 11
+   fooArray[ 2 ][ "anInt" ] = 9 # This shares memory with foos.
+   assert foos[ 2 ].anInt == 9
+
+print( "Verify struct codecs" )
+clearWarnings()
+codecModule, _ = generateOrThrow( [ sanitylib ],
+                                  "CTypeSanityCodecs.py",
+                                  sanityTypes(),
+                                  functions,
+                                  errorfunc=testwarning,
+                                  globalVars=globalVars,
+                                  codecs=True )
+clearWarnings()
+assert codecModule.Foo._struct_codec_ is None # Foo has pointers.
+CodecBar = codecModule.Bar
+assert CodecBar._struct_codec_.size == sizeof( CodecBar )
+bars = ( CodecBar * 2 )()
+bars[ 1 ].x = 5
+bars[ 1 ].y = 6
+assert unpackFrom( CodecBar, bars, sizeof( CodecBar ) ) == ( 5, 6 )
+packInto( CodecBar, bars, 0, 7, 8 )
+assert bars[ 0 ].y == 8
+if sys.version_info >= ( 3, 4 ):
+   assert list( iterUnpack( CodecBar, bars ) ) == [ ( 7, 8 ), ( 5, 6 ) ]
+
+print( "Verify views over buffers" )
+Bar = module.Bar
+barBuffer = bytearray( sizeof( Bar ) * 4 )
+aBar = viewObject( Bar, barBuffer, sizeof( Bar ) )
+aBar.y = 42
+assert viewArray( Bar, barBuffer )[ 1 ].y == 42
+assert len( viewArray( Bar, barBuffer, sizeof( Bar ) * 2 ) ) == 2
+everyOther = list( iterView( Bar, barBuffer, stride=sizeof( Bar ) * 2 ) )
+assert len( everyOther ) == 2
+everyOther[ 1 ].x = 7
+assert viewObject( Bar, barBuffer, sizeof( Bar ) * 2 ).x == 7
+for badView in ( lambda: viewObject( Bar, barBuffer, sizeof( Bar ) * 4 ),
+                 lambda: viewObject( Bar, barBuffer, 1 ),
+                 lambda: viewArray( Bar, barBuffer, 0, 5 ),
+                 lambda: iterView( Bar, barBuffer, 0, 3, sizeof( Bar ) * 2 ) ):
+   try:
+      badView()
+      assert False, "expected ValueError"
+   except ValueError:
+      pass
+
+if sys.version_info >= ( 3, 6 ):
+   print( "Verify pickling" )
+   pickledBar = pickle.loads( pickle.dumps( aBar ) )
+   assert type( pickledBar ) is Bar and pickledBar.y == 42
+   foo = dll.make_foo().contents
+   pickledFoo = pickle.loads( pickle.dumps( foo ) )
+   assert pickledFoo.anInt == foo.anInt
+   assert pickledFoo.aNestedStructure.y == foo.aNestedStructure.y
+   assert not pickledFoo.next # pointers are nulled by default...
+   module.Foo._pickle_pointers_ = "raw"
+   assert cast( pickle.loads( pickle.dumps( foo ) ).next, c_void_p ).value == \
+         cast( foo.next, c_void_p ).value # ... unless asked to keep them
+   module.Foo._pickle_pointers_ = "error"
+   try:
+      pickle.dumps( foo )
+      assert False, "expected PicklingError"
+   except pickle.PicklingError:
+      pass
+   del module.Foo._pickle_pointers_
+   barArray = unpackArray( Bar, packArray( viewArray( Bar, barBuffer ) ) )
+   assert len( barArray ) == 4 and barArray[ 1 ].y == 42
+   assert bytearray( barArray ) == barBuffer
+   class PointerUnion( Union ):
+      _fields_ = [ ( "p", c_void_p ), ( "n", c_long ) ]
+   class HasPointerUnion( Structure ):
+      _fields_ = [ ( "u", PointerUnion * 2 ) ]
+   unions = ( HasPointerUnion * 1 )()
+   unions[ 0 ].u[ 1 ].n = 5
+   try:
+      packArray( unions ) # Nulling p would clobber n.
+      assert False, "expected PicklingError"
+   except pickle.PicklingError:
+      pass
+   HasPointerUnion._pickle_pointers_ = "raw"
+   assert unpackArray( HasPointerUnion, packArray( unions ) )[ 0 ].u[ 1 ].n == 5
+
+print( "Verify dict converters" )
+clearWarnings()
+convModule, _ = generateOrThrow( [ sanitylib ],
+                                 "CTypeSanityConverters.py",
+                                 sanityTypes(),
+                                 functions,
+                                 errorfunc=testwarning,
+                                 globalVars=globalVars,
+                                 converters=True )
+clearWarnings()
+convDll = CDLL( sanitylib )
+convModule.decorateFunctions( convDll )
+convFoo = convDll.make_foo().contents
+fooDict = convModule.Foo_to_dict( convFoo )
+assert fooDict[ "anInt" ] == 3
+assert fooDict[ "aNestedStructure" ] == { "x": 100, "y": 200 }
+assert fooDict[ "aNestedUnion" ][ "bar" ] == { "x": 1, "y": 2 }
+assert fooDict[ "aOneDimensionalArrayOfChar" ] == b"hello world"
+assert len( fooDict[ "aTwoDimensionalArrayOfLong" ] ) == 17
+assert len( fooDict[ "aTwoDimensionalArrayOfLong" ][ 0 ] ) == 13
+assert fooDict[ "anEnum" ] == 3
+assert fooDict[ "bigEnum" ] == convModule.BigNum.Big
+assert fooDict[ "aBitFieldPart2" ] == 200
+assert fooDict[ "next" ] == cast( convFoo.next, c_void_p ).value
+fooDict[ "aTwoDimensionalArrayOfLong" ][ 16 ][ 12 ] = 1612
+fooCopy = convModule.Foo_from_dict( fooDict )
+assert convModule.Foo_to_dict( fooCopy ) == fooDict
+assert fooCopy.aTwoDimensionalArrayOfLong[ 16 ][ 12 ] == 1612
+assert fooCopy.aFuncPtr( 4 ) == 8
+assert not hasattr( convModule.Foo, "to_dict" )
+# Types taken from a registry convert as the ones they stand for do.
+partsModule, _ = generateOrThrow( [ sanitylib ],
+                                  "CTypeSanityParts.py",
+                                  [ PythonType( u"Baz" ), PythonType( u"BigNum" ) ],
+                                  [],
+                                  converters=True,
+                                  registry="CTypeSanityParts.json" )
+with open( "CTypeSanityParts.json" ) as partsRegistry:
+   partsKinds = dict( ( "::".join( entry[ "name" ] ), entry[ "kind" ] )
+                      for entry in json.load( partsRegistry )[ "types" ] )
+assert partsKinds == { "Bar": "structure", "Baz": "union", "BigNum": "enum" }
+wholeModule, _ = generateOrThrow( [ sanitylib ],
+                                  "CTypeSanityWhole.py",
+                                  [ PythonType( u"Foo" ) ],
+                                  [ "make_foo" ],
+                                  converters=True,
+                                  existingTypes=[ "CTypeSanityParts.json" ] )
+with open( "CTypeSanityWhole.py" ) as wholeSource:
+   assert "class Bar(" not in wholeSource.read()
+sanityBinary = os.path.basename( sanitylib )
+assert wholeModule.layoutHashes[ sanityBinary ][ "Foo" ] == \
+      module.layoutHashes[ sanityBinary ][ "Foo" ]
+wholeDll = CDLL( sanitylib )
+wholeModule.decorateFunctions( wholeDll )
+wholeDict = wholeModule.Foo_to_dict( wholeDll.make_foo().contents )
+assert wholeDict[ "aOneDimensionalArrayOfChar" ] == b"hello world"
+assert wholeDict[ "bigEnum" ] == partsModule.BigNum.Big
+assert wholeDict[ "aNestedUnion" ][ "bar" ] == { "x": 1, "y": 2 }
+wholeCopy = wholeModule.Foo_from_dict( wholeDict )
+assert wholeModule.Foo_to_dict( wholeCopy ) == wholeDict
+
+print( "Verify reading objects from process memory and core files" )
+def writeCore( path, regions, mappings ):
+   ''' Write a minimal x86_64 ELF core file, with a PT_LOAD segment for each
+   ( address, data ) in regions, and an NT_FILE note listing mappings '''
+   files = struct.pack( "<QQ", len( mappings ), 1 ) # page size 1: byte offsets
+   for mapping in mappings:
+      files += struct.pack( "<QQQ", mapping.start, mapping.end, mapping.offset )
+   files += b"".join( m.path.encode( "utf-8" ) + b"\0" for m in mappings )
+   note = struct.pack( "<III", 5, len( files ), 0x46494c45 ) + b"CORE\0\0\0\0" + \
+         files + b"\0" * ( -len( files ) % 4 )
+   phnum = len( regions ) + 1
+   offset = 64 + 56 * phnum
+   headers = [ struct.pack( "<IIQQQQQQ", 4, 0, offset, 0, 0, len( note ), 0, 4 ) ]
+   body = note
+   for address, data in regions:
+      headers.append( struct.pack( "<IIQQQQQQ", 1, 6, offset + len( body ),
+                                   address, 0, len( data ), len( data ), 1 ) )
+      body += data
+   with open( path, "wb" ) as core:
+      core.write( b"\x7fELF\x02\x01\x01" + b"\0" * 9 )
+      core.write( struct.pack( "<HHIQQQIHHHHHH", 4, 62, 1, 0, 64, 0, 0, 64, 56,
+                               phnum, 64, 0, 0 ) )
+      core.write( b"".join( headers ) + body )
+
+localFoo = dll.make_foo().contents
+fooAddress = addressof( localFoo )
+with ProcessMemory( os.getpid() ) as target:
+   remoteFoo = target.readObject( module.Foo, fooAddress )
+   assert remoteFoo is not localFoo
+   assert string_at( addressof( remoteFoo ), sizeof( module.Foo ) ) == \
+         string_at( fooAddress, sizeof( module.Foo ) )
+   assert remoteFoo.aNestedStructure.y == 200
+   assert target.dereference( remoteFoo.next ).anInt == 3
+   assert target.dereference( POINTER( module.Foo )() ) is None
+   remoteGlobals = target.globals( module.Globals, sanitylib )
+   assert remoteGlobals.ExternalStruct.x == 42
+   strings = cast( remoteGlobals.ExternalStrings, POINTER( c_void_p ) )
+   assert target.readCString( strings[ 3 ] ) == b"three"
+   syscalls = target.syscalls
+   assert len( target.readObjects( module.Foo, [ fooAddress ] * 3 ) ) == 3
+   assert target.syscalls == syscalls # all served from the page cache
+   try:
+      target.read( 0, 1 )
+      assert False, "expected ValueError"
+   except ValueError:
+      pass
+
+   # Make a core file with the pages holding our Foo and ExternalStruct
+   regions = []
+   for address, size in ( ( fooAddress, sizeof( module.Foo ) ),
+                          ( remoteGlobals.address( "ExternalStruct" ),
+                            sizeof( module.AnotherStruct ) ) ):
+      start = address & ~4095
+      end = ( address + size + 4095 ) & ~4095
+      regions.append( ( start, target.read( start, end - start ) ) )
+   writeCore( "CTypeSanity.core", regions, target.mappings() )
+
+with CoreMemory( "CTypeSanity.core" ) as core:
+   coreFoo = core.readObject( module.Foo, fooAddress )
+   assert coreFoo.anInt == 3 and coreFoo.aNestedStructure.x == 100
+   assert core.dereference( coreFoo.next ).aDouble == localFoo.aDouble
+   assert core.globals( module.Globals, sanitylib ).ExternalStruct.x == 42
+os.unlink( "CTypeSanity.core" )
+
+print( "Verify breadth-first traversal of pointers" )
+chain = ( module.Foo * 100 )()
+for i, node in enumerate( chain ):
+   node.anInt = i
+   node.aNestedStructure.y = i * 2
+   node.aNestedStructurePointer = pointer( node.aNestedStructure )
+   if i + 1 < len( chain ):
+      node.next = pointer( chain[ i + 1 ] )
+chain[ 99 ].next = pointer( chain[ 50 ] ) # a cycle, visited once
+chainAddress = addressof( chain )
+nodes = list( LocalMemory().traverse( module.Foo, chainAddress, [ "next" ],
+                                      fields=[ "anInt", "aNestedStructure" ] ) )
+assert [ n.data[ 0 ] for n in nodes ] == list( range( 100 ) )
+assert [ n.depth for n in nodes ] == list( range( 100 ) )
+assert nodes[ 7 ].data[ 1 ] == ( 0, 14 ) and nodes[ 7 ].parent == nodes[ 6 ].address
+with ProcessMemory( os.getpid() ) as target:
+   follow = { module.Foo: [ "next", "aNestedStructurePointer" ] }
+   fields = { module.Foo: [ "anInt" ], module.Bar: [ "y" ] }
+   nodes = list( target.traverse( module.Foo, [ chainAddress ] * 2, follow,
+                                  fields=fields, maxDepth=3 ) )
+   assert [ ( n.type, n.depth, n.data ) for n in nodes ] == [
+         ( module.Foo, 0, ( 0, ) ),
+         ( module.Foo, 1, ( 1, ) ), ( module.Bar, 1, ( 0, ) ),
+         ( module.Foo, 2, ( 2, ) ), ( module.Bar, 2, ( 2, ) ),
+         ( module.Foo, 3, ( 3, ) ), ( module.Bar, 3, ( 4, ) ) ]
+   nodes = list( target.traverse( module.Foo, chainAddress, [ "next" ] ) )
+   assert len( nodes ) == 100
+   assert module.Foo.from_buffer_copy( nodes[ 42 ].data ).anInt == 42
+   assert target.syscalls <= sizeof( chain ) // 4096 + 2 # each page read once
+   assert len( list( target.traverse( module.Foo, chainAddress, [ "next" ],
+                                      limit=10 ) ) ) == 10
+   chain[ 3 ].next = cast( c_void_p( 8 ), POINTER( module.Foo ) )
+   target.invalidate()
+   assert len( list( target.traverse( module.Foo, chainAddress, [ "next" ],
+                                      skipUnreadable=True ) ) ) == 4
+# A frontier wider than the cache is read in chunks that fit in it, rather
+# than prefetched all at once, and evicted before it's read.
+with ProcessMemory( os.getpid(), cachePages=8 ) as target:
+   nodes = list( target.traverse( module.Foo, [ addressof( n ) for n in chain ], [] ) )
+   assert len( nodes ) == 100
+   assert target.syscalls <= sizeof( chain ) // ( 4096 * 2 )
+
+print( "Verify batch calls" )
+inputs = ( c_int * 1000 )( *range( 1000 ) )
+tripled = batchCall( dll.bythree, [ inputs ] )
+assert list( tripled ) == [ i * 3 for i in range( 1000 ) ]
+undecorated = CDLL( sanitylib ).bythree
+assert list( batchCall( undecorated, [ inputs ],
+                        proto=module.functionTypes[ "bythree" ] ) ) == list( tripled )
+out = ( c_int * 5 )()
+assert batchCall( dll.bythree, [ 7 ], out=out ) is out
+assert list( out ) == [ 21 ] * 5
+if numpy:
+   numbers = numpy.arange( 10, dtype=numpy.int32 )
+   assert ( numpyArray( batchCall( dll.bythree, [ numbers ] ) ) == numbers * 3 ).all()
+   numbers.setflags( write=False ) # read-only arrays are copied
+   assert ( numpyArray( batchCall( dll.bythree, [ numbers ] ) ) == numbers * 3 ).all()
+   try:
+      batchCall( dll.bythree, [ numbers[ : : 2 ] ] )
+      assert False, "expected ValueError"
+   except ValueError:
+      pass
+strlen = CDLL( None ).strlen
+strlen.restype = c_size_t
+strlen.argtypes = [ POINTER( c_char ) ]
+text = create_string_buffer( b"abcdefgh" ) # each element is passed by address
+assert list( batchCall( strlen, [ text ] ) ) == list( range( 8, -1, -1 ) )
+try:
+   batchCall( strlen, [ ( c_int * 3 )() ] )
+   assert False, "expected TypeError"
+except TypeError:
+   pass
+
+print( "Verify profiling of bindings" )
+profiledDll = CDLL( sanitylib )
+module.decorateFunctions( profiledDll )
+assert "ProfiledFunction" not in type( profiledDll.bythree ).__name__
+module.decorateFunctions( profiledDll, profile=True )
+assert list( batchCall( profiledDll.bythree, [ inputs ] ) ) == list( tripled )
+assert cast( profiledDll.bythree, c_void_p ).value == \
+      cast( CDLL( sanitylib ).bythree, c_void_p ).value
+assert profiledDll.bythree.argtypes == [ c_int ] or \
+      profiledDll.bythree.argtypes == ( c_int, )
+for i in range( 100 ):
+   assert profiledDll.bythree( i ) == i * 3
+profiledDll.make_foo()
+stats = bindingStats()
+bythreeStats = stats[ ( "CTypeSanity", "bythree" ) ]
+assert bythreeStats.calls == 100 and sum( bythreeStats.histogram ) == 100
+assert bythreeStats.total > 0 and bythreeStats.percentile( 0.5 ) > 0
+assert stats[ ( "CTypeSanity", "make_foo" ) ].calls == 1
+assert stats[ ( "CTypeSanity", "print_foo" ) ].calls == 0
+folded = io.StringIO() if sys.version_info >= ( 3, ) else io.BytesIO()
+dumpBindingStats( folded )
+assert "CTypeSanity;bythree " in folded.getvalue()
+resetBindingStats()
+assert bythreeStats.calls == 0
+module.decorateFunctions( profiledDll, profile=True, stackDepth=4 )
+profiledDll.print_foo( dll.make_foo(), create_string_buffer( 1024 ), 1024 )
+folded = io.StringIO() if sys.version_info >= ( 3, ) else io.BytesIO()
+dumpBindingStats( folded )
+assert "<module> (CTypeGenSanity.py:" in folded.getvalue()
+assert ");CTypeSanity;print_foo " in folded.getvalue()
+
+print( "Verify generation statistics" )
+with open( "CTypeSanity.stats.json" ) as statsFile:
+   generationStats = json.load( statsFile )
+assert generationStats == json.loads( json.dumps( generator.stats.asDict() ) )
+for phaseName in ( "open", "scan", "hints", "emit", "load", "test" ):
+   assert generationStats[ "phases" ][ phaseName ][ "count" ] >= 1
+   assert generationStats[ "phases" ][ phaseName ][ "maxRssGrowth" ] >= 0
+assert generationStats[ "diesVisited" ] > 0
+assert generationStats[ "typesEmitted" ] == len( generator.definedTypes )
+assert generationStats[ "typeCacheMisses" ] == len( generator.typesByDieKey )
+assert generationStats[ "typeCacheHits" ] > 0
+
+print( "Verify rendered names are memoized and invalidated" )
+assert asPythonId( u"Outer::Inner::Leaf" ) == u"Outer_cn_cn_Inner_cn_cn_Leaf"
+assert asPythonId( u"Foo<int, char*>" ) == u"Foo_lt_int_comma_sp_char_ptr_gt"
+assert asPythonId( u"operator()" ) == u"operator_lp_rp"
+assert asPythonId( u"plain" ) == u"plain" and asPythonId( None ) is None
+sanitySpecs = dict( ( spec.pythonName, spec ) for spec in generator.requiredTypes )
+bigNumType = sanitySpecs[ u"BigNum" ].type
+leafType = sanitySpecs[ u"GlobalLeaf" ].type
+assert bigNumType.ctype() == u"CTypeSanity.BigNum"
+leafCtype = leafType.ctype()
+# Type names are interned, whether they're str or unicode.
+assert leafType._name is intern( u"".join( [ u"Le", u"af" ] ) )
+assert leafType.ctype() is leafCtype
+# Hints on one type leave the names rendered for others alone.
+bigNumType.applyHints( sanitySpecs[ u"BigNum" ] )
+assert "ctype" not in bigNumType.memos
+assert leafType.memos[ "ctype" ] is leafCtype
+# Changing the package changes every name.
+generator.pkgname = None
+assert leafType.ctype() == u"Leaf" and bigNumType.ctype() == u"BigNum"
+generator.pkgname = "CTypeSanity"
+assert leafType.ctype() == leafCtype
+
+print( "Verify ABI comparison" )
+sanityLayouts = binaryLayouts( [ sanitylib ], lambda _: None )
+assert sanityLayouts[ "Bar" ] == [ "structure", 8, [ [ "x", 0, None, [ "int", 4 ] ],
+                                                    [ "y", 4, None, [ "int", 4 ] ] ] ]
+assert sanityLayouts[ "AnonEnumWithTypedef" ][ 0 ] == "enum"
+selfDiff = diffLayouts( sanityLayouts, sanityLayouts )
+assert not selfDiff and selfDiff.compared == len( sanityLayouts )
+moduleDiff = abiDiff( sanitylib, module, lambda _: None )
+assert not moduleDiff and moduleDiff.compared == len( moduleLayouts( module ) )
+# Typedefs for anonymous types are compared under the typedef's name.
+assert module.AnonEnumWithTypedef._c_typedefs_ == ( "AnonEnumWithTypedef", )
+assert moduleLayouts( module )[ "AnonEnumWithTypedef" ] == \
+      sanityLayouts[ "AnonEnumWithTypedef" ]
+assert moduleLayouts( module )[ "Foo" ] == sanityLayouts[ "Foo" ]
+# Both sides name types by their C names, whatever their python names.
+assert module.NamespacedLeaf._c_name_ == "Outer::Inner::Leaf"
+assert moduleLayouts( module )[ "Outer::Inner::Leaf" ] == \
+      sanityLayouts[ "Outer::Inner::Leaf" ]
+# Fields renamed or retyped by hints are compared as the DWARF describes them.
+hinted, _ = generateOrThrow( [ sanitylib ],
+                             "CTypeSanityHinted.py",
+                             [ PythonType( "Bar" )
+                                 .field( "x", name="renamedX" )
+                                 .field( "y", typeOverride="c_uint" ) ],
+                             [] )
+assert [ field[ 0 ] for field in hinted.Bar._fields_ ] == [ "renamedX", "y" ]
+assert moduleLayouts( hinted )[ "Bar" ] == sanityLayouts[ "Bar" ]
+hintedDiff = abiDiff( sanitylib, hinted, lambda _: None )
+assert not hintedDiff and hintedDiff.compared == 1
+changedLayouts = json.loads( json.dumps( sanityLayouts ) )
+changedLayouts[ "Bar" ][ 1 ] = 16
+changedLayouts[ "Bar" ][ 2 ][ 1 ][ 1:4 ] = [ 8, None, [ "int", 8 ] ]
+changedLayouts[ "BigNum" ][ 2 ][ 1 ][ 0 ] = 2
+del changedLayouts[ "Baz" ]
+changedLayouts[ "Extra" ] = [ "structure", None, None ]
+assert layoutFingerprint( changedLayouts[ "Foo" ] ) == \
+      layoutFingerprint( sanityLayouts[ "Foo" ] )
+changes = diffLayouts( sanityLayouts, changedLayouts )
+assert changes.added == [ "Extra" ] and changes.removed == [ "Baz" ]
+assert changes.changed == [
+      ( "Bar", [ "size 8 -> 16", "y: offset 4 -> 8", "y: type int32 -> int64" ] ),
+      ( "BigNum", [ "enumerator Big = 20014547599360 -> 2" ] ) ]
+
+print( "Verify embedded layout fingerprints" )
+assert module.buildIds == { sanityBinary: buildId( sanitylib ) }
+sanityHashes = module.layoutHashes[ sanityBinary ]
+assert sanityHashes[ "Foo" ] == layoutFingerprint( sanityLayouts[ "Foo" ] )
+assert sanityHashes[ "Outer::Inner::Leaf" ] == \
+      layoutFingerprint( sanityLayouts[ "Outer::Inner::Leaf" ] )
+assert module.verify( sanitylib ) == []
+assert sharded.verify( sanitylib ) == []
+# A library with another build-id is checked against its DWARF instead.
+with open( sanitylib, "rb" ) as original:
+   image = original.read()
+ident = binascii.unhexlify( buildId( sanitylib ) )
+with open( "CTypeSanityRebuilt", "wb" ) as rebuilt:
+   rebuilt.write( image.replace( ident, ident[ : : -1 ] ) )
+assert buildId( "CTypeSanityRebuilt" ) not in ( None, buildId( sanitylib ) )
+assert module.verify( "CTypeSanityRebuilt" ) == []
+changedHashes = { sanityBinary: dict( sanityHashes ) }
+changedHashes[ sanityBinary ][ "Bar" ] = "0" * 40
+changedHashes[ sanityBinary ][ "NoSuchType" ] = "0" * 40
+assert verifyLayouts( "CTypeSanityRebuilt", module.buildIds, changedHashes ) == \
+      [ "Bar", "NoSuchType" ]
+# The result is cached by content, as long as the library doesn't change.
+verifications = len( layoutVerifications )
+assert verifyLayouts( "CTypeSanityRebuilt", module.buildIds,
+                      json.loads( json.dumps( changedHashes ) ) ) == \
+      [ "Bar", "NoSuchType" ]
+assert len( layoutVerifications ) == verifications
+# Without the generator, only the check by build-id can be made.
+generatorModule = sys.modules[ "CTypeGen" ]
+sys.modules[ "CTypeGen" ] = None
+try:
+   assert verifyLayouts( sanitylib, module.buildIds, module.layoutHashes ) == []
+   verifyLayouts( "CTypeSanityRebuilt", module.buildIds, { sanityBinary: {} } )
+   assert False, "expected ImportError"
+except ImportError as e:
+   assert "checking its layouts needs CTypeGen" in str( e )
+finally:
+   sys.modules[ "CTypeGen" ] = generatorModule
+# With several binaries, only the types from the one named are checked.
+otherIds = dict( module.buildIds, other=None )
+otherHashes = dict( changedHashes, other={ "Foo": "0" * 40 } )
+assert verifyLayouts( "CTypeSanityRebuilt", otherIds, otherHashes,
+                      sanityBinary ) == [ "Bar", "NoSuchType" ]
+assert verifyLayouts( "CTypeSanityRebuilt", otherIds, otherHashes,
+                      "other" ) == [ "Foo" ]
+try:
+   verifyLayouts( "CTypeSanityRebuilt", otherIds, otherHashes )
+   assert False, "expected ValueError"
+except ValueError as e:
+   assert "CTypeSanityRebuilt is not one of" in str( e )
@@ -191,6 +191,11 @@ extern "C" {
 void
 void_return_func() {}
 
+int
+bythree( int arg ) {
+   return arg * 3;
+}
+
 Foo_t *
 make_foo() {
    Foo_t * aFoop = ( Foo * )malloc( sizeof( Foo ) );